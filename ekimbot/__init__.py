@@ -1,3 +1,3 @@
-from girc import Handler
 from ekimbot.botplugin import BotPlugin, ClientPlugin, command_plugin
-from ekimbot.commands import CommandHandler
+# plugins get a Handler which records stats
+from ekimbot.commands import CommandHandler, TimedHandler as Handler
@@ -0,0 +1,368 @@
+"""End-to-end throughput benchmark.
+
+Runs real ClientManagers against an in-process ekimbot.fakeserver, sends them synthetic traffic
+and reports how fast it was handled:
+	python -m ekimbot.bench [options]
+
+Traffic is a random (but seeded, so repeatable) mix of:
+	chatter: plain channel messages
+	command: prefixed commands, eg. "ekimbot: help"
+	typo: prefixed commands that don't exist, for didyoumean
+	churn: JOIN, PART, QUIT and NICK of other users
+Throughput is messages handled per second of wall time, from the first message being sent until
+each client has read everything (see Connection.sync()). Since the server runs in the same process,
+this includes the cost of generating and sending the traffic. Latency is taken from ekimbot.stats:
+the time handlers and commands took to run, not including time spent queued.
+
+Use --save to write the results to a file, and --compare to check the results against a previous run.
+Baselines are only comparable when recorded on the same machine with the same options.
+No baseline is shipped, as results depend on the machine: record one with --save first.
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import gevent
+
+from ekimbot import main
+from ekimbot.botplugin import BotPlugin
+from ekimbot.config import config
+from ekimbot.discovery import PluginManifest
+from ekimbot.fakeserver import FakeServer
+from ekimbot.stats import stats, Histogram, format_seconds
+
+
+COMMANDS = ['help', 'help help', 'more']
+TYPOS = ['hlep', 'halp', 'mroe', 'hepl']
+CHATTER = ['hello', 'anyone around?', 'lol', 'so anyway, as I was saying earlier it turns out the thing was broken all along']
+
+# results where bigger is better. For everything else, smaller is better.
+HIGHER_IS_BETTER = {'throughput'}
+
+
+class Traffic(object):
+	"""Generates lines from other users for one client, keeping track of who is in each channel
+	so that churn is consistent (eg. users only PART channels they're in)"""
+
+	def __init__(self, rand, nick, names, users, mix):
+		self.rand = rand
+		self.nick = nick
+		self.channels = sorted(names)
+		self.names = {channel: set(channel_names) for channel, channel_names in names.items()}
+		self.users = list(users)
+		self.mix = [kind for kind, weight in mix for _ in range(weight)]
+		self.next_user = 0
+
+	def hostmask(self, nick):
+		return '{}!{}@user.host'.format(nick, nick)
+
+	def line(self):
+		kind = self.rand.choice(self.mix)
+		return getattr(self, kind)()
+
+	def privmsg(self, text):
+		channel = self.rand.choice(self.channels)
+		if not self.names[channel]:
+			return self.join(channel) # no-one to speak
+		user = self.rand.choice(list(self.names[channel]))
+		return ':{} PRIVMSG {} :{}'.format(self.hostmask(user), channel, text)
+
+	def chatter(self):
+		return self.privmsg(self.rand.choice(CHATTER))
+
+	def command(self):
+		return self.privmsg('{}: {}'.format(self.nick, self.rand.choice(COMMANDS)))
+
+	def typo(self):
+		return self.privmsg('{}: {}'.format(self.nick, self.rand.choice(TYPOS)))
+
+	def join(self, channel):
+		absent = [user for user in self.users if user not in self.names[channel]]
+		if not absent:
+			return self.part(channel)
+		user = self.rand.choice(absent)
+		self.names[channel].add(user)
+		return ':{} JOIN {}'.format(self.hostmask(user), channel)
+
+	def part(self, channel):
+		user = self.rand.choice(list(self.names[channel]))
+		self.names[channel].remove(user)
+		return ':{} PART {} :bye'.format(self.hostmask(user), channel)
+
+	def churn(self):
+		channel = self.rand.choice(self.channels)
+		kind = self.rand.choice(['join', 'part', 'quit', 'nick'])
+		if kind == 'join' or not self.names[channel]:
+			return self.join(channel)
+		if kind == 'part':
+			return self.part(channel)
+		user = self.rand.choice(list(self.names[channel]))
+		if kind == 'quit':
+			for names in self.names.values():
+				names.discard(user)
+			return ':{} QUIT :Quit: bye'.format(self.hostmask(user))
+		self.next_user += 1
+		new = 'renamed{}'.format(self.next_user)
+		self.users[self.users.index(user)] = new
+		for names in self.names.values():
+			if user in names:
+				names.remove(user)
+				names.add(new)
+		return ':{} NICK :{}'.format(self.hostmask(user), new)
+
+
+def parse_mix(value):
+	mix = []
+	for part in value.split(','):
+		kind, weight = part.split('=')
+		if kind not in ('chatter', 'command', 'typo', 'churn'):
+			raise argparse.ArgumentTypeError("Unknown traffic kind: {!r}".format(kind))
+		mix.append((kind, int(weight)))
+	return mix
+
+
+def merged_latency(kind):
+	"""Returns a Histogram of all timers of the given kind"""
+	result = Histogram()
+	for (timer_kind, name), timer in stats.timers.items():
+		if timer_kind != kind:
+			continue
+		for i, count in enumerate(timer.latency.buckets):
+			result.buckets[i] += count
+		result.count += timer.latency.count
+		result.sum += timer.latency.sum
+	return result
+
+
+def max_rss():
+	"""Peak memory use in KiB"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def configure(server, client_names, client_options, loglevel='WARNING', user_config=False):
+	"""Load config for running the given clients against server, with client_options overriding
+	client_defaults. Unlike a normal run, argv and the environment are ignored, as is user config
+	unless user_config is True (though clients and client_defaults are always replaced).
+	Returns the path of a temporary store file, which should be removed with cleanup()."""
+	store_fd, store_path = tempfile.mkstemp(prefix='ekimbot-bench-', suffix='.json')
+	os.close(store_fd)
+	os.remove(store_path) # the store expects to create it
+	client_defaults = config.client_defaults.copy()
+	client_defaults.update({
+		'hostname': server.address[0],
+		'port': server.port,
+		'channels': [],
+		'flood': {
+			'lines_per_second': None,
+			'line_burst': None,
+			'bytes_per_second': None,
+			'byte_burst': None,
+			'max_queue': 10**6,
+		},
+	})
+	client_defaults.update(client_options)
+	config.load(user_config=user_config, argv=False, env=False,
+		loglevel=loglevel,
+		clients={name: {} for name in client_names},
+		client_defaults=client_defaults,
+		store_path=store_path,
+		plugin_manifest_path=None,
+	)
+	main.configure_logging()
+	main.plugin_manifest = PluginManifest(config.plugin_paths, None, BotPlugin.load)
+	return store_path
+
+
+def start_clients(server, client_names, timeout=30):
+	"""Start a ClientManager for each client and wait until they have connected and joined their channels.
+	Returns (managers, connections), where connections are the server's Connections for each client in no particular order."""
+	managers = [main.ClientManager.spawn(name) for name in client_names]
+	if not server.wait_for_connections(len(client_names), timeout=timeout):
+		raise Exception("Timed out waiting for clients to connect")
+	for manager in managers:
+		if not manager.started.wait(timeout):
+			raise Exception("Timed out waiting for client {} to start".format(manager.name))
+	connections = list(server.connections)
+	for connection in connections:
+		if not connection.sync(timeout):
+			raise Exception("Timed out waiting for clients to join channels")
+	return managers, connections
+
+
+def cleanup(managers, server, store_path):
+	for manager in managers:
+		manager.stop('Benchmark finished')
+	gevent.joinall(managers, timeout=10)
+	server.stop()
+	if os.path.exists(store_path):
+		os.remove(store_path)
+
+
+def run(options):
+	rand = random.Random(options.seed)
+	nick = 'benchbot'
+	channels = ['#chan{}'.format(i) for i in range(options.channels)]
+	client_names = ['bench{}'.format(i) for i in range(options.clients)]
+
+	# every client starts with the same users in each channel
+	users = ['user{}'.format(i) for i in range(options.users)]
+	names = {channel: rand.sample(users, len(users) // 2) for channel in channels}
+	server = FakeServer(names=names, record=False)
+	server.start()
+
+	store_path = configure(server, client_names, {
+		'nick': nick,
+		'command_prefix': '{}: '.format(nick),
+		'channels': channels,
+		'plugins': options.plugins,
+		'ignore': ['ignored{}!*@*'.format(i) for i in range(options.ignore)],
+	}, options.loglevel)
+
+	managers = []
+	try:
+		rss_before = max_rss()
+		managers, connections = start_clients(server, client_names)
+		gc.collect()
+		rss_idle = max_rss()
+		stats.reset()
+
+		# generate traffic up front, so it isn't counted
+		lines = {}
+		for connection in connections:
+			traffic = Traffic(rand, nick, names, users, options.mix)
+			lines[connection] = [traffic.line() for _ in range(options.messages)]
+
+		def send(connection):
+			connection_lines = lines[connection]
+			for i in range(0, len(connection_lines), options.batch):
+				connection.send(*connection_lines[i:i+options.batch])
+				gevent.sleep(0)
+			if not connection.sync(options.timeout):
+				raise Exception("Timed out waiting for client to handle traffic")
+
+		start = time.time()
+		gevent.joinall([gevent.spawn(send, connection) for connection in connections], raise_error=True)
+		# let any handlers still running finish
+		gevent.idle()
+		elapsed = time.time() - start
+
+		total = options.messages * len(connections)
+		handlers = merged_latency('handler')
+		commands = merged_latency('command')
+		results = {
+			'throughput': total / elapsed,
+			'handler_p50': handlers.percentile(0.5),
+			'handler_p99': handlers.percentile(0.99),
+			'command_p50': commands.percentile(0.5),
+			'command_p99': commands.percentile(0.99),
+			'rss_idle_kib': rss_idle - rss_before,
+			'rss_peak_kib': max_rss(),
+		}
+		handled = sum(client_stats.messages_in.count for client_stats in stats.clients.values())
+		if handled < total:
+			logging.getLogger('ekimbot.bench').warning("Only {} of {} messages were counted as received".format(handled, total))
+		return results
+
+	finally:
+		cleanup(managers, server, store_path)
+
+
+def format_value(key, value):
+	if value is None:
+		return '-'
+	if key == 'throughput':
+		return '{:.0f} msgs/s'.format(value)
+	if key.endswith('_kib'):
+		return '{:.0f} KiB'.format(value)
+	return format_seconds(value)
+
+
+def compare(results, baseline, tolerance):
+	"""Returns a list of (key, value, baseline value) for results that are worse than the baseline by more than tolerance,
+	a fraction of the baseline value. Latencies are histogram bucket bounds (see ekimbot.stats),
+	so a latency regression means it went up by at least one bucket."""
+	regressions = []
+	for key, value in sorted(results.items()):
+		old = baseline.get(key)
+		if value is None or old is None:
+			continue
+		if key in HIGHER_IS_BETTER:
+			worse = value < old * (1 - tolerance)
+		else:
+			worse = value > old * (1 + tolerance)
+		if worse:
+			regressions.append((key, value, old))
+	return regressions
+
+
+def report_baseline(results, options, compare_path=None, save_path=None, tolerance=0.2):
+	"""Compares results to the baseline at compare_path and/or saves them as a baseline to save_path,
+	printing any regressions. options are what the results depend on, and are saved with them so baselines
+	recorded under different options can be warned about. Returns an exit status, non-zero if there were regressions."""
+	# round-trip options through json, so they compare equal to what was loaded
+	options = json.loads(json.dumps(options))
+	status = 0
+	if compare_path:
+		with open(compare_path) as f:
+			baseline = json.load(f)
+		if baseline['options'] != options:
+			print "Warning: baseline was recorded with different options: {}".format(baseline['options'])
+		regressions = compare(results, baseline['results'], tolerance)
+		for key, value, old in regressions:
+			print "REGRESSION {}: {} (baseline {})".format(key, format_value(key, value), format_value(key, old))
+		if regressions:
+			status = 1
+		else:
+			print "No regressions compared to baseline"
+	if save_path:
+		with open(save_path, 'w') as f:
+			json.dump({'options': options, 'results': results}, f, indent=4, sort_keys=True)
+	return status
+
+
+def options_key(options):
+	"""The options which affect results, for checking a baseline is comparable"""
+	return {key: getattr(options, key) for key in ('clients', 'channels', 'users', 'messages', 'mix', 'ignore', 'plugins', 'batch', 'seed')}
+
+
+def main_cli(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark ekimbot against a fake IRC server")
+	parser.add_argument('--clients', type=int, default=1)
+	parser.add_argument('--channels', type=int, default=5)
+	parser.add_argument('--users', type=int, default=50, help="Other users per client")
+	parser.add_argument('--messages', type=int, default=10000, help="Messages to send to each client")
+	parser.add_argument('--mix', type=parse_mix, default='chatter=70,command=10,typo=5,churn=15',
+		help="Weights of each kind of traffic, as comma-seperated KIND=WEIGHT")
+	parser.add_argument('--ignore', type=int, default=0, help="Number of (non-matching) entries in the ignore list")
+	parser.add_argument('--plugins', type=lambda value: value.split(','), default=['help', 'more', 'didyoumean'],
+		help="Comma-seperated plugins to enable on each client")
+	parser.add_argument('--batch', type=int, default=100, help="Lines to send at once")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--timeout', type=float, default=300)
+	parser.add_argument('--loglevel', default='WARNING')
+	parser.add_argument('--save', metavar='PATH', help="Save results to PATH as a baseline")
+	parser.add_argument('--compare', metavar='PATH', help="Compare results to the baseline at PATH")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="Fraction by which results may be worse than baseline")
+	options = parser.parse_args(argv)
+	if options.compare and not os.path.exists(options.compare):
+		parser.error("No baseline at {} - record one with --save first".format(options.compare))
+
+	results = run(options)
+	for key, value in sorted(results.items()):
+		print '{}: {}'.format(key, format_value(key, value))
+	return report_baseline(results, options_key(options), options.compare, options.save, options.tolerance)
+
+
+if __name__ == '__main__':
+	sys.exit(main_cli())
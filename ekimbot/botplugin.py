@@ -1,13 +1,13 @@
 
 from plugins import Plugin
-from classtricks import classproperty, dotdict
+from classtricks import classproperty
 
 from girc import Handler, Channel
 
-from ekimbot import utils
+from ekimbot import paging, utils
 from ekimbot.commands import CommandHandler
 from ekimbot.config import config
-from ekimbot.store import Store
+from ekimbot.store import BACKENDS
 
 
 class BotPlugin(Plugin):
@@ -27,6 +27,18 @@ class BotPlugin(Plugin):
 		"""Called when plugin is enabled."""
 		pass
 
+	def get_handoff_state(self):
+		"""Called when the process is about to be replaced by a handoff (eg. "process restart"),
+		before the plugin is disabled. May return any picklable value, which will be passed to
+		set_handoff_state() of the same plugin in the new process. The default returns None,
+		meaning there is no state to pass on."""
+		return None
+
+	def set_handoff_state(self, state):
+		"""Called in the new process after a handoff, after init() and before the client starts,
+		with the value returned by get_handoff_state() in the old process."""
+		pass
+
 	def get_logger(self):
 		# lazy import to break cyclic dependency
 		from ekimbot.main import main_logger
@@ -36,9 +48,17 @@ class BotPlugin(Plugin):
 	def config(self):
 		"""Returns config for this plugin, which should be a dict of the plugin's name inside the main config.
 		Uses defaults from the "defaults" attr.
-		Returned object is a dotdict.
+		Returned object is a read-only ConfigView (which allows attribute access like a dotdict),
+		and is cached until config changes.
 		"""
-		d = dotdict(self.defaults)
+		return config.cached(self._config_key, self._build_config)
+
+	@property
+	def _config_key(self):
+		return ('plugin', self.name)
+
+	def _build_config(self):
+		d = dict(self.defaults)
 		d.update(config.get(self.name, {}))
 		return d
 
@@ -47,16 +67,28 @@ class BotPlugin(Plugin):
 		"""Return actual store object.
 		We save a reference after first access to keep it alive for the lifetime of the plugin,
 		even though Store has singleton semantics."""
-		self.__store = Store(config.store_path)
+		self.__store = BACKENDS[config.store_backend](
+			config.store_path,
+			write_delay=config.store_write_delay,
+			compact_size=config.store_compact_size,
+			shared=config.store_shared,
+			poll_interval=config.store_poll_interval,
+		)
 		return self.__store
 
 	@property
 	def store(self):
-		"""Dict which will be persisted to disk when save_store() is called."""
-		return self._store.data.setdefault(self.name, {})
+		"""Dict (or dict-like mapping, depending on store backend)
+		which will be persisted to disk when save_store() is called."""
+		return self._store.namespace(*self._store_key)
+
+	@property
+	def _store_key(self):
+		return (self.name,)
 
 	def save_store(self):
-		self._store.save()
+		"""Persist the store. Depending on config, this may be written to disk later (see Store)."""
+		self._store.save(*self._store_key)
 
 
 class ClientPlugin(BotPlugin):
@@ -70,6 +102,7 @@ class ClientPlugin(BotPlugin):
 		self.client = client
 		super(ClientPlugin, self).__init__(client, *args)
 		Handler.register_all(client, self)
+		client.command_index.invalidate()
 		client.stop_handlers.add(lambda client: self.cleanup())
 
 	def get_logger(self):
@@ -79,21 +112,31 @@ class ClientPlugin(BotPlugin):
 		"""Called on disable. Should clean up any ongoing operations. The default one unregisters
 		methods that are Handlers."""
 		Handler.unregister_all(self.client, self)
+		self.client.command_index.invalidate()
 
-	def reply(self, msg, text):
-		utils.reply(self.client, msg, text)
+	def reply(self, msg, text, priority=None):
+		utils.reply(self.client, msg, text, priority)
+
+	def reply_lines(self, msg, lines, max_lines=None, target=None, notice=False, priority=None):
+		"""Reply with multiple lines of output, packed into as few lines as possible.
+		Output beyond max_lines is kept for the sender to get using the "more" command.
+		See paging.reply_lines() for details."""
+		paging.reply_lines(self.client, msg, lines, max_lines, target, notice, priority)
 
 	@property
-	def config(self):
+	def _config_key(self):
+		return ('plugin', self.name, self.client.name)
+
+	def _build_config(self):
 		"""As BotHandler but also searches for config under plugin name inside client's config"""
-		d = super(ClientPlugin, self).config
+		d = super(ClientPlugin, self)._build_config()
 		d.update(self.client.config.get(self.name, {}))
 		return d
 
 	@property
-	def store(self):
+	def _store_key(self):
 		"""As bothandler but additionally indexes by client name"""
-		return super(ClientPlugin, self).store.setdefault(self.client.name, {})
+		return (self.name, self.client.name)
 
 
 class ChannelPlugin(ClientPlugin):
@@ -112,18 +155,21 @@ class ChannelPlugin(ClientPlugin):
 		return super(ChannelPlugin, self).get_logger().getChild(self.channel.name)
 
 	@property
-	def config(self):
+	def _config_key(self):
+		return ('plugin', self.name, self.client.name, self.channel.name)
+
+	def _build_config(self):
 		"""As ClientHandler but merges top-level config with any config found under channel name,
 		eg. {"a": 1, "b": 2, "#foo": {"b": 3}} would resolve to {"a": 1", "b": 3} for #foo
 		"""
-		d = super(ChannelPlugin, self).config
+		d = super(ChannelPlugin, self)._build_config()
 		d.update(d.pop(self.channel.name, {}))
 		return d
 
 	@property
-	def store(self):
+	def _store_key(self):
 		"""As ClientHandler but additionally indexes by channel name"""
-		return super(ChannelPlugin, self).store.setdefault(self.channel.name, {})
+		return (self.name, self.client.name, self.channel.name)
 
 
 def command_plugin(*args, **kwargs):
@@ -0,0 +1,117 @@
+"""Recording raw inbound traffic to a file, see the "capture" client option and ekimbot.replay.
+
+A capture file is plain text. The first line is a header "# ekimbot capture START", where START is the
+unix time the file was started. Every other line is "DELTA LINE", where DELTA is the number of milliseconds
+since the previous line (or the start of the file) and LINE is the line as received, without line ending.
+Files are rotated like logging's RotatingFileHandler: PATH.1 is the previous file, PATH.2 the one before that, etc.
+"""
+
+import os
+import time
+
+import gevent
+import gevent.lock
+
+
+HEADER = '# ekimbot capture '
+
+
+class CaptureWriter(object):
+	"""Appends lines to a capture file at path, starting a new file once it reaches max_size bytes
+	and keeping at most backups old files. Lines are buffered in memory and written out flush_interval seconds
+	after the first unwritten line, or on close(). All file I/O, including rotation, happens in gevent's threadpool,
+	so write() never blocks."""
+
+	def __init__(self, path, max_size=64*1024*1024, backups=5, flush_interval=1):
+		self.path = path
+		self.max_size = max_size
+		self.backups = backups
+		self.flush_interval = flush_interval
+		self.file = None
+		self.pending = [] # [(time, line)] not yet written
+		self.started = time.time()
+		self._flusher = None
+		self._lock = gevent.lock.Semaphore()
+
+	def write(self, line):
+		self.pending.append((time.time(), line))
+		if self._flusher is None:
+			self._flusher = gevent.spawn_later(self.flush_interval, self.flush)
+
+	def flush(self):
+		with self._lock:
+			self._flusher = None
+			pending, self.pending = self.pending, []
+			if pending:
+				gevent.get_hub().threadpool.apply(self._write_lines, (pending,))
+
+	def close(self):
+		# any pending flush is left to run, and will find nothing to write
+		self.flush()
+		with self._lock:
+			if self.file is not None:
+				gevent.get_hub().threadpool.apply(self.file.close)
+				self.file = None
+
+	# the following are only called from the threadpool, under _lock
+
+	def _open(self, start):
+		self.file = open(self.path, 'a')
+		self.size = self.file.tell()
+		self.last = round(start, 3)
+		# always start with a header, even when appending, as we don't know when the last line was
+		self._write('{}{:.3f}\n'.format(HEADER, self.last))
+
+	def _write(self, data):
+		self.file.write(data)
+		self.size += len(data)
+
+	def _write_lines(self, lines):
+		if self.file is None:
+			self._open(self.started)
+		for timestamp, line in lines:
+			delta = max(0, int((timestamp - self.last) * 1000))
+			self._write('{} {}\n'.format(delta, line))
+			# advance by the rounded delta, so rounding errors don't add up
+			self.last += delta / 1000.
+			if self.size >= self.max_size:
+				self._rotate()
+		self.file.flush()
+
+	def _rotate(self):
+		self.file.close()
+		for n in range(self.backups - 1, 0, -1):
+			if os.path.exists('{}.{}'.format(self.path, n)):
+				os.rename('{}.{}'.format(self.path, n), '{}.{}'.format(self.path, n + 1))
+		if self.backups:
+			os.rename(self.path, '{}.1'.format(self.path))
+		else:
+			os.remove(self.path)
+		self._open(self.last)
+
+
+def capture_files(path):
+	"""Returns path and all its rotated files which exist, oldest first"""
+	paths = [path]
+	n = 1
+	while os.path.exists('{}.{}'.format(path, n)):
+		paths.insert(0, '{}.{}'.format(path, n))
+		n += 1
+	return paths
+
+
+def read(paths):
+	"""Yields (time, line) for every line in the given capture files, in order"""
+	for path in paths:
+		with open(path) as f:
+			timestamp = None
+			for line in f:
+				line = line.rstrip('\n')
+				if line.startswith(HEADER):
+					timestamp = float(line[len(HEADER):])
+					continue
+				if timestamp is None:
+					raise ValueError("{} is not a capture file".format(path))
+				delta, line = line.split(' ', 1)
+				timestamp += int(delta) / 1000.
+				yield timestamp, line
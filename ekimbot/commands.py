@@ -1,14 +1,33 @@
 
 import functools
+import time
+from collections import namedtuple
 
 from girc import Handler, Channel
 from girc.common import iterable
 import modulemanager
 
+from ekimbot.hostmask import compile_masks
+from ekimbot.outbound import PRIORITY_ADMIN
+from ekimbot.stats import stats
 from ekimbot.utils import reply
 
 
-class EkimbotHandler(Handler):
+class TimedHandler(Handler):
+	"""A girc Handler which records its calls and how long they took in stats, as ('handler', name).
+	Plugins should use this (or EkimbotHandler) instead of Handler, so that all their handlers are counted."""
+
+	def _stats_name(self, instance):
+		"""Name to record this handler's stats under"""
+		name = getattr(self.callback, '__name__', repr(self.callback))
+		return name if instance is None else '{}.{}'.format(instance.name, name)
+
+	def _handle(self, client, msg, instance=None):
+		with stats.timed('handler', self._stats_name(instance)):
+			return super(TimedHandler, self)._handle(client, msg, instance)
+
+
+class EkimbotHandler(TimedHandler):
 	"""Contains some standard matching criteria in order to implement bot-wide things
 	like master-mode and ignore lists"""
 	def __init__(self, *args, **kwargs):
@@ -18,8 +37,9 @@ class EkimbotHandler(Handler):
 				True: (default) Only when we are master
 				False: Only when we are NOT master
 				None: Either
+		Senders are checked against the client's "ignore" list of nicks or nick!user@host masks.
 		"""
-		no_ignore = kwargs.pop('no_ignore', False)
+		self.no_ignore = kwargs.pop('no_ignore', False)
 		master = kwargs.pop('master', True)
 
 		# because we check nick state under lock, we can't wait go before sync
@@ -27,39 +47,53 @@ class EkimbotHandler(Handler):
 		before = kwargs.get('before', [])
 		if not iterable(before):
 			before = [before]
-		if (
-			(master is not None or not no_ignore) and
-			(kwargs.get('sync', False) or 'sync' in before)
-		):
+		if master is not None and (kwargs.get('sync', False) or 'sync' in before):
 			raise Exception("Can't define a default EkimbotHandler for before sync due to potential deadlock")
 
 		def check_sender(client, sender):
+			start = time.time()
+			error = False
 			try:
-				if master is not None or not no_ignore:
-					current_nick = client.nick
-				if not no_ignore:
-					if any(sender.lower() == ignored_nick.lower() for ignored_nick in client.config['ignore']):
-						return False
 				if master is not None:
-					if master != client.is_master(current_nick):
+					if master != client.is_master():
 						return False
 				return True
 			except Exception:
 				# match args consider errors to be failures, so we need to report our own errors here
 				client.logger.exception("Error in EkimbotHandler check_sender")
+				error = True
 				return False
+			finally:
+				# looked up each time, as stats.reset() replaces all timers
+				stats.timer('internal', 'check_sender').observe(time.time() - start, error)
 
 		kwargs.update(
 			sender=check_sender
 		)
 		super(EkimbotHandler, self).__init__(*args, **kwargs)
 
+	def _is_ignored(self, client, msg):
+		"""Returns whether msg should be ignored as its sender matches the client's ignore list.
+		This needs the full nick!user@host so it's checked at handle time rather than as a match arg."""
+		if self.no_ignore:
+			return False
+		return compile_masks(client.config['ignore']).match(msg.sender, msg.user, msg.host)
+
+	def _handle(self, client, msg, instance=None):
+		if self._is_ignored(client, msg):
+			return
+		return super(EkimbotHandler, self)._handle(client, msg, instance)
+
 
 class CommandHandler(EkimbotHandler):
 	"""A special case of Handler designed to handle and respond to PRIVMSGs that have a command-like structure.
 	A command handler matches if all the following are true:
 		* msg is a PRIVMSG beginning with the configured command prefix.
 		* After being split on whitespace, the leading words match the values in the "name" arg, case-insensitive.
+		* No other command with a longer name also matches (see CommandIndex).
+	If the client's "allow" option has an entry for the command name (eg. "process restart") or, failing that,
+	for the name of the plugin the handler belongs to, the sender must match one of the masks in that entry.
+	Replies to such restricted commands are sent with admin priority.
 	It is checked that there are at least nargs further words. If there isn't, an error message is replied.
 	(msg, *args) is passed to the callback, where args is the words after the leading words that match "name".
 
@@ -87,22 +121,9 @@ class CommandHandler(EkimbotHandler):
 		)
 		super(CommandHandler, self).__init__(*args, **kwargs)
 
-	def _get_args(self, client, payload):
-		current_nick = client.nick
-		prefixes = ['{}: '.format(current_nick)]
-		if client.is_master(current_nick):
-			prefixes.append(client.config['command_prefix'])
-		for prefix in prefixes:
-			if not payload.startswith(prefix):
-				continue
-			payload = payload[len(prefix):]
-			payload = payload.split()
-			if [word.lower() for word in payload[:len(self.name)]] != self.name:
-				continue
-			return payload[len(self.name):]
-
 	def _match_payload(self, client, payload):
-		return self._get_args(client, payload) is not None
+		match = client.command_index.match(payload)
+		return match is not None and self in match.handlers
 
 	@property
 	def help(self):
@@ -118,9 +139,37 @@ class CommandHandler(EkimbotHandler):
 		summary = helpstr.strip().split('\n')[0]
 		return summary, '\n'.join(line.strip() for line in helpstr.split('\n'))
 
+	def _allowed_masks(self, client, instance=None):
+		"""Returns the allow list for this command, or None if it isn't restricted"""
+		allow = client.config.get('allow', {})
+		masks = allow.get(' '.join(self.name))
+		if masks is None and instance is not None:
+			masks = allow.get(instance.name)
+		return masks
+
 	def _handle(self, client, msg, instance=None):
+		# checked before timing, so ignored messages aren't counted as uses of the command
+		if self._is_ignored(client, msg):
+			return
+		with stats.timed('command', ' '.join(self.name)):
+			return self._handle_command(client, msg, instance)
+
+	def _handle_command(self, client, msg, instance=None):
 		msg.extra['command_matched'] = True # this tells did_you_mean that a command matched
-		args = self._get_args(client, msg.payload)
+		match = msg.extra.get('command_match')
+		if match is None:
+			match = msg.extra['command_match'] = client.command_index.match(msg.payload)
+		if match is None or self not in match.handlers:
+			return # our nick or master state changed since matching
+		masks = self._allowed_masks(client, instance)
+		if masks is not None:
+			if not compile_masks(masks).match(msg.sender, msg.user, msg.host):
+				client.logger.info("Denied {} use of command {!r}".format(msg.sender, ' '.join(self.name)))
+				reply(client, msg, "You are not allowed to use command {!r}".format(' '.join(self.name)))
+				return
+			# restricted commands are administrative, so their replies shouldn't wait behind normal output
+			msg.extra['reply_priority'] = PRIORITY_ADMIN
+		args = match.args
 		if len(args) < self.nargs:
 			reply(client, msg, "Command {!r} requires at least {} args".format(' '.join(self.name), self.nargs))
 			return
@@ -149,3 +198,132 @@ class ChannelCommandHandler(CommandHandler):
 				return
 			return callback(instance, msg, *args)
 		self.callback = wrapper
+
+
+CommandMatch = namedtuple('CommandMatch', ['handlers', 'name', 'args'])
+
+
+class _CommandNode(object):
+	"""A node in a CommandIndex trie. Children are keyed by lowercased command word,
+	handlers is the set of CommandHandlers whose name ends at this node,
+	and commands is a list of all CommandHandlers at or below this node, sorted by name."""
+	def __init__(self):
+		self.children = {}
+		self.handlers = set()
+		self.commands = []
+
+	def _sort_commands(self):
+		self.commands = list(self.handlers)
+		for child in self.children.values():
+			child._sort_commands()
+			self.commands += child.commands
+		self.commands.sort(key=lambda handler: handler.name)
+
+
+class CommandIndex(object):
+	"""Per-client index of registered CommandHandlers, so that a PRIVMSG is tokenized once
+	and resolved to a command without every handler re-parsing the payload.
+	The index is a trie of command words built from client.message_handlers. It is rebuilt
+	lazily after invalidate() is called, which ClientPlugin does whenever it is enabled or disabled.
+	It also serves as a registry of commands for things like help, with sorted command lists
+	and pre-parsed help text. generation increases every time the set of commands may have changed,
+	so users can cache their own derived data.
+	"""
+
+	def __init__(self, client):
+		self.client = client
+		self.generation = 0
+		self._root = None
+		self._help = {}
+		self._last = None # (key, result) of most recent match
+
+	def invalidate(self):
+		"""Discard the index, causing it to be rebuilt on next use.
+		Call this after registering or unregistering CommandHandlers."""
+		self.generation += 1
+		self._root = None
+		self._help = {}
+		self._last = None
+
+	@property
+	def root(self):
+		if self._root is None:
+			self._root = self._build()
+		return self._root
+
+	def _build(self):
+		root = _CommandNode()
+		for handler in self.client.message_handlers:
+			if not isinstance(handler, CommandHandler):
+				continue
+			node = root
+			for word in handler.name:
+				node = node.children.setdefault(word, _CommandNode())
+			node.handlers.add(handler)
+		root._sort_commands()
+		self._help = {handler: handler.help for handler in root.commands}
+		return root
+
+	@property
+	def commands(self):
+		"""All registered CommandHandlers, sorted by name"""
+		return self.root.commands
+
+	def node(self, words):
+		"""Returns the trie node for the given command group or command name (a list of words),
+		or None if no command starts with those words."""
+		node = self.root
+		for word in words:
+			node = node.children.get(word.lower())
+			if node is None:
+				return None
+		return node
+
+	def commands_with_prefix(self, words):
+		"""Returns all CommandHandlers whose name starts with the given words, sorted by name"""
+		node = self.node(words)
+		return [] if node is None else node.commands
+
+	def help(self, handler):
+		"""Returns handler.help, pre-parsed when the index was built"""
+		self.root # ensure built
+		if handler not in self._help:
+			self._help[handler] = handler.help
+		return self._help[handler]
+
+	def match(self, payload):
+		"""Resolve a PRIVMSG payload to a CommandMatch(handlers, name, args), or None if it isn't a command.
+		The longest command name that matches wins, so at most one command is resolved per message
+		(handlers may contain more than one handler if several were registered with the same name).
+		Since every CommandHandler asks about the same payload in turn, the most recent result is cached.
+		"""
+		current_nick = self.client.nick
+		master = self.client.is_master(current_nick)
+		command_prefix = self.client.config['command_prefix']
+		key = payload, current_nick, master, command_prefix
+		if self._last is not None and self._last[0] == key:
+			return self._last[1]
+		result = self._match(payload, current_nick, master, command_prefix)
+		self._last = key, result
+		return result
+
+	def _match(self, payload, current_nick, master, command_prefix):
+		prefixes = ['{}: '.format(current_nick)]
+		if master:
+			prefixes.append(command_prefix)
+		for prefix in prefixes:
+			if not payload.startswith(prefix):
+				continue
+			words = payload[len(prefix):].split()
+			node = self.root
+			found = None
+			for depth, word in enumerate(words):
+				node = node.children.get(word.lower())
+				if node is None:
+					break
+				if node.handlers:
+					found = node, depth + 1
+			if found:
+				node, depth = found
+				return CommandMatch(frozenset(node.handlers), words[:depth], words[depth:])
+		return None
@@ -9,20 +9,93 @@ import random
 
 from pyconfig import Config
 
-from ekimbot import core_plugins
-from ekimbot.utils import list_modules
 
+# Core plugin path. We avoid importing core_plugins here, as plugins are only imported when needed.
+core_plugins_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'core_plugins')
 
-# Core plugin auto-detect
-core_plugins_path = os.path.dirname(core_plugins.__file__)
-core_plugins_list = list_modules(core_plugins_path)
+
+def freeze(value):
+	"""Returns a read-only version of a config value: dicts become ConfigViews, lists become tuples"""
+	if isinstance(value, ConfigView):
+		return value
+	if isinstance(value, dict):
+		return ConfigView(value)
+	if isinstance(value, (list, tuple)):
+		return tuple(freeze(item) for item in value)
+	if isinstance(value, set):
+		return frozenset(value)
+	return value
+
+
+class ConfigView(dict):
+	"""A read-only dict of config values, which also allows attribute access like a dotdict.
+	Nested values are frozen as per freeze(), so views can be safely cached and shared.
+	Use copy() to get a mutable (shallow) copy.
+	"""
+	def __init__(self, *args, **kwargs):
+		super(ConfigView, self).__init__()
+		for key, value in dict(*args, **kwargs).items():
+			dict.__setitem__(self, key, freeze(value))
+
+	def __getattr__(self, attr):
+		try:
+			return self[attr]
+		except KeyError:
+			raise AttributeError(attr)
+
+	def __reduce__(self):
+		return ConfigView, (dict(self),)
+
+	def _read_only(self, *args, **kwargs):
+		raise TypeError("Config views are read-only")
+
+	__setitem__ = __delitem__ = __setattr__ = __delattr__ = _read_only
+	clear = pop = popitem = setdefault = update = _read_only
 
 
 class BotConfig(Config):
-	# Contains some special derived properties
+	"""Contains some special derived properties.
+	Merged config (eg. per-client or per-plugin) is cached as ConfigViews, which are discarded
+	whenever config is loaded or changed. A counter, generation, is incremented on each change.
+	"""
+
+	generation = 0
+	_views = None
+
+	def load(self, *args, **kwargs):
+		super(BotConfig, self).load(*args, **kwargs)
+		self.changed()
+
+	def register(self, *args, **kwargs):
+		super(BotConfig, self).register(*args, **kwargs)
+		self.changed()
+
+	def __setattr__(self, attr, value):
+		super(BotConfig, self).__setattr__(attr, value)
+		if not attr.startswith('_'):
+			self.changed()
+
+	def changed(self):
+		"""Discard cached views. This is done automatically when setting or loading options,
+		but must be called manually after modifying a config value in place."""
+		object.__setattr__(self, 'generation', self.generation + 1)
+		object.__setattr__(self, '_views', {})
+
+	def cached(self, key, build):
+		"""Returns a ConfigView of the dict returned by build(), which is only called again
+		once config has changed. key must uniquely identify what build() returns."""
+		if self._views is None:
+			self.changed()
+		views = self._views
+		if key not in views:
+			views[key] = ConfigView(build())
+		return views[key]
 
 	@property
 	def clients_with_defaults(self):
+		return self.cached('clients_with_defaults', self._clients_with_defaults)
+
+	def _clients_with_defaults(self):
 		result = {}
 		for name, client in self.clients.items():
 			d = self.client_defaults.copy()
@@ -41,6 +114,9 @@ config = BotConfig()
 config.register('loglevel', long_opts=['log'], default='INFO')
 # log file - file to log to, or None to disable (default).
 config.register('logfile', default=None)
+# log_queue_size - If set, logs are written from a background thread instead of when they are logged,
+# with at most this many waiting to be written (further logs are dropped). See ekimbot.logqueue.
+config.register('log_queue_size', default=None)
 
 # --- Plugins ---
 # These options contain default values that should not be overwritten.
@@ -49,25 +125,101 @@ config.register('logfile', default=None)
 config.register('plugin_paths', default=[core_plugins_path])
 # global_plugins - list of global plugins to enable
 config.register('global_plugins', default=[])
+# plugin_manifest_path - file to cache which plugins each module in plugin_paths defines,
+# so that modules are only imported when one of their plugins is enabled. Set to None to not cache.
+config.register('plugin_manifest_path', default="/tmp/ekimbot-plugins-{}.json".format(os.getuid()))
+# profile_startup - if set, log how long each phase of startup took, and how long each plugin module took to import
+config.register('profile_startup', long_opts=['profile-startup'], default=False)
 
 # --- Persistence ---
-# store_path - JSON file to store persistent data - defaults to a random file in /tmp
+# store_backend - How to store persistent data. One of:
+#   json: (default) Keep all data in memory and save it to a JSON file.
+#   sqlite: Keep data in an sqlite database, loading only what is used. Better for large stores.
+#           Use "python -m ekimbot.store JSON_PATH SQLITE_PATH" to migrate an existing JSON store.
+config.register('store_backend', default='json')
+# store_path - file to store persistent data - defaults to a random file in /tmp
 config.register('store_path',
                 default="/tmp/ekimbot-{}.json".format(''.join(random.choice(string.letters + string.digits) for x in range(8))))
+# store_write_delay - json backend only. If set, the store is write-behind: saves are batched up and written to a journal
+# at most once per this many seconds, instead of rewriting the whole file on every save.
+config.register('store_write_delay', default=None)
+# store_compact_size - In write-behind mode, the size in bytes the journal may grow to
+# before it is compacted into the main store file.
+config.register('store_compact_size', default=1024 * 1024)
+# store_shared - json backend only. Set this if multiple processes use the same store_path,
+# eg. for redundancy with the slave plugin. Each process then only overwrites the parts of the store
+# it has changed, and picks up changes made by other processes.
+config.register('store_shared', default=False)
+# store_poll_interval - When store_shared is set, how often in seconds to check for changes by other processes.
+config.register('store_poll_interval', default=1)
+
+# --- Processes ---
+# workers - If set, run clients in this many worker processes instead of all in one process,
+# or "auto" for one per CPU. Clients are split evenly between workers, and global plugins run in the first.
+# Workers are started and restarted as needed by a supervisor process, see ekimbot.supervisor.
+# All workers use the same store, with store_shared implied for the json backend.
+config.register('workers', default=None)
+
+# --- Connections ---
+# connect_concurrency - At most this many clients may be connecting to the same network at once,
+# so that reconnecting after an outage doesn't get us throttled. See ekimbot.connect.
+config.register('connect_concurrency', default=2)
+
+# --- Internal ---
+# handoff_fd - Set in the environment by a process re-exec()ing itself, see ekimbot.handoff
+config.register('handoff_fd', default=None)
+# worker_index, worker_count, control_fd - Set in the environment of worker processes, see ekimbot.supervisor
+config.register('worker_index', default=None)
+config.register('worker_count', default=None)
+config.register('control_fd', default=None)
 
 # --- Per-client options ---
 # clients - Should be a dict {name: dict containing client options}.
 # Each client should take hostname, optionally nick, port, password, ident, real_name, plugins, channels
 # Most of those should be obvious, plugins is what plugins to enable on startup
+# channels may be given as "#name" or "#name key" for channels which need a key.
 config.register('clients', default={})
 # client_defaults - As per client option dicts, but provides defaults for option dicts in clients option.
 # Note that the default value of client_defaults already defines some defaults - you probably want to
 # update the existing value instead of overwriting it.
+# ignore is a list of nicks or nick!user@host masks (wildcards * and ? allowed) to ignore.
+# allow maps command names (eg. "process restart") or plugin names (eg. "processops") to a list of masks,
+# as per ignore. Only matching senders may use that command or any command in that plugin.
+# An entry for a command takes precedence over an entry for its plugin.
+# flood configures pacing of messages sent by plugins, as kwargs for ekimbot.outbound.OutboundScheduler:
+# lines_per_second and line_burst, bytes_per_second and byte_burst (any of which may be None for no limit),
+# and max_queue, the number of messages that may be queued per target before more are dropped.
+# paging configures multi-line replies (see ekimbot.paging): max_lines to send per command by default,
+# line_length to override the automatically determined max length of a line, and buffer_size and expiry
+# for how many senders' remaining output to keep for the "more" command, and for how many seconds.
+# network is a name for the network the client connects to, for limiting concurrent connection attempts
+# as per connect_concurrency. Defaults to the client's hostname. weight determines which clients connect first,
+# highest first, when more are waiting to connect than are allowed at once.
+# capture, if set, records all inbound traffic for replaying later with ekimbot.replay. It should be a dict with path
+# (which may contain "{name}" for the client name), and optionally max_size in bytes before the file is rotated
+# and backups, the number of rotated files to keep. See ekimbot.capture.
 config.register('client_defaults', default={
 	'nick': 'ekimbot',
 	'command_prefix': 'ekimbot: ',
-	'plugins': ['help'],
+	'plugins': ['help', 'more'],
 	'ignore': [],
+	'allow': {},
+	'flood': {
+		'lines_per_second': 1,
+		'line_burst': 5,
+		'bytes_per_second': 512,
+		'byte_burst': 2048,
+		'max_queue': 100,
+	},
+	'paging': {
+		'max_lines': 3,
+		'line_length': None,
+		'buffer_size': 100,
+		'expiry': 600,
+	},
+	'capture': None,
+	'network': None,
+	'weight': 1,
 })
 
 
@@ -0,0 +1,116 @@
+"""Scheduling of client connection attempts, so that many clients (re)connecting at once don't
+all hit the same server in the same second and get throttled.
+
+At most config.connect_concurrency clients may be connecting to each network at once, where a client's
+network is its "network" option, or its hostname if not set. Clients waiting to connect go in order of
+their "weight" option, highest first. Clients wait between attempts using JitterBackoff.
+
+The scheduler also tracks how long it takes for all clients to be connected, after startup or after any
+client loses its connection, and records it in stats as ('connect', '(all)').
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+import gevent.event
+
+from ekimbot.config import config
+from ekimbot.stats import stats
+
+
+class JitterBackoff(object):
+	"""Backoff with "decorrelated jitter": each delay is random between start and 3 times the previous delay,
+	capped at limit. This spreads out clients that started backing off at the same time.
+	Has the same interface as backoff.Backoff."""
+
+	def __init__(self, start, limit):
+		self.start = start
+		self.limit = limit
+		self.reset()
+
+	def reset(self):
+		self.last = self.start
+		self._next = self._choose()
+
+	def _choose(self):
+		return min(self.limit, random.uniform(self.start, self.last * 3))
+
+	def peek(self):
+		return self._next
+
+	def get(self):
+		self.last = value = self._next
+		self._next = self._choose()
+		return value
+
+
+class ConnectScheduler(object):
+
+	def __init__(self):
+		self.active = {} # {network: number of clients connecting}
+		self.waiting = {} # {network: heap of (-weight, seq, event)}
+		self._seq = itertools.count()
+		self.disconnected = set() # names of clients that aren't connected
+		self.outage_start = None # when disconnected last became non-empty
+		self.logger = logging.getLogger('ekimbot.connect')
+
+	@contextmanager
+	def slot(self, network, weight=1):
+		"""Context manager that waits until this client may connect to network, and holds its place until exited"""
+		if self.active.get(network, 0) >= config.connect_concurrency:
+			event = gevent.event.Event()
+			entry = -weight, next(self._seq), event
+			heapq.heappush(self.waiting.setdefault(network, []), entry)
+			try:
+				event.wait()
+			except BaseException:
+				if event.is_set():
+					# we were given the slot, but we won't be using it
+					self._release(network)
+				else:
+					self.waiting[network].remove(entry)
+					heapq.heapify(self.waiting[network])
+				raise
+			# the releasing client handed its slot directly to us, so active is already counted
+		else:
+			self.active[network] = self.active.get(network, 0) + 1
+		try:
+			yield
+		finally:
+			self._release(network)
+
+	def _release(self, network):
+		waiting = self.waiting.get(network)
+		if waiting:
+			_, _, event = heapq.heappop(waiting)
+			event.set()
+			return
+		self.active[network] -= 1
+		if not self.active[network]:
+			del self.active[network]
+			self.waiting.pop(network, None)
+
+	def mark_disconnected(self, name):
+		if not self.disconnected:
+			self.outage_start = time.time()
+		self.disconnected.add(name)
+
+	def mark_connected(self, name):
+		if name not in self.disconnected:
+			return
+		self.disconnected.remove(name)
+		if not self.disconnected:
+			duration = time.time() - self.outage_start
+			stats.timer('connect', '(all)').observe(duration)
+			self.logger.info("All clients connected after {:.3f}s".format(duration))
+
+	def forget(self, name):
+		"""Stop tracking a client, eg. because it's shutting down"""
+		self.disconnected.discard(name)
+
+
+scheduler = ConnectScheduler()
@@ -1,6 +1,8 @@
 
 from ekimbot.botplugin import BotPlugin
 from ekimbot.main import clients
+from ekimbot.profiler import profiler
+from ekimbot.stats import stats
 
 from gevent.backdoor import BackdoorServer
 
@@ -14,6 +16,8 @@ class BackdoorPlugin(BotPlugin):
 	def init(self):
 		self.server = BackdoorServer(('localhost', self.config.port), locals={
 			'clients': clients,
+			'stats': stats,
+			'profiler': profiler,
 		})
 		self.server.start()
 
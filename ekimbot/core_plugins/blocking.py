@@ -0,0 +1,104 @@
+
+import sys
+import time
+import traceback
+from collections import deque
+
+import gevent
+import greenlet
+from gevent.monkey import get_original
+
+from ekimbot.botplugin import BotPlugin
+from ekimbot.frames import frame_owner, describe_owner
+from ekimbot.stats import stats
+
+
+start_new_thread, allocate_lock, get_ident = get_original('thread', ['start_new_thread', 'allocate_lock', 'get_ident'])
+real_sleep = get_original('time', 'sleep')
+
+
+class BlockingMonitorPlugin(BotPlugin):
+	"""Detects when the gevent hub hasn't switched greenlets for more than threshold seconds.
+	This means some code is blocking (eg. doing synchronous disk or network I/O) and holding up
+	every client in the process.
+	A native thread watches a count of greenlet switches, and when it stops changing while a greenlet other
+	than the hub is running, captures that greenlet's stack. Once the hub is running again, the stall is
+	logged along with the plugin and method responsible (see ekimbot.frames), and recorded in stats as
+	('hub_stall', plugin name). Stalls of at least alert_threshold seconds are logged as warnings
+	(and so will be emailed if logalert is enabled), others at info level.
+	Enable as a global plugin.
+	"""
+	name = 'blocking'
+	defaults = {
+		'threshold': 0.1,
+		'alert_threshold': 1,
+		'stack_limit': 20,
+	}
+
+	def init(self):
+		self.hub = gevent.get_hub()
+		self.main_thread = get_ident()
+		self.switches = 0
+		self.current = None # greenlet last switched to
+		self.stalls = deque() # (duration, owner, stack) waiting to be reported
+		self.stopping = False
+		self.stopped = allocate_lock() # released by the monitor thread when it exits
+		self.stopped.acquire()
+		self.threshold = self.config.threshold
+		self.stack_limit = self.config.stack_limit
+		self.reporter = self.hub.loop.async_()
+		self.reporter.start(lambda: gevent.spawn(self.report))
+		self.previous_trace = greenlet.settrace(self.trace)
+		start_new_thread(self.monitor, ())
+
+	def cleanup(self):
+		self.stopping = True
+		self.stopped.acquire() # this won't be long, the monitor thread checks every threshold / 2 seconds
+		greenlet.settrace(self.previous_trace)
+		self.reporter.stop()
+		self.reporter.close()
+		super(BlockingMonitorPlugin, self).cleanup()
+
+	def trace(self, event, args):
+		if event in ('switch', 'throw'):
+			origin, target = args
+			self.switches += 1
+			self.current = target
+		if self.previous_trace is not None:
+			self.previous_trace(event, args)
+
+	def monitor(self):
+		"""Runs in a native thread. Must not touch anything that might use gevent."""
+		try:
+			self._monitor()
+		finally:
+			self.stopped.release()
+
+	def _monitor(self):
+		last_switches = self.switches
+		last_switch_at = time.time()
+		stall = None # (owner, stack) of current stall
+		while not self.stopping:
+			real_sleep(self.threshold / 2.)
+			now = time.time()
+			if self.switches != last_switches:
+				if stall is not None:
+					owner, stack = stall
+					self.stalls.append((now - last_switch_at, owner, stack))
+					self.reporter.send()
+					stall = None
+				last_switches = self.switches
+				last_switch_at = now
+			elif stall is None and now - last_switch_at >= self.threshold and self.current not in (None, self.hub):
+				frame = sys._current_frames().get(self.main_thread)
+				stall = frame_owner(frame), traceback.extract_stack(frame, self.stack_limit)
+				del frame
+
+	def report(self):
+		while self.stalls:
+			duration, owner, stack = self.stalls.popleft()
+			stats.timer('hub_stall', owner[0] if owner else 'unknown').observe(duration)
+			level = 'warning' if duration >= self.config.alert_threshold else 'info'
+			getattr(self.logger, level)("Hub blocked for {:.3f}s by {}, at:\n{}".format(
+				duration, describe_owner(owner), ''.join(traceback.format_list(stack)),
+			))
@@ -1,10 +1,68 @@
 
 from ekimbot.botplugin import ClientPlugin
-from ekimbot.commands import EkimbotHandler, CommandHandler
+from ekimbot.commands import EkimbotHandler
+
+
+def edit_distance(a, b):
+	"""Returns the levenshtein distance between a and b, ie. the number of single-character
+	insertions, deletions or substitutions needed to turn a into b."""
+	# we only keep the last row of the full table
+	row = range(len(b) + 1)
+	for i in range(1, len(a) + 1):
+		prev_row, row = row, [i] + [0] * len(b)
+		for j in range(1, len(b) + 1):
+			cost = 0 if a[i-1] == b[j-1] else 1
+			row[j] = min(row[j-1] + 1, prev_row[j] + 1, prev_row[j-1] + cost)
+	return row[-1]
+
+
+class BKTree(object):
+	"""A metric tree over a set of words, which finds all words within some edit distance of a query
+	without comparing against every word. Each node is (word, {distance: child node}),
+	where every word under a child is exactly that distance from the node's word."""
+
+	def __init__(self, words):
+		self.root = None
+		for word in words:
+			self.add(word)
+
+	def add(self, word):
+		if self.root is None:
+			self.root = word, {}
+			return
+		node_word, children = self.root
+		while True:
+			distance = edit_distance(word, node_word)
+			if distance == 0:
+				return # already present
+			if distance not in children:
+				children[distance] = word, {}
+				return
+			node_word, children = children[distance]
+
+	def search(self, word, max_distance):
+		"""Returns a list of all words within max_distance of word"""
+		results = []
+		nodes = [self.root] if self.root is not None else []
+		while nodes:
+			node_word, children = nodes.pop()
+			distance = edit_distance(word, node_word)
+			if distance <= max_distance:
+				results.append(node_word)
+			# by the triangle inequality, only these children can contain matches
+			for child_distance in range(distance - max_distance, distance + max_distance + 1):
+				if child_distance in children:
+					nodes.append(children[child_distance])
+		return results
 
 
 class DidYouMeanPlugin(ClientPlugin):
 	name = 'didyoumean'
+	defaults = {
+		'max_distance': 2, # max edit distance for suggestions. Words of 3 letters or less always use 1.
+	}
+
+	_trees_generation = None
 
 	@EkimbotHandler(
 		command='PRIVMSG',
@@ -27,30 +85,30 @@ class DidYouMeanPlugin(ClientPlugin):
 
 		command = msg.payload[len(client.config['command_prefix']):]
 		words = command.split()
-		names = [h.name for h in client.message_handlers if isinstance(h, CommandHandler)]
+		index = client.command_index
 		help_enabled = ClientPlugin.get_plugin('help', client)
 
 		if not command or command.startswith(' '):
 			# special case - no command given. we want to ignore this to prevent accidental usage.
 			return
 
+		# walk down the command trie as far as the words allow
+		node = index.root
 		longest_word_prefix = []
-		for name in names:
-			common_prefix = []
-			for got, want in zip(words, name):
-				if got != want:
-					break
-				common_prefix.append(want)
-			if len(longest_word_prefix) < len(common_prefix):
-				longest_word_prefix = common_prefix
+		for word in words:
+			child = node.children.get(word.lower())
+			if child is None:
+				break
+			node = child
+			longest_word_prefix.append(word.lower())
 
 		if longest_word_prefix:
-			if longest_word_prefix == words:
+			if len(longest_word_prefix) == len(words):
 				# special case: words is an exact prefix of some command group
 				self.reply(msg, "{words!r} is a command group, please specify a subcommand{help}".format(
 					words=' '.join(words),
 					help=(
-						' or try {command_prefix}help {prefix}' if help else ''
+						' or try {command_prefix}help {prefix}' if help_enabled else ''
 					).format(
 						command_prefix=self.client.config['command_prefix'],
 						prefix=' '.join(words),
@@ -58,17 +116,14 @@ class DidYouMeanPlugin(ClientPlugin):
 				))
 				return
 			n = len(longest_word_prefix)
-			match = self.find_close(
-				words[n],
-				set(name[n] for name in names if name[:n] == longest_word_prefix),
-			)
+			match = self.find_close(words[n], node)
 			if match:
 				self.reply_with(msg, words[n], match, prefix=longest_word_prefix)
 			else:
 				self.reply_with(msg, words[n], prefix=longest_word_prefix, help=help_enabled)
 			return
 
-		match = self.find_close(words[0], set(name[0] for name in names))
+		match = self.find_close(words[0], index.root)
 		if match:
 			self.reply_with(msg, words[0], match)
 		else:
@@ -91,7 +146,24 @@ class DidYouMeanPlugin(ClientPlugin):
 		)
 		self.reply(msg, reply)
 
-	def find_close(self, got, corpus):
-		"""Returns a string from corpus if it is within some edit distance of got,
+	def find_close(self, got, node):
+		"""Returns a command word under the given command index node if it is within some edit distance of got,
 		and nothing else is. Otherwise returns None."""
-		pass # TODO later
+		got = got.lower()
+		max_distance = 1 if len(got) <= 3 else self.config.max_distance
+		matches = self.get_tree(node).search(got, max_distance)
+		if len(matches) == 1:
+			match, = matches
+			return match
+		return None
+
+	def get_tree(self, node):
+		"""Returns a BKTree of the words under a command index node.
+		Trees are cached until the set of commands changes."""
+		index = self.client.command_index
+		if self._trees_generation != index.generation:
+			self._trees = {}
+			self._trees_generation = index.generation
+		if node not in self._trees:
+			self._trees[node] = BKTree(node.children)
+		return self._trees[node]
@@ -1,26 +1,12 @@
 
-from girc.message import Notice
-
 from ekimbot.botplugin import ClientPlugin
 from ekimbot.commands import CommandHandler
-
-
-def startswith(a, b):
-	"""Returns whether items of iterable a are equal to iterable b for all of iterable b's length.
-	ie. it's str.startswith(), but for iterables. b must be finite."""
-	a = iter(a)
-	for item in b:
-		try:
-			if item != a.next():
-				return False # elements don't match
-		except StopIteration:
-			return False # a shorter than b
-	return True
+from ekimbot.outbound import PRIORITY_BULK
 
 
 class HelpPlugin(ClientPlugin):
 	name = 'help'
-	defaults = {'max_lines': 3}
+	defaults = {'max_lines': 3, 'long_max_lines': 10}
 
 	@CommandHandler("help", 0)
 	def help_command(self, msg, *target):
@@ -32,42 +18,40 @@ class HelpPlugin(ClientPlugin):
 
 	def help(self, msg, long, *target):
 		target = [part.lower() for part in target]
-		commands = [handler for handler in self.client.message_handlers if isinstance(handler, CommandHandler)]
-		commands = [command for command in commands if startswith(command.name, target)]
-		commands.sort(key=lambda command: command.name)
+		index = self.client.command_index
+		commands = index.commands_with_prefix(target)
 
 		if long:
-			reply = lambda s: Notice(self.client, msg.sender, s).send()
+			reply = lambda lines: self.reply_lines(
+				msg, lines, self.config.long_max_lines, target=msg.sender, notice=True, priority=PRIORITY_BULK,
+			)
 		else:
-			reply = lambda s: self.reply(msg, s)
+			reply = lambda lines: self.reply_lines(msg, lines, self.config.max_lines)
 
 		if target and len(commands) == 0:
-			reply("No commands matching {!r} found".format(' '.join(target)))
+			reply(["No commands matching {!r} found".format(' '.join(target))])
 			return
 
 		if target and len(commands) == 1:
 			command, = commands
-			summary, description = command.help
+			summary, description = index.help(command)
 			if not description:
-				reply("Command {!r} has no help available".format(' '.join(command.name)))
-				return
-			lines = [line.strip() for line in description.strip().split('\n') if line.strip()]
-			if len(lines) > self.config.max_lines and not long:
-				reply(summary)
-				reply("Full description too long. Use longhelp for full description via PM")
+				reply(["Command {!r} has no help available".format(' '.join(command.name))])
 				return
-			for line in lines:
-				reply(line)
+			reply([line.strip() for line in description.strip().split('\n') if line.strip()])
 			return
 
 		if len(commands) > self.config.max_lines and not long:
-			commands = ', '.join(' '.join(command.name) for command in commands)
-			reply("Commands: {}".format(commands))
-			reply("Use longhelp for full descriptions via PM")
+			reply([
+				"Commands: {}".format(', '.join(' '.join(command.name) for command in commands)),
+				"Use longhelp for full descriptions via PM",
+			])
 			return
 
+		lines = []
 		for command in commands:
-			summary, description = command.help
+			summary, description = index.help(command)
 			if not summary:
 				summary = "(no help available)"
-			reply("{} - {}".format(' '.join(command.name), summary))
+			lines.append("{} - {}".format(' '.join(command.name), summary))
+		reply(lines)
@@ -3,70 +3,198 @@ import logging
 import os
 import smtplib
 import socket
+import time
+from collections import OrderedDict
 from email.MIMEText import MIMEText
 
 import gevent
+import gevent.event
 
 from ekimbot.botplugin import BotPlugin
 from ekimbot.config import config
 
 
-def send(target, subject, text):
-	args = config.logalert
-
-	msg = MIMEText(text)
-	msg['From'] = args['smtp_user']
-	msg['To'] = target
-	msg['Subject'] = subject
+class Mailer(object):
+	"""Sends mail as per the logalert config, keeping the SMTP connection open between sends.
+	Config keys:
+		smtp_server: list of args for smtplib.SMTP, eg. ["smtp.example.com", 587]
+		smtp_user: address to send from, and user to log in as
+		smtp_password: password to log in with. If not given, we don't log in.
+		starttls: whether to use STARTTLS, default true.
+	For testing, you can run a local SMTP server which prints mail instead of sending it with:
+		python -m smtpd -n -c DebuggingServer localhost:1025
+	and use {"smtp_server": ["localhost", 1025], "starttls": false}.
+	"""
+
+	server = None
+
+	def __init__(self, args):
+		self.args = args
+
+	def connect(self):
+		self.close()
+		server = smtplib.SMTP(*self.args['smtp_server'])
+		server.ehlo() # Send greeting
+		if self.args.get('starttls', True):
+			server.starttls() # Switch to SSL
+			server.ehlo() # Send greeting again now that we're on SSL
+		if self.args.get('smtp_password'):
+			server.login(self.args['smtp_user'], self.args['smtp_password'])
+		self.server = server
+
+	def send(self, target, subject, text):
+		msg = MIMEText(text)
+		msg['From'] = self.args['smtp_user']
+		msg['To'] = target
+		msg['Subject'] = subject
+		if self.server is not None:
+			try:
+				self.server.sendmail(self.args['smtp_user'], target, msg.as_string())
+				return
+			except smtplib.SMTPServerDisconnected:
+				pass # our idle connection was closed by the server, try again with a new one
+		self.connect()
+		self.server.sendmail(self.args['smtp_user'], target, msg.as_string())
 
-	server = smtplib.SMTP(*args['smtp_server'])
-	server.ehlo() # Send greeting
-	server.starttls() # Switch to SSL
-	server.ehlo() # Send greeting again now that we're on SSL
-	server.login(args['smtp_user'], args['smtp_password'])
-	server.sendmail(args['smtp_user'], target, msg.as_string())
-	server.close()
+	def close(self):
+		if self.server is None:
+			return
+		try:
+			self.server.quit()
+		except (smtplib.SMTPException, socket.error):
+			pass
+		self.server = None
 
 
 class EmailHandler(logging.Handler):
+	"""Emails log records. Records are queued and sent from a background greenlet,
+	so logging never waits on the mail server.
+	Records are collected for batch_window seconds after the first one, then sent together as one email.
+	Records with the same logger and message template (ie. before formatting with args) are only
+	included once, with a count. At most LIMIT emails are sent per LIMIT_INTERVAL; once the limit
+	is reached records are collected until it resets, up to MAX_PENDING distinct records.
+	"""
 	LIMIT = 10
 	LIMIT_INTERVAL = 3600
+	BATCH_WINDOW = 60
+	MAX_PENDING = 100
+	# close our connection to the mail server if it hasn't been used for this long
+	IDLE_TIMEOUT = 300
 
 	def __init__(self, level=0):
 		super(EmailHandler, self).__init__(level)
 		if config.logalert is None:
 			raise ValueError("Cannot start log alerting; no configration given")
 		self.target = config.logalert['target']
+		self.batch_window = config.logalert.get('batch_window', self.BATCH_WINDOW)
+		self.mailer = Mailer(config.logalert)
 		self.limit = self.LIMIT
+		self.pending = OrderedDict() # {(logger name, msg template): [count, first formatted record, last time]}
+		self.overflow = 0 # records not included as there were too many pending
+		self.sent = 0
+		self._wakeup = gevent.event.Event()
 		self.limit_reset = gevent.spawn(self._limit_reset)
+		self.sender = gevent.spawn(self._send_loop)
 
 	def _limit_reset(self):
 		while True:
 			gevent.sleep(self.LIMIT_INTERVAL)
 			self.limit = self.LIMIT
+			self._wakeup.set()
 
 	def close(self):
 		self.limit_reset.kill()
+		self.sender.kill()
+		# send anything outstanding, but don't hold up shutdown for long
+		with gevent.Timeout(10, False):
+			self._send_pending()
+		self.mailer.close()
 		super(EmailHandler, self).close()
 
 	def emit(self, record):
 		try:
+			key = record.name, str(record.msg)
+			entry = self.pending.get(key)
+			if entry is not None:
+				entry[0] += 1
+				entry[2] = record.created
+			elif len(self.pending) >= self.MAX_PENDING:
+				self.overflow += 1
+			else:
+				# the record must be formatted now, as eg. its traceback won't be available later
+				self.pending[key] = [1, self.format(record), record.created]
+			self._wakeup.set()
+		except Exception:
+			self.handleError(record)
+
+	def _send_loop(self):
+		while True:
+			self._wakeup.wait(self.IDLE_TIMEOUT)
+			if not self._wakeup.is_set():
+				self.mailer.close()
+				continue
 			if self.limit <= 0:
-				return
-			self.limit -= 1
-			subject = "Alert from ekimbot process {}@{}".format(os.getpid(), socket.gethostname())
-			text = self.format(record)
-			if not self.limit:
-				text += '\nNote: Rate limit reached. Further alerts will be ignored.'
-			send(self.target, subject, text)
+				# wait for limit reset
+				self._wakeup.clear()
+				continue
+			gevent.sleep(self.batch_window)
+			self._wakeup.clear()
+			self._send_pending()
+
+	def _send_pending(self):
+		if not self.pending or self.limit <= 0:
+			return
+		# new records may arrive while we're sending, so we take what we have now and put it back if we fail
+		pending, self.pending = self.pending, OrderedDict()
+		overflow, self.overflow = self.overflow, 0
+		count = sum(entry[0] for entry in pending.values()) + overflow
+		subject = "Alert from ekimbot process {}@{}".format(os.getpid(), socket.gethostname())
+		if count > 1:
+			subject += " ({} records)".format(count)
+		parts = []
+		for repeats, text, last in pending.values():
+			if repeats > 1:
+				text += "\n(Repeated {} times, last at {})".format(
+					repeats, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)),
+				)
+			parts.append(text)
+		text = '\n\n----------\n\n'.join(parts)
+		if overflow:
+			text += '\n\nNote: {} further records were not included.'.format(overflow)
+		if self.limit == 1:
+			text += '\nNote: Rate limit reached. Further alerts will be held until it resets.'
+		try:
+			self.mailer.send(self.target, subject, text)
 		except Exception:
+			self.mailer.close()
+			self._restore(pending, overflow)
+			# try again after the next batch window
+			self._wakeup.set()
 			root_logger = logging.getLogger()
 			if self not in root_logger.handlers:
-				root_logger.warning("Failed to emit log in {}".format(self), exc_info=True)
+				root_logger.warning("Failed to send log alert in {}".format(self), exc_info=True)
+			return
+		self.limit -= 1
+		self.sent += 1
+
+	def _restore(self, pending, overflow):
+		"""Put back records taken by a failed _send_pending(), ahead of any that arrived since"""
+		for key, entry in self.pending.items():
+			if key in pending:
+				old = pending[key]
+				old[0] += entry[0]
+				old[2] = entry[2]
+			elif len(pending) >= self.MAX_PENDING:
+				overflow += entry[0]
+			else:
+				pending[key] = entry
+		self.pending = pending
+		self.overflow += overflow
 
 
 class AlertPlugin(BotPlugin):
-	"""Sets up a logging handler to email logs above a certain level"""
+	"""Sets up a logging handler to email logs above a certain level.
+	See EmailHandler and Mailer for config."""
 	name = 'logalert'
 	FORMAT = ("%(levelname)s in %(name)s at %(asctime)s\n"
 	          "%(message)s\n\n"
@@ -0,0 +1,15 @@
+
+from ekimbot.botplugin import ClientPlugin
+from ekimbot.commands import CommandHandler
+from ekimbot.paging import reply_more
+
+
+class MorePlugin(ClientPlugin):
+	"""Allows getting the rest of long output from other commands"""
+	name = 'more'
+
+	@CommandHandler("more", 0)
+	def more(self, msg, *args):
+		"""Show more output from the last command you ran, if it was too long to show at once"""
+		if not reply_more(self.client, msg):
+			self.reply(msg, "Nothing more to show")
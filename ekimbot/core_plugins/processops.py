@@ -1,11 +1,10 @@
 
 import os
 import socket
-import sys
 
 import gevent
 
-from ekimbot.main import handoff_all
+from ekimbot.main import restart_all, stop_all
 from ekimbot.botplugin import ClientPlugin
 from ekimbot.commands import CommandHandler
 
@@ -24,10 +23,10 @@ class ProcessopsPlugin(ClientPlugin):
 	@CommandHandler('process restart', 0)
 	def restart(self, msg, *args):
 		"""Restart the entire python process, but handoff the connections so we don't need to re-connect"""
-		# need to run handoff_all NOT as a greenlet associated with a client
+		# need to run restart_all NOT as a greenlet associated with a client
 		self.reply(msg, "Restarting process")
-		gevent.spawn(handoff_all)
+		gevent.spawn(restart_all)
 
 	@CommandHandler('process stop', 0)
 	def stop(self, msg, *args):
-		sys.exit()
+		stop_all()
@@ -0,0 +1,80 @@
+
+import os
+import time
+
+import gevent
+
+from ekimbot.botplugin import ClientPlugin
+from ekimbot.commands import CommandHandler
+from ekimbot.profiler import profiler
+
+
+class ProfilerPlugin(ClientPlugin):
+	"""Profiles the whole process (see ekimbot.profiler) and writes the results to a file
+	for use with flamegraph tools. The profiler is also available from the backdoor as "profiler".
+	You probably want to restrict who can use this with the "allow" option."""
+	name = 'profiler'
+	defaults = {
+		'duration': 30, # default duration in seconds
+		'max_duration': 600,
+		'rate': 100, # samples per second
+		'max_stacks': 10000,
+		'max_depth': 100,
+		'waiting': True, # whether to include suspended greenlets, not just the running one
+		'output': '/tmp/ekimbot-profile-{pid}-{time}.collapsed',
+		'top': 5, # how many plugins to list in the summary
+	}
+
+	@CommandHandler("profile start", 0)
+	def start(self, msg, duration=None, *args):
+		"""Start profiling for DURATION seconds (or the default), then write the results to a file"""
+		if duration is None:
+			duration = self.config.duration
+		else:
+			try:
+				duration = float(duration)
+			except ValueError:
+				self.reply(msg, "Bad duration: {!r}".format(duration))
+				return
+		duration = min(duration, self.config.max_duration)
+		try:
+			profiler.start(duration,
+				rate=self.config.rate,
+				max_stacks=self.config.max_stacks,
+				max_depth=self.config.max_depth,
+				waiting=self.config.waiting,
+			)
+		except ValueError as ex:
+			self.reply(msg, str(ex))
+			return
+		self.reply(msg, "Profiling for {:g} seconds".format(duration))
+		# not associated with this plugin, so it still reports if the plugin is disabled
+		gevent.spawn(self.finish, msg)
+
+	@CommandHandler("profile stop", 0)
+	def stop(self, msg, *args):
+		"""Stop profiling early. The results are still written."""
+		if not profiler.running:
+			self.reply(msg, "Profiler is not running")
+			return
+		profiler.stop()
+
+	def finish(self, msg):
+		profiler.wait()
+		path = self.config.output.format(pid=os.getpid(), time=int(time.time()))
+		try:
+			profiler.write(path)
+		except EnvironmentError as ex:
+			self.logger.exception("Failed to write profile to {!r}".format(path))
+			self.reply(msg, "Failed to write profile: {}".format(ex))
+			return
+		self.logger.info("Wrote profile of {} samples to {!r}".format(profiler.samples, path))
+		total = sum(profiler.by_plugin().values()) or 1
+		plugins = sorted(profiler.by_plugin().items(), key=lambda (plugin, count): -count)
+		self.reply_lines(msg, [
+			"Took {} samples over {:.1f}s, written to {}".format(profiler.samples, profiler.duration, path),
+			"Busiest: {}".format(', '.join(
+				"{} {:.0%}".format(plugin or 'other', float(count) / total)
+				for plugin, count in plugins[:self.config.top]
+			)),
+		])
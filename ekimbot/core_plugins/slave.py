@@ -1,60 +1,231 @@
 
-import random
+import os
+import socket
 import time
+import zlib
+from collections import deque
 
 import gevent
 
-from girc import Handler
+from girc.message import Message
 
 from ekimbot.botplugin import ClientPlugin
-from ekimbot.commands import CommandHandler
+from ekimbot.commands import CommandHandler, TimedHandler
+from ekimbot.election import LocalElection
+from ekimbot.hostmask import irc_lower
+from ekimbot.stats import stats
 
 
 class SlavePlugin(ClientPlugin):
 	"""Adds redundancy to the bot by allowing it to run in multiple places.
 	Since only one connection can hold the configured nick, we call this the "master".
 	We have other handlers predicate on client nick matching configured nick
+
+	Slaves take the master nick as soon as they see it become free. If the server supports MONITOR,
+	it tells us when that happens. Otherwise, we keep track of which of our channels the master is in,
+	and consider it gone once it has left all of them. If we share no channels with the master,
+	we fall back to polling with ISON every poll_interval seconds.
+	So that slaves don't all try to take the nick at once, each waits a fixed delay of up to
+	takeover_spread seconds depending on instance_id (default: hostname and pid) before trying.
+	Further attempts back off exponentially, up to max_backoff seconds.
+
+	If local_election is set, instances on the same host connecting to the same server elect a leader
+	between themselves (see ekimbot.election). Only the leader ever tries to take the master nick,
+	and it does so without delay. Abdicating hands leadership to another instance as soon as
+	we have given up the nick.
 	"""
 	name = 'slave'
 
 	defaults = {
 		'poll_interval': 5,
+		'takeover_spread': 2,
+		'instance_id': None,
+		'max_backoff': 60,
+		'local_election': False,
 	}
 
 	abdicated_until = None
+	master_lost_at = None # when we noticed the master nick was free, for measuring failover time
+	attempts = 0 # takeover attempts since the master nick was last free
+	takeover = None # greenlet trying to take the master nick, if any
+	election = None
 
 	def init(self):
-		self.check_user_poller = self.client._group.spawn(self.poll_check_users)
+		self.failover_times = deque(maxlen=100)
+		self.master_channels = self.find_master_channels()
+		self.ison_poller = self.client._group.spawn(self.poll_ison)
+		if self.config.local_election:
+			name = '{}/{}'.format(self.client.config['hostname'], self.master_nick)
+			self.election = LocalElection(name, self.on_election, self.client._group, self.logger)
+		if self.monitoring:
+			# we're taking over an already registered connection
+			self.monitor()
 
 	def cleanup(self):
-		self.check_user_poller.kill()
+		self.ison_poller.kill()
+		if self.takeover is not None:
+			self.takeover.kill()
+		if self.election is not None:
+			self.election.stop()
 		super(SlavePlugin, self).cleanup()
 
+	def get_handoff_state(self):
+		return {'abdicated_until': self.abdicated_until, 'master_lost_at': self.master_lost_at}
+
+	def set_handoff_state(self, state):
+		self.abdicated_until = state['abdicated_until']
+		if state['master_lost_at'] is not None:
+			self.master_lost_at = state['master_lost_at']
+			self.master_gone()
+
 	@property
 	def master_nick(self):
 		return self.client.config['nick']
 
-	# it's a bit hacky, but "after sync" ensures that the user list has been updated
-	@Handler(command={'QUIT', 'NICK'}, after={'sync'})
-	def check_users(self, *_):
-		"""Called after any user is observed to leave or change nick.
-		Also called peroidically in case this happened without us being able to see it.
-		Checks if any user can be seen with master nick. If not, tries to change nick to master nick.
-		"""
-		if self.client.is_master():
-			return
-		if self.abdicated_until is not None and time.time() < self.abdicated_until:
+	def is_master_nick(self, nick):
+		return irc_lower(nick) == irc_lower(self.master_nick)
+
+	@property
+	def monitoring(self):
+		return 'MONITOR' in self.client.isupport
+
+	@property
+	def takeover_delay(self):
+		"""Delay before our first attempt to take the master nick, which is fixed for this instance"""
+		instance_id = self.config.instance_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+		return self.config.takeover_spread * (zlib.crc32(instance_id) & 0xffff) / float(0xffff)
+
+	@property
+	def may_take_over(self):
+		return self.election is None or self.election.leader
+
+	def on_election(self, leader):
+		if leader and self.master_lost_at is not None:
+			self.master_gone()
+		elif not leader and self.takeover is not None:
+			self.takeover.kill(block=False)
+
+	def monitor(self):
+		Message(self.client, 'MONITOR', '+', self.master_nick).send()
+
+	def find_master_channels(self):
+		return {
+			name for name, channel in self.client._channels.items()
+			if channel.users_ready.is_set() and self.master_nick in channel.users.users
+		}
+
+	def shares_channel(self):
+		return any(channel.users_ready.is_set() for channel in self.client._channels.values())
+
+	@TimedHandler(command={'376', '422'})
+	def on_registered(self, client, msg):
+		"""End of MOTD (or no MOTD). By now the server has sent ISUPPORT, so we know if we can MONITOR."""
+		if self.monitoring:
+			self.monitor()
+
+	@TimedHandler(command={'730', '731'})
+	def on_monitor(self, client, msg):
+		"""RPL_MONONLINE and RPL_MONOFFLINE, with a list of nicks or nick!user@host"""
+		if any(self.is_master_nick(target.split('!')[0]) for target in msg.params[-1].split(',')):
+			if msg.command == '730':
+				self.master_present()
+			else:
+				self.master_gone()
+
+	@TimedHandler(command='303')
+	def on_ison(self, client, msg):
+		if self.monitoring or self.shares_channel():
 			return
-		for channel in self.client._channels.values():
-			if channel.users_ready.is_set() and self.master_nick in channel.users.users:
+		if any(self.is_master_nick(nick) for nick in msg.params[-1].split()):
+			self.master_present()
+		else:
+			self.master_gone()
+
+	# "after sync" ensures that channel user lists have been updated
+	@TimedHandler(command={'JOIN', 'PART', 'KICK', 'QUIT', 'NICK', '366'}, after={'sync'})
+	def on_presence(self, client, msg):
+		"""Keep track of which channels the master is in, and take the nick when it is in none of them"""
+		if msg.command == 'NICK' and self.is_master_nick(msg.params[0]):
+			if self.client.matches_nick(msg.params[0]):
+				self.became_master()
 				return
-		gevent.sleep(random.random() * 2) # prevent crashing txircd by changing nick at the same time as another ekimbot
-		self.client.try_change_nick(self.master_nick) # don't increment nick and try again if we fail, just try once.
+			# someone else took the nick. We don't know what channels they are in without checking all of them.
+			self.master_channels = self.find_master_channels()
+		elif msg.command in ('QUIT', 'NICK'):
+			if self.is_master_nick(msg.sender):
+				self.master_channels.clear()
+				if msg.command == 'NICK' and self.client.matches_nick(msg.params[0]) and self.election is not None:
+					# we've given up the nick, now let another instance take it
+					self.election.resign(max(0, (self.abdicated_until or 0) - time.time()))
+		elif msg.command == 'JOIN':
+			if self.is_master_nick(msg.sender):
+				self.master_channels.update(msg.params[0].split(','))
+		elif msg.command == 'PART':
+			if self.is_master_nick(msg.sender) or self.client.matches_nick(msg.sender):
+				self.master_channels.difference_update(msg.params[0].split(','))
+		elif msg.command == 'KICK':
+			if self.is_master_nick(msg.params[1]) or self.client.matches_nick(msg.params[1]):
+				self.master_channels.discard(msg.params[0])
+		else: # RPL_ENDOFNAMES, we have the full user list of a channel
+			channel = self.client.channel(msg.params[1])
+			if self.master_nick in channel.users.users:
+				self.master_channels.add(msg.params[1])
+			else:
+				self.master_channels.discard(msg.params[1])
+
+		if self.monitoring or self.client.is_master():
+			return
+		if self.master_channels:
+			self.master_present()
+		elif self.shares_channel():
+			self.master_gone()
 
-	def poll_check_users(self):
+	def poll_ison(self):
 		while True:
 			gevent.sleep(self.config.poll_interval)
-			self.check_users()
+			if not self.client.is_master() and not self.monitoring and not self.shares_channel():
+				Message(self.client, 'ISON', self.master_nick).send()
+
+	def master_present(self):
+		self.master_lost_at = None
+		self.attempts = 0
+		if self.takeover is not None and self.takeover is not gevent.getcurrent():
+			self.takeover.kill(block=False)
+			self.takeover = None
+
+	def master_gone(self):
+		if self.client.is_master():
+			return
+		if self.master_lost_at is None:
+			self.master_lost_at = time.time()
+		if self.takeover is None and self.may_take_over:
+			self.takeover = self.client._group.spawn(self.take_over)
+
+	def take_over(self):
+		try:
+			while self.master_lost_at is not None and not self.client.is_master():
+				# with a local election, we're the only instance trying so there's no need to wait
+				delay = 0 if self.election is not None else self.takeover_delay
+				if self.attempts:
+					delay += min(self.config.max_backoff, self.config.poll_interval * 2**(self.attempts - 1))
+				if self.abdicated_until is not None:
+					delay = max(delay, self.abdicated_until - time.time())
+				gevent.sleep(delay)
+				if self.client.is_master():
+					break
+				self.attempts += 1
+				self.client.try_change_nick(self.master_nick) # don't increment nick and try again if we fail, just try once.
+		finally:
+			if self.takeover is gevent.getcurrent():
+				self.takeover = None
+
+	def became_master(self):
+		if self.master_lost_at is not None:
+			failover_time = time.time() - self.master_lost_at
+			self.failover_times.append(failover_time)
+			stats.timer('failover', self.client.name).observe(failover_time)
+			self.logger.info("Took over as master {:.3f}s after master nick became free".format(failover_time))
+		self.master_present()
 
 	@CommandHandler("abdicate", 0)
 	def abdicate(self, msg, *args):
@@ -66,6 +237,11 @@ class SlavePlugin(ClientPlugin):
 				return
 		else:
 			timeout = self.config.poll_interval * 2
-		self.logger.info("Stepping down as master")
 		self.abdicated_until = time.time() + timeout
+		if not self.client.is_master():
+			if self.election is not None:
+				self.election.resign(timeout)
+			return
+		self.logger.info("Stepping down as master")
+		# if we're in a local election, we resign once the nick change goes through (see on_presence)
 		self.client.nick = self.client.increment_nick(self.client.nick)
@@ -0,0 +1,67 @@
+
+from gevent.pywsgi import WSGIServer
+
+from ekimbot.botplugin import BotPlugin, ClientPlugin
+from ekimbot.commands import CommandHandler
+from ekimbot.stats import stats, prometheus_text, format_seconds
+
+
+class StatsPlugin(ClientPlugin):
+	"""Shows performance stats for the whole process.
+	You probably want to restrict who can use this with the "allow" option."""
+	name = 'stats'
+	defaults = {
+		'top': 5, # how many timers to show, slowest (by total time) first
+	}
+
+	@CommandHandler("stats", 0)
+	def show(self, msg, *args):
+		"""Show message rates for each client, and the handlers and commands that took the most time"""
+		lines = []
+		for name, client_stats in sorted(stats.clients.items()):
+			lines.append("{}: {:.2f} msgs/s in, {:.2f} msgs/s out".format(
+				name, client_stats.messages_in.rate, client_stats.messages_out.rate,
+			))
+		lines.append("Outbound queue: {}".format(', '.join(
+			"{} {}".format(count, priority) for priority, count in sorted(self.client.outbound.depth_by_priority().items())
+		)))
+		timers = sorted(stats.timers.items(), key=lambda (key, timer): -timer.latency.sum)
+		for (kind, name), timer in timers[:self.config.top]:
+			lines.append("{} {}: {} calls, {} errors, p50 {}, p99 {}, total {}".format(
+				kind, name, timer.calls, timer.errors,
+				format_seconds(timer.latency.percentile(0.5)),
+				format_seconds(timer.latency.percentile(0.99)),
+				format_seconds(timer.latency.sum),
+			))
+		self.reply_lines(msg, lines)
+
+	@CommandHandler("stats reset", 0)
+	def reset(self, msg, *args):
+		"""Clear all collected stats"""
+		stats.reset()
+		self.reply(msg, "Stats reset")
+
+
+class StatsServerPlugin(BotPlugin):
+	"""Serves stats over HTTP at /metrics, in the prometheus text format.
+	Enable as a global plugin. Only listens on localhost by default."""
+	name = 'stats_http'
+	defaults = {
+		'host': 'localhost',
+		'port': 9105,
+	}
+
+	def init(self):
+		self.server = WSGIServer((self.config.host, self.config.port), self.app, log=None)
+		self.server.start()
+
+	def cleanup(self):
+		super(StatsServerPlugin, self).cleanup()
+		self.server.stop()
+
+	def app(self, environ, start_response):
+		if environ['PATH_INFO'] != '/metrics':
+			start_response('404 Not Found', [('Content-Type', 'text/plain')])
+			return ['Not found\n']
+		start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+		return [prometheus_text()]
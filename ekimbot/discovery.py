@@ -0,0 +1,144 @@
+"""Finding which module provides a plugin without importing it.
+
+Plugin modules are scanned (without importing them) for the names of the plugins they define.
+The results are cached in a manifest file, and a module is only re-scanned when it has changed.
+This lets us import a module only when one of its plugins is first enabled.
+"""
+
+import ast
+import json
+import logging
+import os
+import time
+
+from ekimbot.utils import list_modules
+
+
+logger = logging.getLogger('ekimbot.discovery')
+
+
+def module_files(path, module):
+	"""Returns the list of source files for a module in path, as found by list_modules()"""
+	fullname = os.path.join(path, module)
+	if not os.path.isdir(fullname):
+		return [fullname + '.py']
+	files = []
+	for dirpath, dirnames, filenames in os.walk(fullname):
+		files += [os.path.join(dirpath, name) for name in filenames if name.endswith('.py')]
+	return sorted(files)
+
+
+def plugin_names(source, filename='<unknown>'):
+	"""Returns the names of plugins defined in the given module source. These are found by looking for
+	classes with a string "name" attribute, and functions decorated with command_plugin()."""
+	names = []
+	for node in ast.walk(ast.parse(source, filename)):
+		if isinstance(node, ast.ClassDef):
+			for statement in node.body:
+				if (
+					isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Str)
+					and any(isinstance(target, ast.Name) and target.id == 'name' for target in statement.targets)
+				):
+					names.append(statement.value.s)
+		elif isinstance(node, ast.FunctionDef):
+			for decorator in node.decorator_list:
+				if isinstance(decorator, ast.Call):
+					decorator = decorator.func
+				decorator_name = decorator.attr if isinstance(decorator, ast.Attribute) else getattr(decorator, 'id', None)
+				if decorator_name == 'command_plugin':
+					names.append(node.name)
+	return names
+
+
+class PluginManifest(object):
+	"""Maps plugin names to the modules that define them, for modules in the given paths.
+	manifest_path is a file to cache the results of scanning modules in, or None to not cache them.
+	load is a function which takes a module name and imports it, eg. BotPlugin.load.
+	Since we can only guess at plugin names from the source, require() falls back to importing
+	every module if it can't find the plugin it is asked for.
+	"""
+
+	def __init__(self, paths, manifest_path, load):
+		self.paths = paths
+		self.manifest_path = manifest_path
+		self._load = load
+		self.plugins = {} # {plugin name: module name}
+		self.modules = [] # all module names, in load order
+		self.loaded = set()
+		self.import_times = {} # {module name: seconds taken to import}
+		self.scan()
+
+	def scan(self):
+		"""(Re-)build the manifest, only re-reading modules that have changed since they were cached"""
+		cache = self._read_cache()
+		new_cache = {}
+		self.plugins = {}
+		self.modules = []
+		for path in self.paths:
+			for module in list_modules(path):
+				files = module_files(path, module)
+				mtime = max(os.stat(filename).st_mtime for filename in files) if files else 0
+				key = os.path.join(path, module)
+				cached = cache.get(key)
+				if cached is not None and cached['mtime'] == mtime:
+					names = cached['plugins']
+				else:
+					names = []
+					for filename in files:
+						try:
+							with open(filename) as f:
+								names += plugin_names(f.read(), filename)
+						except (IOError, SyntaxError):
+							# we'll get a proper error if we ever try to import it
+							logger.debug("Failed to scan {} for plugins".format(filename), exc_info=True)
+				new_cache[key] = {'mtime': mtime, 'plugins': names}
+				if module in self.modules:
+					continue # as per load paths, earlier paths take precedence
+				self.modules.append(module)
+				for name in names:
+					self.plugins.setdefault(name, module)
+		if new_cache != cache:
+			self._write_cache(new_cache)
+
+	def _read_cache(self):
+		if not self.manifest_path or not os.path.exists(self.manifest_path):
+			return {}
+		try:
+			with open(self.manifest_path) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			logger.warning("Failed to read plugin manifest {}, ignoring".format(self.manifest_path), exc_info=True)
+			return {}
+
+	def _write_cache(self, cache):
+		if not self.manifest_path:
+			return
+		tmp_path = "{}.tmp".format(self.manifest_path)
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump(cache, f)
+			os.rename(tmp_path, self.manifest_path)
+		except (IOError, OSError):
+			logger.warning("Failed to write plugin manifest {}".format(self.manifest_path), exc_info=True)
+
+	def load(self, module):
+		"""Import a module, if it hasn't been already"""
+		if module in self.loaded:
+			return
+		start = time.time()
+		self._load(module)
+		self.import_times[module] = time.time() - start
+		self.loaded.add(module)
+
+	def load_all(self):
+		for module in self.modules:
+			self.load(module)
+
+	def require(self, plugin):
+		"""Ensure the module defining the named plugin has been imported"""
+		module = self.plugins.get(plugin)
+		if module is None:
+			logger.debug("Plugin {!r} not found in manifest, loading all plugins".format(plugin))
+			self.load_all()
+		else:
+			self.load(module)
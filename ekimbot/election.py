@@ -0,0 +1,110 @@
+"""Leader election between processes on the same host.
+
+The leader listens on an abstract unix socket (so this is linux-only). Everyone else connects to it
+and waits for the connection to close, which happens as soon as the leader resigns or exits
+(even if it crashes, since the kernel closes its sockets). They then all try to listen on the socket.
+Binding is atomic, so exactly one of them wins and becomes the new leader, and the rest connect to it.
+"""
+
+import errno
+import logging
+import socket
+import time
+
+import gevent
+import gevent.event
+
+
+class LocalElection(object):
+	"""Takes part in the election for the given name. on_change(leader) is called from the election's
+	greenlet (which is spawned in group) whenever we become or stop being the leader."""
+
+	# how long to wait before retrying if we can neither become the leader or find it,
+	# eg. because the new leader hasn't started listening yet
+	RETRY_INTERVAL = 0.1
+
+	def __init__(self, name, on_change, group, logger=None):
+		self.name = name
+		self.address = '\0ekimbot-election:{}'.format(name)
+		self.on_change = on_change
+		self.logger = logger or logging.getLogger('ekimbot.election')
+		self.leader = False
+		self.resigned_until = None
+		self._resign = gevent.event.Event()
+		self._worker = group.spawn(self._run)
+
+	def stop(self):
+		"""Stop taking part in the election, resigning if we are the leader"""
+		self._worker.kill()
+
+	def resign(self, duration=0):
+		"""If we are the leader, immediately hand over to another process if there is one.
+		We won't try to become leader again for duration seconds."""
+		self.resigned_until = time.time() + duration
+		self._resign.set()
+
+	def _run(self):
+		while True:
+			if self.resigned_until is None or time.time() >= self.resigned_until:
+				listener = self._listen()
+				if listener is not None:
+					self._lead(listener)
+					continue
+			if not self._follow():
+				gevent.sleep(self.RETRY_INTERVAL)
+
+	def _listen(self):
+		"""Returns a listening socket if we won the election, otherwise None"""
+		listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			listener.bind(self.address)
+		except socket.error as e:
+			listener.close()
+			if e.errno != errno.EADDRINUSE:
+				raise
+			return None
+		listener.listen(128)
+		return listener
+
+	def _lead(self, listener):
+		followers = []
+		def accept():
+			while True:
+				conn, _ = listener.accept()
+				followers.append(conn)
+		acceptor = gevent.spawn(accept)
+		self._resign.clear()
+		try:
+			self.leader = True
+			self.logger.info("Became leader for {!r}".format(self.name))
+			self.on_change(True)
+			self._resign.wait()
+		finally:
+			acceptor.kill()
+			# closing these wakes up all followers, one of which will take over
+			listener.close()
+			for conn in followers:
+				conn.close()
+			self.leader = False
+			self.logger.info("No longer leader for {!r}".format(self.name))
+			self.on_change(False)
+
+	def _follow(self):
+		"""Wait until the current leader goes away. Returns False if there is no leader to follow."""
+		conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			try:
+				conn.connect(self.address)
+			except socket.error as e:
+				if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+					raise
+				return False
+			try:
+				# the leader never sends anything, this returns when the connection is closed
+				conn.recv(1)
+			except socket.error as e:
+				if e.errno != errno.ECONNRESET:
+					raise
+			return True
+		finally:
+			conn.close()
@@ -0,0 +1,217 @@
+"""A minimal IRC server for testing and benchmarking, see ekimbot.bench.
+
+It does just enough for a client to register, join channels and get user lists. Everything else
+the client sends is recorded but otherwise ignored. Traffic from other users is faked by
+writing raw lines to a connection with send().
+"""
+
+import logging
+import time
+
+import gevent
+import gevent.event
+from gevent.server import StreamServer
+
+
+SERVER_NAME = 'fake.server'
+
+# sent in RPL_ISUPPORT on registration
+DEFAULT_ISUPPORT = ['CHANTYPES=#&', 'PREFIX=(ov)@+', 'NICKLEN=30', 'CHANLIMIT=#:100', 'TARGMAX=JOIN:,PRIVMSG:4', 'MONITOR=100']
+
+
+def parse_line(line):
+	"""Returns (command, params) for a line from a client. Any prefix is ignored."""
+	if line.startswith(':'):
+		_, line = line.split(' ', 1)
+	if ' :' in line:
+		line, trailing = line.split(' :', 1)
+		params = line.split() + [trailing]
+	else:
+		params = line.split()
+	if not params:
+		return None, []
+	return params[0].upper(), params[1:]
+
+
+class Connection(object):
+	"""A connected client. lines is a list of (time received, line) for everything the client has sent,
+	unless the server was created with record=False."""
+
+	def __init__(self, server, sock, address):
+		self.server = server
+		self.sock = sock
+		self.address = address
+		self.nick = None
+		self.user = None
+		self.registered = gevent.event.Event()
+		self.channels = set()
+		self.lines = []
+		self.received = 0
+		self.closed = gevent.event.Event()
+		self._pongs = {}
+		self._syncs = 0
+
+	@property
+	def hostmask(self):
+		return '{}!{}@fake.host'.format(self.nick, self.user or self.nick)
+
+	def send(self, *lines):
+		"""Send the given raw lines, without line endings"""
+		self.sock.sendall(''.join(line + '\r\n' for line in lines))
+
+	def reply(self, numeric, *params):
+		"""Send a numeric reply, with the client's nick as first param and the last param as trailing"""
+		params = [self.nick or '*'] + list(params)
+		params[-1] = ':' + params[-1]
+		self.send(':{} {} {}'.format(SERVER_NAME, numeric, ' '.join(params)))
+
+	def sync(self, timeout=None):
+		"""Ping the client and wait for the reply. Since a client handles lines in order,
+		this means it has read everything sent before this call. Returns False on timeout."""
+		self._syncs += 1
+		token = 'sync-{}'.format(self._syncs)
+		pong = self._pongs[token] = gevent.event.Event()
+		self.send('PING :{}'.format(token))
+		try:
+			return pong.wait(timeout)
+		finally:
+			self._pongs.pop(token, None)
+
+	def close(self):
+		self.sock.close()
+		self.closed.set()
+
+	def _run(self):
+		buf = ''
+		try:
+			while True:
+				data = self.sock.recv(4096)
+				if not data:
+					break
+				buf += data
+				lines = buf.split('\n')
+				buf = lines.pop()
+				for line in lines:
+					self._handle(line.rstrip('\r'))
+		finally:
+			self.closed.set()
+
+	def _handle(self, line):
+		self.received += 1
+		if self.server.record:
+			self.lines.append((time.time(), line))
+		command, params = parse_line(line)
+		if self.server.on_line is not None:
+			self.server.on_line(self, command, params)
+		handler = getattr(self, '_handle_{}'.format(command), None)
+		if handler is not None:
+			handler(*params)
+
+	def _handle_NICK(self, nick, *args):
+		if self.registered.is_set():
+			self.send(':{} NICK :{}'.format(self.hostmask, nick))
+		self.nick = nick
+		self._check_registered()
+
+	def _handle_USER(self, user, *args):
+		self.user = user
+		self._check_registered()
+
+	def _check_registered(self):
+		if self.registered.is_set() or not (self.nick and self.user):
+			return
+		self.reply('001', "Welcome to the fake IRC network {}".format(self.hostmask))
+		self.reply('005', *(list(self.server.isupport) + ["are supported by this server"]))
+		self.reply('422', "MOTD File is missing")
+		self.registered.set()
+
+	def _handle_PING(self, *args):
+		self.send(':{} PONG {} :{}'.format(SERVER_NAME, SERVER_NAME, args[-1] if args else ''))
+
+	def _handle_PONG(self, *args):
+		if args and args[-1] in self._pongs:
+			self._pongs[args[-1]].set()
+
+	def _handle_JOIN(self, channels, *args):
+		for channel in channels.split(','):
+			self.channels.add(channel)
+			self.send(':{} JOIN {}'.format(self.hostmask, channel))
+			names = [self.nick] + list(self.server.names.get(channel, []))
+			# keep lines well under 512 bytes
+			for i in range(0, len(names), 20):
+				self.reply('353', '=', channel, ' '.join(names[i:i+20]))
+			self.reply('366', channel, "End of /NAMES list")
+
+	def _handle_PART(self, channels, *args):
+		for channel in channels.split(','):
+			self.channels.discard(channel)
+			self.send(':{} PART {}'.format(self.hostmask, channel))
+
+	def _handle_ISON(self, *nicks):
+		online = set(self.server.online)
+		self.reply('303', ' '.join(nick for nick in ' '.join(nicks).split() if nick in online))
+
+	def _handle_QUIT(self, *args):
+		self.send('ERROR :Closing link')
+		self.close()
+
+
+class FakeServer(object):
+	"""Listens on address (by default, a random port on localhost) until stopped.
+	names is {channel: list of nicks} of other users to report as in each channel on join.
+	online is a list of other users' nicks which are reported as online by ISON.
+	If given, on_line(connection, command, params) is called for every line received, before it's handled.
+	"""
+
+	def __init__(self, address=('localhost', 0), isupport=DEFAULT_ISUPPORT, names={}, online=(), on_line=None, record=True):
+		self.isupport = isupport
+		self.names = names
+		self.online = online
+		self.on_line = on_line
+		self.record = record
+		self.connections = []
+		self.connected = gevent.event.Event() # set on every new connection, clear it to wait for the next
+		self.logger = logging.getLogger('ekimbot.fakeserver')
+		self.server = StreamServer(address, self._accept)
+
+	@property
+	def address(self):
+		return self.server.address
+
+	@property
+	def port(self):
+		return self.server.server_port
+
+	def start(self):
+		self.server.start()
+		self.logger.debug("Listening on {}:{}".format(*self.address))
+
+	def stop(self):
+		self.server.stop()
+		for connection in self.connections:
+			connection.close()
+
+	def wait_for_connections(self, count, timeout=None):
+		"""Wait until at least count clients have connected and registered. Returns False on timeout."""
+		deadline = None if timeout is None else time.time() + timeout
+		while len(self.connections) < count:
+			self.connected.clear()
+			if not self.connected.wait(None if deadline is None else max(0, deadline - time.time())):
+				return False
+		for connection in self.connections:
+			if not connection.registered.wait(None if deadline is None else max(0, deadline - time.time())):
+				return False
+		return True
+
+	def _accept(self, sock, address):
+		connection = Connection(self, sock, address)
+		self.connections.append(connection)
+		self.connected.set()
+		self.logger.debug("Connection from {}".format(address))
+		try:
+			connection._run()
+		except Exception:
+			self.logger.warning("Connection from {} failed".format(address), exc_info=True)
+		finally:
+			self.connections.remove(connection)
+			sock.close()
@@ -0,0 +1,22 @@
+"""Helpers for inspecting stacks, eg. to work out which plugin some running code belongs to"""
+
+
+def frame_owner(frame):
+	"""Walks outwards from frame and returns (plugin name, function name) for the innermost
+	method of a plugin (ie. a function with a "self" local which is a BotPlugin), or None if there isn't one."""
+	# lazy import to break cyclic dependency
+	from ekimbot.botplugin import BotPlugin
+	while frame is not None:
+		if 'self' in frame.f_code.co_varnames:
+			obj = frame.f_locals.get('self')
+			if isinstance(obj, BotPlugin):
+				return obj.name, frame.f_code.co_name
+		frame = frame.f_back
+	return None
+
+
+def describe_owner(owner):
+	"""Human-readable description of a return value of frame_owner()"""
+	if owner is None:
+		return "unknown code"
+	return "plugin {} ({})".format(*owner)
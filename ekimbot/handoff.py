@@ -0,0 +1,59 @@
+"""Passing client connections and state to a re-exec()ed process.
+
+The old process pickles the handoff state to an unlinked temporary file, then sends that file
+and every client socket over one end of a unix socketpair with SCM_RIGHTS. Only the other end
+of the socketpair needs to be kept open across exec(). File descriptors in flight are held
+by the kernel, so the new process can receive everything from that one fd, and the old process
+can close everything else.
+"""
+
+import cPickle as pickle
+import os
+import socket
+import tempfile
+
+# python 2 has no socket.sendmsg(), but multiprocessing provides the SCM_RIGHTS primitives we need
+from _multiprocessing import sendfd, recvfd
+
+
+def send(state, fds):
+	"""Send state (any picklable object) and a list of fds for handoff.
+	Returns an fd which must be kept open across exec() and passed to receive() in the new process.
+	The caller should close all other fds, including the ones given."""
+	sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		with tempfile.TemporaryFile() as state_file:
+			pickle.dump((len(fds), state), state_file, pickle.HIGHEST_PROTOCOL)
+			state_file.flush()
+			sendfd(sender.fileno(), state_file.fileno())
+		for fd in fds:
+			sendfd(sender.fileno(), fd)
+		return os.dup(receiver.fileno())
+	finally:
+		sender.close()
+		receiver.close()
+
+
+def receive(handoff_fd):
+	"""Receive the state and fds sent by send(), given the fd it returned. Returns (state, fds)."""
+	try:
+		with os.fdopen(recvfd(handoff_fd), 'rb') as state_file:
+			state_file.seek(0)
+			count, state = pickle.load(state_file)
+		fds = [recvfd(handoff_fd) for _ in range(count)]
+	finally:
+		os.close(handoff_fd)
+	return state, fds
+
+
+def close_fds(keep):
+	"""Close all fds except stdin, stdout, stderr and the ones in keep"""
+	try:
+		open_fds = map(int, os.listdir('/proc/self/fd'))
+	except OSError:
+		open_fds = range(os.sysconf('SC_OPEN_MAX'))
+	for fd in set(open_fds) - {0, 1, 2} - set(keep):
+		try:
+			os.close(fd)
+		except OSError:
+			pass # this is probably EBADF, but even if it isn't we can't do anything about it
@@ -0,0 +1,99 @@
+"""Matching of IRC nick!user@host masks, as used by ignore and allow lists"""
+
+import re
+import string
+
+from ekimbot.config import config
+
+
+_LOWER_TABLE = string.maketrans(
+	string.ascii_uppercase + '[]\\~',
+	string.ascii_lowercase + '{}|^',
+)
+
+
+def irc_lower(s):
+	"""Lowercase a nick or mask as per the rfc1459 case mapping"""
+	if isinstance(s, unicode):
+		s = s.encode('utf-8')
+	return s.translate(_LOWER_TABLE)
+
+
+def _compile(globs):
+	"""Combine a list of globs (where * is any string and ? is any character) into a single regex,
+	or None if there are no globs."""
+	if not globs:
+		return None
+	parts = []
+	for glob in globs:
+		parts.append(''.join(
+			'.*' if c == '*' else '.' if c == '?' else re.escape(c)
+			for c in glob
+		))
+	return re.compile(r'(?:{})\Z'.format('|'.join(parts)), re.DOTALL)
+
+
+class HostmaskMatcher(object):
+	"""A compiled list of masks. Each mask is either a bare nick, which matches that nick
+	regardless of user and host, or a nick!user@host mask (a missing part matches anything,
+	eg. "*@example.com" or "nick!user"). Masks may contain * and ? wildcards, and matching is case-insensitive.
+	Bare nicks without wildcards (the common case) are checked with a single set lookup.
+	All other masks are combined into one regex.
+	"""
+
+	def __init__(self, masks):
+		self.nicks = set()
+		nick_globs = []
+		mask_globs = []
+		for mask in masks:
+			mask = irc_lower(mask)
+			if '!' in mask or '@' in mask:
+				nick, _, userhost = mask.rpartition('!')
+				user, _, host = userhost.partition('@')
+				mask_globs.append('{}!{}@{}'.format(nick or '*', user or '*', host or '*'))
+			elif '*' in mask or '?' in mask:
+				nick_globs.append(mask)
+			else:
+				self.nicks.add(mask)
+		self.nick_regex = _compile(nick_globs)
+		self.mask_regex = _compile(mask_globs)
+
+	def __nonzero__(self):
+		return bool(self.nicks or self.nick_regex or self.mask_regex)
+
+	def match(self, nick, user=None, host=None):
+		"""Returns whether the given sender matches any mask"""
+		nick = irc_lower(nick)
+		if nick in self.nicks:
+			return True
+		if self.nick_regex and self.nick_regex.match(nick):
+			return True
+		if self.mask_regex:
+			mask = '{}!{}@{}'.format(nick, irc_lower(user or ''), irc_lower(host or ''))
+			return bool(self.mask_regex.match(mask))
+		return False
+
+
+# maps id(masks) to (masks, matcher). Keeping masks alive means its id can't be reused while it's cached.
+_matchers = {}
+_matchers_generation = None
+_MAX_MATCHERS = 256
+
+
+def compile_masks(masks):
+	"""Returns a HostmaskMatcher for the given list of masks, normally a config value.
+	Matchers are cached by the identity of the list, so repeated calls with the same config value
+	take constant time. The cache is discarded whenever config changes (see BotConfig.changed()),
+	so masks must not be modified in place without calling config.changed()."""
+	global _matchers_generation
+	if _matchers_generation != config.generation:
+		_matchers.clear()
+		_matchers_generation = config.generation
+	entry = _matchers.get(id(masks))
+	if entry is not None and entry[0] is masks:
+		return entry[1]
+	if len(_matchers) >= _MAX_MATCHERS:
+		_matchers.clear()
+	matcher = HostmaskMatcher(masks)
+	_matchers[id(masks)] = masks, matcher
+	return matcher
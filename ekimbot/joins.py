@@ -0,0 +1,74 @@
+"""Joining many channels in as few JOIN lines as possible, within the limits the server advertises in ISUPPORT"""
+
+# longest line we may send, not including the trailing \r\n
+MAX_LENGTH = 510
+
+
+def parse_channel(entry):
+	"""Channels in config may be given as "#name" or "#name key". Returns (name, key or None)."""
+	parts = entry.split(None, 1)
+	return parts[0], (parts[1] if len(parts) > 1 else None)
+
+
+def targmax(isupport, command):
+	"""Returns the max number of targets the server allows for command, or None for no limit"""
+	for entry in isupport.get('TARGMAX', '').split(','):
+		name, _, limit = entry.partition(':')
+		if name.upper() == command:
+			return int(limit) if limit else None
+	return None
+
+
+def chanlimit(isupport):
+	"""Returns [(prefixes, limit)] for the max number of channels we may be in, by channel prefix.
+	Each limit is shared by all channels with any of the prefixes."""
+	if 'CHANLIMIT' in isupport:
+		limits = []
+		for entry in isupport['CHANLIMIT'].split(','):
+			prefixes, _, limit = entry.partition(':')
+			if limit:
+				limits.append((prefixes, int(limit)))
+		return limits
+	if 'MAXCHANNELS' in isupport:
+		return [(isupport.get('CHANTYPES', '#&'), int(isupport['MAXCHANNELS']))]
+	return []
+
+
+def join_batches(channels, isupport, joined=()):
+	"""Takes a list of (name, key or None) and returns (batches, skipped), where batches is a list of
+	(names, keys) to send as "JOIN NAMES KEYS" (each a comma-seperated list, keys may be empty),
+	and skipped is a list of names that weren't included because we'd be over CHANLIMIT.
+	joined is the names of any channels we're already in, which count towards CHANLIMIT."""
+	limits = [[prefixes, limit] for prefixes, limit in chanlimit(isupport)]
+	for name in joined:
+		for limit in limits:
+			if name[:1] in limit[0]:
+				limit[1] -= 1
+	allowed = []
+	skipped = []
+	for name, key in channels:
+		limit = next((limit for limit in limits if name[:1] in limit[0]), None)
+		if limit is not None:
+			if limit[1] <= 0:
+				skipped.append(name)
+				continue
+			limit[1] -= 1
+		allowed.append((name, key))
+
+	max_targets = targmax(isupport, 'JOIN')
+	# keys apply to channels in order, so channels with keys must come first in each line
+	allowed.sort(key=lambda (name, key): key is None)
+	batches = []
+	names, keys = [], []
+	for name, key in allowed:
+		new_names = names + [name]
+		new_keys = keys + [key] if key is not None else keys
+		length = len('JOIN {} {}'.format(','.join(new_names), ','.join(new_keys)))
+		if names and (length > MAX_LENGTH or (max_targets and len(new_names) > max_targets)):
+			batches.append((','.join(names), ','.join(keys)))
+			names, keys = [name], ([key] if key is not None else [])
+		else:
+			names, keys = new_names, new_keys
+	if names:
+		batches.append((','.join(names), ','.join(keys)))
+	return batches, skipped
@@ -0,0 +1,185 @@
+"""Writing logs from a background thread, see the "log_queue_size" option.
+
+Logging calls only put the record on a queue, and a native (not gevent) thread does the
+formatting and writing, so slow disks or a lot of logging don't hold up everything else.
+"""
+
+import logging
+import time
+from collections import deque
+
+from gevent.monkey import get_original
+
+
+# we need a real thread and real locks, even when gevent has patched these modules
+start_new_thread, allocate_lock, get_ident = get_original('thread', ['start_new_thread', 'allocate_lock', 'get_ident'])
+
+# queued in place of a record to ask the writer to flush
+_FLUSH = object()
+
+
+class NativeRLock(object):
+	"""A re-entrant lock made from real thread locks, for handlers used by both the writer thread and
+	the main thread (eg. logging.shutdown() acquires a handler's lock and then calls flush(), which acquires it again)"""
+
+	def __init__(self):
+		self._lock = allocate_lock()
+		self._owner = None
+		self._count = 0
+
+	def acquire(self, blocking=True):
+		me = get_ident()
+		if self._owner == me:
+			self._count += 1
+			return True
+		if not self._lock.acquire(blocking):
+			return False
+		self._owner = me
+		self._count = 1
+		return True
+
+	def release(self):
+		self._count -= 1
+		if not self._count:
+			self._owner = None
+			self._lock.release()
+
+	def __enter__(self):
+		self.acquire()
+
+	def __exit__(self, *exc_info):
+		self.release()
+
+
+class QueueHandler(logging.Handler):
+	"""Passes records to the given handlers from a background thread.
+	At most max_size records may be waiting to be written, further records are dropped and counted
+	in dropped. Consecutive identical records (same logger, level, location and message)
+	are only written once, followed by "Last message repeated N times" once a different record
+	is written or the handler is flushed.
+	The given handlers are only ever used from the writer thread, except when closed.
+	"""
+
+	# how long flush() waits for the writer to catch up
+	FLUSH_TIMEOUT = 5
+
+	def __init__(self, handlers, max_size=10000, level=logging.NOTSET):
+		super(QueueHandler, self).__init__(level)
+		self.handlers = handlers
+		for handler in handlers:
+			# the handler's own lock is a gevent lock, which can't be shared with another thread
+			handler.lock = NativeRLock()
+		self.max_size = max_size
+		self.queue = deque()
+		self.queued = 0 # total records queued, including flush requests
+		self.written = 0 # total records taken from the queue by the writer
+		self.dropped = 0
+		self.suppressed = 0 # total repeated records not written
+		self._reported_dropped = 0
+		self._last_key = None
+		self._last = None
+		self._repeats = 0
+		self._stopping = False
+		self._wakeup = allocate_lock()
+		self._wakeup.acquire() # released to wake the writer, acts as a binary semaphore
+		self._stopped = allocate_lock()
+		self._stopped.acquire()
+		start_new_thread(self._run, ())
+
+	def emit(self, record):
+		if len(self.queue) >= self.max_size:
+			self.dropped += 1
+			return
+		# merge args now, as they may change before the writer gets to them
+		record.msg = record.getMessage()
+		record.args = None
+		self._put(record)
+
+	def _put(self, item):
+		self.queued += 1
+		self.queue.append(item)
+		try:
+			self._wakeup.release()
+		except Exception:
+			pass # it was already released, the writer will get to it
+
+	def flush(self):
+		"""Wait (up to FLUSH_TIMEOUT) until everything queued so far has been written and flushed"""
+		if self._stopping:
+			return
+		self._put(_FLUSH)
+		target = self.queued
+		deadline = time.time() + self.FLUSH_TIMEOUT
+		while self.written < target and time.time() < deadline:
+			time.sleep(0.01)
+
+	def close(self):
+		if self._stopping:
+			return
+		self.flush()
+		self._stopping = True
+		self._put(_FLUSH)
+		self._stopped.acquire()
+		for handler in self.handlers:
+			handler.close()
+		super(QueueHandler, self).close()
+
+	def _run(self):
+		while True:
+			self._wakeup.acquire()
+			while self.queue:
+				item = self.queue.popleft()
+				if item is _FLUSH:
+					self._flush()
+				else:
+					self._write(item)
+				self.written += 1
+			if self.dropped > self._reported_dropped:
+				self._handle(logging.LogRecord(
+					__name__, logging.WARNING, __file__, 0,
+					"Log queue full, dropped {} records".format(self.dropped - self._reported_dropped),
+					None, None,
+				))
+				self._reported_dropped = self.dropped
+			if self._stopping:
+				self._stopped.release()
+				return
+
+	def _write(self, record):
+		key = record.name, record.levelno, record.pathname, record.lineno, record.msg
+		if key == self._last_key:
+			self._repeats += 1
+			self.suppressed += 1
+			return
+		self._write_repeats()
+		self._last_key, self._last = key, record
+		self._handle(record)
+
+	def _write_repeats(self):
+		if not self._repeats:
+			return
+		last = self._last
+		self._handle(logging.LogRecord(
+			last.name, last.levelno, last.pathname, last.lineno,
+			"Last message repeated {} times".format(self._repeats), None, None,
+		))
+		self._repeats = 0
+
+	def _flush(self):
+		self._write_repeats()
+		# a repeat after a flush should still be written, so it's clear it happened after anything in between
+		self._last_key = None
+		for handler in self.handlers:
+			try:
+				handler.flush()
+			except Exception:
+				pass
+
+	def _handle(self, record):
+		for handler in self.handlers:
+			if record.levelno < handler.level or not handler.filter(record):
+				continue
+			try:
+				handler.emit(record)
+			except Exception:
+				handler.handleError(record)
@@ -1,18 +1,29 @@
 import gc
-import json
 import logging
 import os
 import signal
 import socket
 import sys
+import time
 
 import gevent
-from backoff import Backoff
-from girc import Client
+import gevent.event
+from girc import Client, Handler
+from girc.message import Message
 
+from ekimbot import handoff, supervisor
 from ekimbot.config import config
 from ekimbot.botplugin import BotPlugin, ClientPlugin
-from ekimbot.utils import list_modules
+from ekimbot.capture import CaptureWriter
+from ekimbot.connect import JitterBackoff, scheduler as connect_scheduler
+from ekimbot.commands import CommandIndex
+from ekimbot.discovery import PluginManifest
+from ekimbot.joins import parse_channel, join_batches
+from ekimbot.logqueue import QueueHandler
+from ekimbot.outbound import OutboundScheduler, PRIORITY_NORMAL
+from ekimbot.paging import MoreBuffer
+from ekimbot.stats import stats
+from ekimbot.store import Store
 
 RETRY_START = 1
 RETRY_LIMIT = 300
@@ -23,33 +34,74 @@ main_logger = logging.getLogger('ekimbot')
 # maps name to manager controlling client
 clients = {}
 
+# PluginManifest of all plugins in config.plugin_paths, set by main()
+plugin_manifest = None
+
+# when running as a worker process, our supervisor.ControlLink to the supervisor
+worker_link = None
+
 
 def main(**options):
+	global plugin_manifest, worker_link
+
+	profile = StartupProfile()
 	config.load(user_config=True, argv=True, env=True, **options)
 
 	configure_logging()
 	main_logger.info("Starting up")
 
-	for path in config.plugin_paths:
-		for plugin_name in list_modules(path):
-			BotPlugin.load(plugin_name)
-
-	for plugin in config.global_plugins:
-		main_logger.debug("Enable {}".format(plugin))
-		BotPlugin.enable(plugin)
-
-	if config.handoff_data:
-		# expects a dict { client name: {'fd': sock fd, **kwargs for from_handoff()}}
-		handoff_data = json.loads(config.handoff_data)
-		# json deals in unicode, we want bytes
-		for k, v in handoff_data.items():
-			if isinstance(v, unicode):
-				handoff_data[k] = v.encode('utf-8')
+	client_names = list(config.clients)
+	run_global_plugins = True
+	if config.worker_index is not None:
+		index, count = int(config.worker_index), int(config.worker_count)
+		control_fd = int(config.control_fd)
+		worker_link = supervisor.ControlLink(socket.fromfd(control_fd, socket.AF_UNIX, socket.SOCK_STREAM), on_control)
+		os.close(control_fd) # fromfd() dups the fd, so we no longer need the original
+		client_names = [name for name in client_names if supervisor.worker_for(name, count) == index]
+		run_global_plugins = index == 0
+		# Each worker only saves namespaces for its own clients (and global plugins in the first worker),
+		# which shared mode merges per namespace, so workers don't overwrite each other's changes.
+		if config.store_backend == 'json' and not config.store_shared:
+			main_logger.info("Using shared store, as other workers will also be using it")
+			config.store_shared = True
+		main_logger.info("Running as worker {} of {} with clients: {}".format(index, count, ', '.join(client_names)))
+	elif supervisor.worker_count() is not None:
+		supervisor.supervise(supervisor.worker_count())
+		return
+	profile.phase('config')
+
+	# plugin modules are only imported once a plugin they define is enabled
+	plugin_manifest = PluginManifest(config.plugin_paths, config.plugin_manifest_path, BotPlugin.load)
+	profile.phase('plugin discovery')
+
+	if config.handoff_fd:
+		# expects a dict as per handoff_all(), with client data {'fd': index into fds, **see ClientManager.handoff()}
+		state, fds = handoff.receive(int(config.handoff_fd))
+		os.environ.pop('handoff_fd', None) # don't pass it on to any children
+		handoff_data = state['clients']
+		for data in handoff_data.values():
+			data['fd'] = fds[data['fd']]
+		Store.set_handoff_state(state['stores'])
+		plugin_states = state['plugins']
 	else:
 		handoff_data = {}
-
-	for name in config.clients:
-		ClientManager.spawn(name, handoff_data=handoff_data.get(name))
+		plugin_states = {}
+	profile.phase('handoff')
+
+	# with multiple workers, global plugins only run in the first
+	if run_global_plugins:
+		for plugin in config.global_plugins:
+			main_logger.debug("Enable {}".format(plugin))
+			plugin_manifest.require(plugin)
+			BotPlugin.enable(plugin)
+		set_plugin_states(global_plugins(), plugin_states, main_logger)
+	profile.phase('global plugins')
+
+	# highest weight first, so they get the first connection slots
+	client_names.sort(key=lambda name: -config.clients_with_defaults[name].get('weight', 1))
+	managers = [ClientManager.spawn(name, handoff_data=handoff_data.get(name)) for name in client_names]
+	if config.profile_startup:
+		gevent.spawn(profile.report, managers)
 
 	def term(sig, frame):
 		raise KeyboardInterrupt
@@ -66,6 +118,8 @@ def main(**options):
 				manager.stop('Shutting down')
 			for manager in clients.values():
 				manager.get()
+		finally:
+			Store.flush_all()
 	except BaseException:
 		main_logger.exception("Failed to stop cleanly")
 		raise
@@ -77,7 +131,7 @@ def configure_logging():
 	"""Set handlers and level on root logger as per config options.
 	Will remove any existing handlers."""
 	root = logging.getLogger()
-	for handler in root.handlers:
+	for handler in list(root.handlers):
 		root.removeHandler(handler)
 
 	loglevel = config.loglevel
@@ -85,44 +139,159 @@ def configure_logging():
 		loglevel = logging._levelNames[loglevel.upper()]
 	root.setLevel(loglevel)
 
+	log_format = logging.BASIC_FORMAT
+	if config.worker_index is not None:
+		log_format = "[worker {}] {}".format(config.worker_index, log_format)
 	handlers = [logging.StreamHandler()]
 	if config.logfile:
 		handlers.append(logging.FileHandler(config.logfile))
 	for handler in handlers:
-		handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+		handler.setFormatter(logging.Formatter(log_format))
+	if config.log_queue_size:
+		handlers = [QueueHandler(handlers, config.log_queue_size)]
+	for handler in handlers:
 		root.addHandler(handler)
 
 
+def flush_logging():
+	"""Make sure all logs so far have been written"""
+	for handler in logging.getLogger().handlers:
+		handler.flush()
+
+
+class StartupProfile(object):
+	"""Records how long each phase of startup takes, for the profile_startup option"""
+
+	# how long to wait for clients to start before reporting anyway
+	CLIENT_TIMEOUT = 60
+
+	def __init__(self):
+		self.phases = [] # [(name, seconds)]
+		self.last = time.time()
+
+	def phase(self, name):
+		"""Mark the end of the named phase, which began at the end of the previous one"""
+		now = time.time()
+		self.phases.append((name, now - self.last))
+		self.last = now
+
+	def report(self, managers):
+		"""Wait for the given ClientManagers to start their clients, then log the profile"""
+		for manager in managers:
+			manager.started.wait(max(0, self.last + self.CLIENT_TIMEOUT - time.time()))
+		self.phase('clients started')
+		lines = ["Startup profile:"]
+		lines += ["{:>8.3f}s {}".format(duration, name) for name, duration in self.phases]
+		lines.append("{:>8.3f}s total".format(sum(duration for name, duration in self.phases)))
+		import_times = sorted(plugin_manifest.import_times.items(), key=lambda (module, duration): -duration)
+		lines.append("Imported {} of {} plugin modules:".format(len(import_times), len(plugin_manifest.modules)))
+		lines += ["{:>8.3f}s {}".format(duration, module) for module, duration in import_times]
+		main_logger.info('\n'.join(lines))
+
+
+def global_plugins():
+	return {plugin for plugin in BotPlugin.enabled if not isinstance(plugin, ClientPlugin)}
+
+
+def get_plugin_states(plugins, logger):
+	"""Returns {plugin key: state} for each plugin that has state to hand off"""
+	# plugin instances are identified by their store key, which is unique to that plugin, client and channel
+	states = {}
+	for plugin in plugins:
+		try:
+			state = plugin.get_handoff_state()
+		except Exception:
+			logger.warning("Failed to get handoff state from plugin {}".format(plugin.name), exc_info=True)
+			continue
+		if state is not None:
+			states[plugin._store_key] = state
+	return states
+
+
+def set_plugin_states(plugins, states, logger):
+	"""Pass states from get_plugin_states() in the old process to the matching plugins"""
+	for plugin in plugins:
+		if plugin._store_key not in states:
+			continue
+		try:
+			plugin.set_handoff_state(states[plugin._store_key])
+		except Exception:
+			logger.warning("Failed to restore handoff state for plugin {}".format(plugin.name), exc_info=True)
+
+
+def on_control(op, **args):
+	"""Handle an operation sent to this worker by the supervisor"""
+	if op == 'handoff':
+		gevent.spawn(handoff_all)
+	elif op == 'stop' or op is None:
+		# None means the supervisor has gone away, so we should too.
+		# We signal ourselves so that main() does a normal shutdown.
+		os.kill(os.getpid(), signal.SIGTERM)
+
+
+def restart_all():
+	"""Restart the bot, handing off all connections.
+	With multiple workers, this asks the supervisor to restart all workers."""
+	if worker_link is not None:
+		worker_link.send('handoff')
+	else:
+		handoff_all()
+
+
+def stop_all():
+	"""Stop the bot. With multiple workers, this asks the supervisor to stop all workers."""
+	if worker_link is not None:
+		worker_link.send('stop')
+	else:
+		sys.exit()
+
+
 def handoff_all():
 	main_logger.info("Preparing to re-exec with handoffs")
 
+	# prepare all clients at once, since each may need to wait for its connection to quiesce
+	managers = clients.items()
+	preparations = [gevent.spawn(manager.handoff) for name, manager in managers]
+	gevent.joinall(preparations)
+
 	handoff_data = {}
-	for name, manager in clients.items():
-		data = manager.handoff()
+	fds = []
+	for (name, manager), preparation in zip(managers, preparations):
+		data = preparation.value
 		if data:
+			fds.append(data['fd'])
+			data['fd'] = len(fds) - 1
 			handoff_data[name] = data
 
-	main_logger.info("Final handoff data: {!r}".format(handoff_data))
+	main_logger.info("Final handoff data for clients: {}".format(', '.join(handoff_data)))
 
-	for manager in clients.values():
+	for name, manager in managers:
 		manager.get()
 
 	main_logger.info("All managers stopped")
 
-	# TODO this will fail if the bytes contain invalid utf-8
-	handoff_data_str = json.dumps(handoff_data)
+	Store.flush_all()
+
+	state = {
+		'clients': handoff_data,
+		'plugins': get_plugin_states(global_plugins(), main_logger),
+		'stores': Store.get_handoff_state(),
+	}
+	handoff_fd = handoff.send(state, fds)
+	for fd in fds:
+		os.close(fd)
 	env = os.environ.copy()
-	env['handoff_data'] = handoff_data_str
+	env['handoff_fd'] = str(handoff_fd)
+	keep_fds = [handoff_fd]
+	if worker_link is not None:
+		env['control_fd'] = str(worker_link.fileno())
+		keep_fds.append(worker_link.fileno())
 	main_logger.info("Calling execve({!r}, {!r}, {!r})".format(sys.executable, sys.argv, env))
+	flush_logging() # anything still queued would be lost
 
 	# critical section - absolutely no blocking calls beyond this point
 	gc.disable() # we don't want any destructors running
-	open_fds = set(map(int, os.listdir('/proc/self/fd')))
-	for fd in open_fds - {0, 1, 2} - set(data['fd'] for data in handoff_data.values()):
-		try:
-			os.close(fd)
-		except OSError:
-			pass # this is probably EBADF, but even if it isn't we can't do anything about it
+	handoff.close_fds(keep=keep_fds)
 	os.execve(sys.executable, [sys.executable, '-m', 'ekimbot'] + sys.argv[1:], env)
 
 
@@ -132,6 +301,9 @@ class ClientManager(gevent.Greenlet):
 
 	INIT_ARGS = {'hostname', 'nick', 'port', 'password', 'ident', 'real_name', 'twitch'}
 
+	# how long to wait for the server to accept our registration before letting other clients connect
+	CONNECT_TIMEOUT = 60
+
 	client = None
 	_can_signal = False # indicates if main loop is in good state to get a stop/restart
 	_stop = False # indicates to quit after next client quit
@@ -142,6 +314,7 @@ class ClientManager(gevent.Greenlet):
 	def __init__(self, name, handoff_data=None):
 		self.name = name
 		self.handoff_data = handoff_data
+		self.started = gevent.event.Event() # set once the client has first started
 		self.logger = main_logger.getChild(name)
 		super(ClientManager, self).__init__()
 
@@ -163,15 +336,16 @@ class ClientManager(gevent.Greenlet):
 
 	def handoff(self):
 		"""Gracefully shut down and prepare for handoff.
-		This stops the client and returns a dict suitable to pass as config.handoff_data[name]
-		to a child or re-exec()ed process.
+		This stops the client and returns a dict to be passed (via handoff.send()) to the
+		ClientManager of the same name in a child or re-exec()ed process.
 		However, if the client is not currently in a good state for handoff (eg. it is currently restarting)
 		this method will still stop the client manager, but will return None. In this case,
 		there was no state to handoff so the best thing to do is let the child re-create a new client.
 		"""
-		# Note this method intentionally leaks an fd so we can't accidentially close it
-		# due to destructors. This fd is then passed onto the child / re-exec()ed process.
+		# Note this method returns a dup()ed fd so we can't accidentially close it due to destructors.
+		# The caller is responsible for passing it on to the new process, then closing it.
 		self.logger.info("Attempting to handoff")
+		start = time.time()
 
 		if not self._can_signal:
 			self.logger.info("Handoff aborted - client is not running")
@@ -190,9 +364,17 @@ class ClientManager(gevent.Greenlet):
 
 		data = self.client._get_handoff_data()
 		data['fd'] = os.dup(self.client._socket.fileno())
+		data['family'] = self.client._socket.family
 		self.logger.info("Handoff initiated with data {!r}".format(data))
+		# this must be collected before _finalize_handoff(), which disables the plugins
+		data['isupport'] = self.client.isupport
+		data['channel_users'] = self.client.get_channel_state()
+		data['plugin_states'] = get_plugin_states(self.client.plugins, self.logger)
 		# this will gracefully stop, which will cause the main loop to exit
 		self.client._finalize_handoff()
+		# from here on, nothing is reading from the connection until the new process takes over
+		data['stopped_at'] = time.time()
+		self.logger.info("Handoff prepared in {:.3f}s".format(data['stopped_at'] - start))
 
 		return data
 
@@ -212,7 +394,7 @@ class ClientManager(gevent.Greenlet):
 		clients[self.name] = self
 
 		try:
-			self.retry_timer = Backoff(RETRY_START, RETRY_LIMIT, RETRY_FACTOR)
+			self.retry_timer = JitterBackoff(RETRY_START, RETRY_LIMIT)
 
 			while not self._stop:
 				if self.name not in config.clients_with_defaults:
@@ -223,40 +405,79 @@ class ClientManager(gevent.Greenlet):
 				channels = options.get('channels', [])
 				plugins = self._parse_config_plugins()
 
+				handoff_stopped_at = None
+				connecting = not self.handoff_data
+				plugin_states = {}
+				restored_channels = set()
+				plugin_setup = None
+				joiner = None
 				try:
 					if self.handoff_data:
-						self.logger.info("Accepting handoff with data {!r}".format(self.handoff_data))
-						client_sock = socket.fromfd(self.handoff_data.pop('fd'), socket.AF_INET, socket.SOCK_STREAM)
-						self.client = EkimbotClient._from_handoff(client_sock, name=self.name, logger=self.logger, **self.handoff_data)
-						self.handoff_data = None
+						handoff_data, self.handoff_data = self.handoff_data, None
+						isupport = handoff_data.pop('isupport', {})
+						channel_users = handoff_data.pop('channel_users', {})
+						plugin_states = handoff_data.pop('plugin_states', {})
+						self.logger.info("Accepting handoff with data {!r}".format(handoff_data))
+						fd = handoff_data.pop('fd')
+						family = handoff_data.pop('family', socket.AF_INET)
+						handoff_stopped_at = handoff_data.pop('stopped_at', None)
+						client_sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+						os.close(fd) # fromfd() dups the fd, so we no longer need the original
+						self.client = EkimbotClient._from_handoff(client_sock, name=self.name, logger=self.logger, **handoff_data)
+						# the server only sends this on connect, so we won't see it again
+						self.client.isupport.update(isupport)
+						self.client.ready.set()
+						try:
+							restored_channels = self.client.set_channel_state(channel_users)
+						except Exception:
+							# not fatal, we'll just have to re-join and get the user lists from the server
+							self.logger.warning("Failed to restore channel state from handoff", exc_info=True)
 					else:
 						self.logger.info("Starting client")
+						connect_scheduler.mark_disconnected(self.name)
 						self.client = EkimbotClient(self.name,
 						                            logger=self.logger,
 						                            **{key: options[key] for key in self.INIT_ARGS if key in options})
 
-					self.logger.info("Enabling {} plugins".format(len(plugins)))
-					for plugin, args in plugins:
-						self.logger.debug("Enabling plugin {} with args {}".format(plugin, args))
-						ClientPlugin.enable(plugin, self.client, *args)
-
-					self.logger.info("Joining {} channels".format(len(channels)))
-					for channel in channels:
-						self.logger.debug("Joining channel {}".format(channel))
-						self.client.channel(channel).join()
+					plugin_setup = gevent.spawn(self._enable_plugins, self.client, plugins, plugin_states)
 
 					try:
 						self._can_signal = True
-						self.client.start()
+						if connecting:
+							# plugins are set up while we wait to connect
+							self._connect(options)
+						else:
+							# the connection is already up, so plugins must be ready before we read anything from it
+							plugin_setup.get()
+							self.client.start()
+						# channels restored from handoff are still joined, no need to ask the server again
+						channels = [parse_channel(channel) for channel in channels]
+						channels = [(name, key) for name, key in channels if name not in restored_channels]
+						if channels:
+							joiner = gevent.spawn(self._join_channels, self.client, channels, restored_channels)
+						plugin_setup.get()
 						self.logger.debug("Client started")
+						self.started.set()
+						if handoff_stopped_at is not None:
+							self.logger.info("Handoff complete, connection was unattended for {:.3f}s".format(
+								time.time() - handoff_stopped_at
+							))
 						self.retry_timer.reset()
 						self.client.wait_for_stop()
 						self.logger.info("Client exited cleanly, not re-connecting")
 						break
 					finally:
 						self._can_signal = False
+						# if we never registered, this is still waiting for client.ready
+						if joiner is not None:
+							joiner.kill(block=False)
+						self.client.close_capture()
 
 				except Exception as ex:
+					if plugin_setup is not None:
+						plugin_setup.kill(block=False)
+					# we're disconnected from here until we're next ready, including while we wait to retry
+					connect_scheduler.mark_disconnected(self.name)
 					if isinstance(ex, self._Restart):
 						self.logger.info("Client gracefully restarting: {}".format(ex))
 						try:
@@ -274,13 +495,75 @@ class ClientManager(gevent.Greenlet):
 			raise
 
 		finally:
+			connect_scheduler.forget(self.name)
 			assert clients[self.name] is self
 			del clients[self.name]
 
+	def _enable_plugins(self, client, plugins, plugin_states):
+		self.logger.info("Enabling {} plugins".format(len(plugins)))
+		for plugin, args in plugins:
+			self.logger.debug("Enabling plugin {} with args {}".format(plugin, args))
+			plugin_manifest.require(plugin)
+			ClientPlugin.enable(plugin, client, *args)
+		set_plugin_states(client.plugins, plugin_states, self.logger)
+
+	def _join_channels(self, client, channels, joined):
+		"""Join channels, a list of (name, key or None), in as few lines as the server's limits allow.
+		Waits until registration is complete, so we know those limits. Lines are sent via the outbound
+		scheduler so they are paced like any other messages.
+		Note this relies on girc tracking a channel as soon as client.channel() creates it, as channel.join()
+		does before sending its own single-channel JOIN, so that the server's JOIN replies update its state.
+		Runs until done or killed by _run() when the client stops."""
+		client.ready.wait()
+		batches, skipped = join_batches(channels, client.isupport, joined)
+		if skipped:
+			self.logger.warning("Not joining {} channels as we would be over the server's limit: {}".format(
+				len(skipped), ', '.join(skipped)
+			))
+		self.logger.info("Joining {} channels in {} lines".format(len(channels) - len(skipped), len(batches)))
+		for name, key in channels:
+			if name not in skipped:
+				client.channel(name)
+		for names, keys in batches:
+			params = [names, keys] if keys else [names]
+			client.outbound.send(Message(client, 'JOIN', *params), PRIORITY_NORMAL, target='JOIN')
+
+	def _connect(self, options):
+		"""Start the client once connect_scheduler allows it, and wait until the server accepts our registration
+		(or the client fails, or CONNECT_TIMEOUT), so the next client doesn't connect while we're still registering"""
+		def wait_for_stop():
+			try:
+				self.client.wait_for_stop()
+			except Exception:
+				pass # the main loop will get the same error
+
+		network = options.get('network') or options['hostname']
+		with connect_scheduler.slot(network, options.get('weight', 1)):
+			start = time.time()
+			self.client.start()
+			stopped = gevent.spawn(wait_for_stop)
+			try:
+				gevent.wait([self.client.ready, stopped], count=1, timeout=self.CONNECT_TIMEOUT)
+				failed = stopped.ready()
+			finally:
+				stopped.kill(block=False)
+			ready = self.client.ready.is_set()
+			stats.timer('connect', self.name).observe(time.time() - start, error=not ready)
+		# note connect_scheduler.mark_connected() is called by the client once it's ready, even if that's after we stop waiting
+		if not ready and not failed:
+			self.logger.warning("Server has not accepted registration after {}s".format(self.CONNECT_TIMEOUT))
+
 
 class EkimbotClient(Client):
 	"""A girc Client with some ekimbot specialization"""
 
+	_command_index = None
+	_outbound = None
+	_more_buffer = None
+	_isupport = None
+	_capture = None
+	_ready = None
+
 	def __init__(self, name, **options):
 		self.name = name
 		super(EkimbotClient, self).__init__(**options)
@@ -289,10 +572,116 @@ class EkimbotClient(Client):
 	def config(self):
 		return config.clients_with_defaults.get(self.name, {})
 
+	@property
+	def command_index(self):
+		"""The CommandIndex used to dispatch CommandHandlers for this client"""
+		if self._command_index is None:
+			self._command_index = CommandIndex(self)
+		return self._command_index
+
+	@property
+	def outbound(self):
+		"""The OutboundScheduler that paces messages sent by plugins, as per the "flood" option"""
+		if self._outbound is None:
+			self._outbound = OutboundScheduler(self, **self.config.get('flood', {}))
+		return self._outbound
+
+	@property
+	def more_buffer(self):
+		"""The MoreBuffer holding paged output, as per the "paging" option"""
+		if self._more_buffer is None:
+			options = self.config.get('paging', {})
+			self._more_buffer = MoreBuffer(options.get('buffer_size', 100), options.get('expiry', 600))
+		return self._more_buffer
+
+	@property
+	def isupport(self):
+		"""Dict of features the server advertised with ISUPPORT (005), eg. {'MONITOR': '100', 'NICKLEN': '30'}.
+		Features without a value map to True."""
+		if self._isupport is None:
+			self._isupport = {}
+		return self._isupport
+
+	@property
+	def capture(self):
+		"""The CaptureWriter recording inbound traffic as per the "capture" option, or None"""
+		if self._capture is None:
+			options = self.config.get('capture')
+			if options:
+				options = dict(options)
+				path = options.pop('path').format(name=self.name)
+				self._capture = CaptureWriter(path, **options)
+			else:
+				self._capture = False
+		return self._capture or None
+
+	def close_capture(self):
+		if self._capture:
+			self._capture.close()
+
+	@property
+	def ready(self):
+		"""Event which is set once registration is complete, ie. the server has sent the welcome,
+		ISUPPORT and MOTD (or that there is no MOTD)"""
+		if self._ready is None:
+			self._ready = gevent.event.Event()
+		return self._ready
+
+	@Handler(command='376')
+	def _recv_end_of_motd(self, client, msg):
+		self._set_ready()
+
+	@Handler(command='422')
+	def _recv_no_motd(self, client, msg):
+		self._set_ready()
+
+	def _set_ready(self):
+		self.ready.set()
+		connect_scheduler.mark_connected(self.name)
+
+	@Handler()
+	def _count_message(self, client, msg):
+		stats.client(self.name).messages_in.mark()
+
+	def _process(self, line):
+		# capture each line exactly as received, before girc parses it
+		if self.capture:
+			self.capture.write(line.rstrip('\r\n'))
+		return super(EkimbotClient, self)._process(line)
+
+	@Handler(command='005')
+	def _recv_isupport(self, client, msg):
+		# params are our nick, then the features, then "are supported by this server"
+		for feature in msg.params[1:-1]:
+			if feature.startswith('-'):
+				self.isupport.pop(feature[1:], None)
+			elif '=' in feature:
+				key, value = feature.split('=', 1)
+				self.isupport[key] = value
+			else:
+				self.isupport[feature] = True
+
 	@property
 	def plugins(self):
 		return {plugin for plugin in ClientPlugin.enabled if plugin.client is self}
 
+	def get_channel_state(self):
+		"""Returns {channel name: user list} for each channel we have a complete user list for"""
+		return {
+			name: channel.users.users
+			for name, channel in self._channels.items()
+			if channel.users_ready.is_set()
+		}
+
+	def set_channel_state(self, state):
+		"""Restore channel user lists from get_channel_state() of the client we are taking over from.
+		Returns the set of channel names restored."""
+		for name, users in state.items():
+			channel = self.channel(name)
+			channel.users.users = users
+			channel.users_ready.set()
+		return set(state)
+
 	def restart(self, message):
 		if clients[self.name].client is not self:
 			# this Client is not the active client - this is a weird situation, let's do nothing
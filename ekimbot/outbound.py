@@ -0,0 +1,165 @@
+"""Flood control for messages sent by the bot"""
+
+import time
+from collections import deque, OrderedDict
+
+import gevent.event
+from girc.message import Privmsg, Notice
+
+from ekimbot.stats import stats
+
+
+# Priority classes for queued messages, highest first.
+# Protocol messages (eg. PONG) are sent by girc directly and never queued, so they always go out first.
+PRIORITY_ADMIN = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITIES = (PRIORITY_ADMIN, PRIORITY_NORMAL, PRIORITY_BULK)
+PRIORITY_NAMES = {PRIORITY_ADMIN: 'admin', PRIORITY_NORMAL: 'normal', PRIORITY_BULK: 'bulk'}
+
+
+class TokenBucket(object):
+	"""Allows an average of rate units per second, in bursts of up to burst units.
+	A rate of None means no limit."""
+
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last = time.time()
+
+	def _refill(self):
+		now = time.time()
+		self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+		self.last = now
+
+	def wait_time(self, amount):
+		"""Returns how long in seconds until amount units may be taken.
+		Amounts larger than the burst size are treated as the burst size."""
+		if self.rate is None:
+			return 0
+		self._refill()
+		amount = min(amount, self.burst)
+		if self.tokens >= amount:
+			return 0
+		return (amount - self.tokens) / float(self.rate)
+
+	def take(self, amount):
+		if self.rate is None:
+			return
+		self._refill()
+		self.tokens -= min(amount, self.burst)
+
+
+class OutboundScheduler(object):
+	"""Per-client queue for outgoing messages, which paces them to avoid being flood-killed by the server.
+	Messages are limited by two token buckets, one counting lines and one counting bytes.
+	Each priority class is served strictly before lower ones. Within a class, targets are served
+	round-robin so that a lot of output to one target can't hold up replies to others.
+	Each target's queue holds at most max_queue messages, further messages are dropped.
+	"""
+
+	def __init__(self, client, lines_per_second=1, line_burst=5, bytes_per_second=512, byte_burst=2048, max_queue=100):
+		self.client = client
+		self.lines = TokenBucket(lines_per_second, line_burst)
+		self.bytes = TokenBucket(bytes_per_second, byte_burst)
+		self.max_queue = max_queue
+		# {priority: {target: deque of messages}}, with targets in round-robin order
+		self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+		self.sent = 0
+		self.sent_bytes = 0
+		self.dropped = 0
+		self.max_depth = 0
+		self._wakeup = gevent.event.Event()
+		self._worker = None
+
+	def send(self, message, priority=PRIORITY_NORMAL, target=None):
+		"""Queue a girc Message to be sent. Messages are fairly queued by target,
+		messages with no target given share a single queue."""
+		queue = self.queues[priority].setdefault(target, deque())
+		if len(queue) >= self.max_queue:
+			self.dropped += 1
+			self.client.logger.debug("Outbound queue for {!r} full, dropping message".format(target))
+			return
+		queue.append(message)
+		self.max_depth = max(self.max_depth, self.depth)
+		if self._worker is None:
+			self._worker = self.client._group.spawn(self._run)
+		self._wakeup.set()
+
+	def msg(self, target, text, priority=PRIORITY_NORMAL, notice=False):
+		"""Queue a PRIVMSG (or NOTICE if notice=True) to target"""
+		message_type = Notice if notice else Privmsg
+		self.send(message_type(self.client, target, text), priority, target)
+
+	@property
+	def depth(self):
+		"""Total number of queued messages"""
+		return sum(self.depth_by_priority().values())
+
+	def depth_by_priority(self):
+		"""Returns {priority name: number of queued messages}"""
+		return {
+			PRIORITY_NAMES[priority]: sum(len(queue) for queue in queues.values())
+			for priority, queues in self.queues.items()
+		}
+
+	def _head(self):
+		"""Returns (queues, target) for the next message to send, or None if nothing is queued"""
+		for priority in PRIORITIES:
+			queues = self.queues[priority]
+			if queues:
+				target = next(iter(queues))
+				return queues, target
+		return None
+
+	def _run(self):
+		try:
+			self._send_loop()
+		finally:
+			# so that send() starts a new worker if we died
+			self._worker = None
+
+	def _send_loop(self):
+		while True:
+			head = self._head()
+			if head is None:
+				self._wakeup.clear()
+				self._wakeup.wait()
+				continue
+			queues, target = head
+			queue = queues[target]
+			message = queue[0]
+			try:
+				size = len(message.encode()) + 2 # for the trailing \r\n
+			except Exception:
+				self.client.logger.exception("Failed to encode outbound message, dropping it")
+				self._pop(queues, target)
+				self.dropped += 1
+				continue
+			wait = max(self.lines.wait_time(1), self.bytes.wait_time(size))
+			if wait:
+				# re-check afterwards, as something more important may have been queued in the meantime
+				gevent.sleep(wait)
+				continue
+			self._pop(queues, target)
+			self.lines.take(1)
+			self.bytes.take(size)
+			try:
+				message.send()
+			except Exception:
+				self.client.logger.exception("Failed to send outbound message, dropping it")
+				self.dropped += 1
+				continue
+			self.sent += 1
+			self.sent_bytes += size
+			stats.client(self.client.name).messages_out.mark()
+
+	def _pop(self, queues, target):
+		"""Remove the message at the head of target's queue"""
+		queue = queues[target]
+		queue.popleft()
+		# move target to the back of the round-robin order, or remove it if it has nothing left
+		del queues[target]
+		if queue:
+			queues[target] = queue
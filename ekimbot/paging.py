@@ -0,0 +1,147 @@
+"""Coalescing of multi-line replies, and paging of long output with a "more" command"""
+
+import time
+from collections import deque, namedtuple, OrderedDict
+
+from ekimbot.hostmask import irc_lower
+from ekimbot.outbound import PRIORITY_NORMAL
+from ekimbot.utils import reply_target
+
+
+# Remaining output for a (target, sender), both lowercased.
+# lines is a deque of packed lines still to send, the rest are as per reply_lines()
+Page = namedtuple('Page', ['target', 'lines', 'notice', 'priority', 'max_lines', 'line_length'])
+
+
+def _length(s):
+	return len(s.encode('utf-8')) if isinstance(s, unicode) else len(s)
+
+
+def max_text_length(client, target):
+	"""The longest text that can safely be sent to target in one line.
+	This is 512 bytes, less the trailing \r\n, the command and the prefix the server adds
+	when relaying (":nick!user@host "), for which we allow a generous 64 bytes of user@host."""
+	return 510 - len('PRIVMSG {} :'.format(target)) - (len(client.nick) + 64 + 3)
+
+
+def split_line(line, length):
+	"""Split a line into parts of at most length bytes, on whitespace where possible.
+	Lengths are of the utf-8 encoding for unicode lines, and parts are never cut inside a utf-8 character."""
+	data = line.encode('utf-8') if isinstance(line, unicode) else line
+	parts = []
+	while len(data) > length:
+		cut = data.rfind(' ', 0, length + 1)
+		if cut <= 0:
+			cut = length
+			# back off to the start of any multi-byte character we would cut in half
+			while cut > 0 and 0x80 <= ord(data[cut]) < 0xc0:
+				cut -= 1
+			if cut == 0:
+				cut = length # not utf-8, so cut anywhere
+		parts.append(data[:cut].rstrip())
+		data = data[cut:].lstrip()
+	parts.append(data)
+	if isinstance(line, unicode):
+		parts = [part.decode('utf-8') for part in parts]
+	return parts
+
+
+def pack_lines(lines, length, separator=' | '):
+	"""Pack a list of short lines into as few lines of at most length bytes as possible,
+	joining them with separator. Lines that are too long on their own are split."""
+	packed = []
+	current = None
+	for line in lines:
+		for part in split_line(line, length):
+			if current is not None and _length(current) + _length(separator) + _length(part) <= length:
+				current += separator + part
+			else:
+				if current is not None:
+					packed.append(current)
+				current = part
+	if current is not None:
+		packed.append(current)
+	return packed
+
+
+class MoreBuffer(object):
+	"""A bounded LRU of Pages waiting for a "more" command, keyed by (target, sender).
+	Entries expire after expiry seconds."""
+
+	def __init__(self, max_entries=100, expiry=600):
+		self.max_entries = max_entries
+		self.expiry = expiry
+		self.entries = OrderedDict() # {key: (time added, page)}, oldest first
+
+	def put(self, key, page):
+		self.entries.pop(key, None)
+		self.entries[key] = time.time(), page
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def pop(self, key):
+		"""Remove and return the page for key, or None"""
+		self._expire()
+		entry = self.entries.pop(key, None)
+		return None if entry is None else entry[1]
+
+	def _expire(self):
+		cutoff = time.time() - self.expiry
+		while self.entries:
+			added, page = next(self.entries.itervalues())
+			if added > cutoff:
+				break
+			self.entries.popitem(last=False)
+
+
+def reply_lines(client, msg, lines, max_lines=None, target=None, notice=False, priority=None):
+	"""Reply to msg with multiple lines of output, packing them into as few IRC lines as possible.
+	At most max_lines lines are sent (default from the client's "paging" option). The rest is kept
+	for the sender to get with the "more" command.
+	target defaults to the normal reply target (see utils.reply_target). If notice is True, send NOTICEs
+	instead of PRIVMSGs. priority is as per utils.reply().
+	"""
+	if target is None:
+		target = reply_target(client, msg)
+	if priority is None:
+		priority = msg.extra.get('reply_priority', PRIORITY_NORMAL)
+	options = client.config.get('paging', {})
+	if max_lines is None:
+		max_lines = options.get('max_lines', 3)
+	line_length = options.get('line_length') or max_text_length(client, target)
+	page = Page(target, deque(pack_lines(lines, line_length)), notice, priority, max_lines, line_length)
+	send_page(client, (irc_lower(target), irc_lower(msg.sender)), page)
+
+
+def reply_more(client, msg):
+	"""Send the next page of output for msg's sender, if any. Returns whether there was any.
+	Output sent where msg was sent takes precedence, otherwise output that was sent to the sender directly
+	(eg. longhelp) is continued, so "more" works from a channel for that too."""
+	sender = irc_lower(msg.sender)
+	for key in ((irc_lower(reply_target(client, msg)), sender), (sender, sender)):
+		page = client.more_buffer.pop(key)
+		if page is not None:
+			send_page(client, key, page)
+			return True
+	return False
+
+
+def send_page(client, key, page):
+	"""Send the next max_lines lines of page, and keep the rest (if any) for "more"."""
+	# any older output for this key is replaced
+	client.more_buffer.pop(key)
+	lines = [page.lines.popleft() for _ in range(min(page.max_lines, len(page.lines)))]
+	if page.lines:
+		# lazy import to break cyclic dependency
+		from ekimbot.botplugin import ClientPlugin
+		if ClientPlugin.get_plugin('more', client):
+			client.more_buffer.put(key, page)
+			hint = "(+{} more, use {}more)".format(len(page.lines), client.config['command_prefix'])
+		else:
+			hint = "(+{} more not shown)".format(len(page.lines))
+		if lines and _length(lines[-1]) + 1 + _length(hint) <= page.line_length:
+			lines[-1] += ' ' + hint
+		else:
+			lines.append(hint)
+	for line in lines:
+		client.outbound.msg(page.target, line, page.priority, notice=page.notice)
@@ -0,0 +1,158 @@
+"""A sampling profiler for the whole process, see the "profiler" core plugin.
+
+A native (not gevent) thread periodically takes the stack of whatever is running on the main thread,
+and of every suspended greenlet (including the hub), and counts how often each distinct stack is seen.
+Stacks are written out in the "collapsed" format used by flamegraph tools, eg. flamegraph.pl or speedscope.
+Each stack begins with "[running]" or "[waiting]", followed by "[plugin NAME]" if it's inside
+a plugin method (see ekimbot.frames), so the cost of each plugin is easy to pick out.
+"""
+
+import gc
+import os
+import sys
+import time
+import weakref
+
+import gevent
+import gevent.event
+import greenlet
+from gevent.monkey import get_original
+
+from ekimbot.frames import frame_owner
+
+
+start_new_thread, get_ident = get_original('thread', ['start_new_thread', 'get_ident'])
+real_sleep = get_original('time', 'sleep')
+
+# stands in for any stack not counted because max_stacks was reached
+TRUNCATED = ('[truncated]',)
+
+
+def frame_label(code):
+	return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler(object):
+	"""Only one profile may run at a time. Results are kept until the next start().
+	Memory use is bounded: at most max_stacks distinct stacks, each at most max_depth frames, are kept.
+	"""
+	# how often to look for new greenlets, in seconds
+	GREENLET_REFRESH = 1
+
+	def __init__(self):
+		self.running = False
+		self.finished = gevent.event.Event()
+		self.finished.set()
+		self.stacks = {}
+		self.samples = 0
+		self.started_at = None
+		self.duration = None
+
+	def start(self, duration, rate=100, max_stacks=10000, max_depth=100, waiting=True):
+		"""Sample rate times per second for duration seconds. If waiting is False, only the running stack is sampled."""
+		if self.running:
+			raise ValueError("Profiler is already running")
+		self.stacks = {}
+		self.samples = 0
+		self.started_at = time.time()
+		self.duration = duration
+		self.interval = 1. / rate
+		self.max_stacks = max_stacks
+		self.max_depth = max_depth
+		self.waiting = waiting
+		self.main_thread = get_ident()
+		self.running = True
+		self.finished.clear()
+		self._done = gevent.get_hub().loop.async_()
+		self._done.start(self._on_done)
+		start_new_thread(self._run, ())
+
+	def stop(self):
+		"""Stop early. The profiler finishes asynchronously, use wait() if you need the results."""
+		self.running = False
+
+	def wait(self, timeout=None):
+		return self.finished.wait(timeout)
+
+	def _on_done(self):
+		self._done.stop()
+		self._done.close()
+		self.duration = time.time() - self.started_at
+		self.finished.set()
+
+	def _run(self):
+		"""Runs in a native thread. Must not touch anything that might use gevent."""
+		try:
+			greenlets = []
+			refreshed_at = None
+			deadline = self.started_at + self.duration
+			while self.running:
+				now = time.time()
+				if now >= deadline:
+					break
+				if self.waiting and (refreshed_at is None or now - refreshed_at >= self.GREENLET_REFRESH):
+					greenlets = [weakref.ref(obj) for obj in gc.get_objects() if isinstance(obj, greenlet.greenlet)]
+					refreshed_at = now
+				self._sample(greenlets)
+				real_sleep(self.interval)
+		finally:
+			self.running = False
+			self._done.send()
+
+	def _sample(self, greenlets):
+		self.samples += 1
+		frame = sys._current_frames().get(self.main_thread)
+		self._count('[running]', frame)
+		del frame
+		for ref in greenlets:
+			glet = ref()
+			# gr_frame is None for greenlets that are running (ie. the one we already sampled), not started or dead
+			frame = glet and glet.gr_frame
+			if frame is not None:
+				self._count('[waiting]', frame)
+			del glet, frame
+
+	def _count(self, state, frame):
+		if frame is None:
+			return
+		owner = frame_owner(frame)
+		codes = []
+		while frame is not None and len(codes) < self.max_depth:
+			codes.append(frame.f_code)
+			frame = frame.f_back
+		key = (state, owner and owner[0]) + tuple(reversed(codes))
+		if key not in self.stacks and len(self.stacks) >= self.max_stacks:
+			key = TRUNCATED
+		self.stacks[key] = self.stacks.get(key, 0) + 1
+
+	def collapsed(self):
+		"""Returns the results in the collapsed stack format, as a list of lines"""
+		lines = []
+		for key, count in self.stacks.items():
+			if key == TRUNCATED:
+				labels = list(key)
+			else:
+				state, plugin = key[:2]
+				labels = [state]
+				if plugin is not None:
+					labels.append("[plugin {}]".format(plugin))
+				labels += [frame_label(code) for code in key[2:]]
+			lines.append("{} {}".format(';'.join(label.replace(';', ',') for label in labels), count))
+		lines.sort()
+		return lines
+
+	def by_plugin(self):
+		"""Returns {plugin name or None: samples} for running stacks only, ie. where the CPU time went"""
+		result = {}
+		for key, count in self.stacks.items():
+			if key[0] == '[running]':
+				result[key[1]] = result.get(key[1], 0) + count
+		return result
+
+	def write(self, path):
+		with open(path, 'w') as f:
+			for line in self.collapsed():
+				f.write(line + '\n')
+
+
+profiler = Profiler()
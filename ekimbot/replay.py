@@ -0,0 +1,153 @@
+"""Replays traffic recorded with the "capture" client option against a bot, to reproduce and measure
+how it handled a real situation:
+	python -m ekimbot.replay [options] CAPTURE [CAPTURE ...]
+
+A single client is run against an in-process ekimbot.fakeserver, which sends it the captured lines
+either at the recorded speed (optionally sped up) or as fast as possible. Registration is done by the fake
+server, so the captured welcome and MOTD replies are skipped. The client's plugins and other options are
+taken from user config for the client given by --client, except for connection details, channels and flood limits.
+Channels are joined by replaying the captured JOINs.
+
+Afterwards, the time taken by every handler and command is reported, slowest (by total time) first.
+As with ekimbot.bench, --save and --compare record and check overall results.
+"""
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import sys
+import time
+
+import gevent
+
+from ekimbot import bench
+from ekimbot.capture import capture_files, read
+from ekimbot.config import config
+from ekimbot.fakeserver import FakeServer, parse_line
+from ekimbot.stats import stats, format_seconds
+
+
+# replies to registration, which the fake server sends itself
+SKIP_COMMANDS = {'001', '002', '003', '004', '375', '372', '376', '422'}
+
+# client options which make no sense against the fake server
+REPLACED_OPTIONS = {'hostname', 'port', 'password', 'twitch', 'channels', 'flood', 'capture'}
+
+
+def load_capture(paths):
+	"""Returns (nick, [(time, line)]) for the given capture files, where nick is the nick we had when registering
+	(or None if the capture doesn't include registration). A single path includes its rotated files."""
+	if len(paths) == 1:
+		paths = capture_files(paths[0])
+	nick = None
+	lines = []
+	for timestamp, line in read(paths):
+		command, params = parse_line(line)
+		if command in SKIP_COMMANDS:
+			if command == '001' and nick is None:
+				nick = params[0]
+			continue
+		lines.append((timestamp, line))
+	return nick, lines
+
+
+def replay(connection, lines, speed, batch):
+	"""Send lines to connection. If speed is None, as fast as possible, otherwise at speed times the recorded speed."""
+	if speed is None:
+		for i in range(0, len(lines), batch):
+			connection.send(*[line for timestamp, line in lines[i:i+batch]])
+			gevent.sleep(0)
+		return
+	start = time.time()
+	first = lines[0][0]
+	pending = []
+	for timestamp, line in lines:
+		delay = start + (timestamp - first) / speed - time.time()
+		if delay > 0 and pending:
+			connection.send(*pending)
+			pending = []
+		if delay > 0:
+			gevent.sleep(delay)
+		pending.append(line)
+	if pending:
+		connection.send(*pending)
+
+
+def main_cli(argv=None):
+	parser = argparse.ArgumentParser(description="Replay captured traffic against ekimbot")
+	parser.add_argument('captures', nargs='+', metavar='CAPTURE',
+		help="Capture files, oldest first. If only one is given, its rotated files are included.")
+	parser.add_argument('--client', help="Take options from this client in user config")
+	parser.add_argument('--nick', help="Nick to use, if the capture doesn't include registration")
+	parser.add_argument('--speed', type=float, default=None,
+		help="Replay at this multiple of the recorded speed, eg. 1 for real time. By default, replay as fast as possible.")
+	parser.add_argument('--batch', type=int, default=100, help="When replaying as fast as possible, lines to send at once")
+	parser.add_argument('--timeout', type=float, default=300)
+	parser.add_argument('--loglevel', default='WARNING')
+	parser.add_argument('--top', type=int, default=20, help="How many handlers to report")
+	parser.add_argument('--save', metavar='PATH', help="Save results to PATH as a baseline")
+	parser.add_argument('--compare', metavar='PATH', help="Compare results to the baseline at PATH")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="Fraction by which results may be worse than baseline")
+	options = parser.parse_args(argv)
+
+	nick, lines = load_capture(options.captures)
+	nick = options.nick or nick
+	if nick is None:
+		parser.error("Capture doesn't include registration, so --nick must be given")
+	if not lines:
+		parser.error("Capture is empty")
+
+	config.load(user_config=True, argv=False, env=True)
+	name = options.client or 'replay'
+	client_options = dict(config.clients_with_defaults.get(name, config.client_defaults))
+	for key in REPLACED_OPTIONS:
+		client_options.pop(key, None)
+	client_options['nick'] = nick
+
+	server = FakeServer(record=False)
+	server.start()
+	store_path = bench.configure(server, [name], client_options, options.loglevel, user_config=True)
+	managers = []
+	try:
+		managers, (connection,) = bench.start_clients(server, [name])
+		stats.reset()
+		start = time.time()
+		replay(connection, lines, options.speed, options.batch)
+		if not connection.sync(options.timeout):
+			raise Exception("Timed out waiting for client to handle traffic")
+		gevent.idle()
+		elapsed = time.time() - start
+	finally:
+		bench.cleanup(managers, server, store_path)
+
+	handlers = bench.merged_latency('handler')
+	commands = bench.merged_latency('command')
+	results = {
+		'throughput': len(lines) / elapsed,
+		'handler_p50': handlers.percentile(0.5),
+		'handler_p99': handlers.percentile(0.99),
+		'command_p50': commands.percentile(0.5),
+		'command_p99': commands.percentile(0.99),
+		'rss_peak_kib': bench.max_rss(),
+	}
+	print "Replayed {} lines (recorded over {}) in {}".format(
+		len(lines), format_seconds(lines[-1][0] - lines[0][0]), format_seconds(elapsed),
+	)
+	for key, value in sorted(results.items()):
+		print '{}: {}'.format(key, bench.format_value(key, value))
+	timers = sorted(stats.timers.items(), key=lambda (key, timer): -timer.latency.sum)
+	for (kind, timer_name), timer in timers[:options.top]:
+		print "{} {}: {} calls, {} errors, p50 {}, p99 {}, total {}".format(
+			kind, timer_name, timer.calls, timer.errors,
+			format_seconds(timer.latency.percentile(0.5)),
+			format_seconds(timer.latency.percentile(0.99)),
+			format_seconds(timer.latency.sum),
+		)
+
+	replay_options = {'captures': options.captures, 'speed': options.speed, 'client': options.client}
+	return bench.report_baseline(results, replay_options, options.compare, options.save, options.tolerance)
+
+
+if __name__ == '__main__':
+	sys.exit(main_cli())
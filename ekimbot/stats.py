@@ -0,0 +1,187 @@
+"""Process-wide performance statistics: call counts and latency histograms for handlers and
+other timed operations, and per-client message rates.
+Handlers are timed if they are a TimedHandler (see ekimbot.commands), as all plugin handlers should be.
+This doesn't include EkimbotClient's own bookkeeping handlers, which are cheap and run for every message.
+See the "stats" core plugin for ways to view them.
+"""
+
+import bisect
+import math
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of each histogram bucket, from 10us doubling up to about 40s.
+# There is one more bucket for anything larger.
+BUCKET_BOUNDS = [10e-6 * 2**i for i in range(23)]
+
+
+class Histogram(object):
+	"""Counts values into log-sized buckets (see BUCKET_BOUNDS), so it uses a fixed amount of memory"""
+
+	def __init__(self):
+		self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+		self.count = 0
+		self.sum = 0
+
+	def observe(self, value):
+		self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def percentile(self, fraction):
+		"""Returns an upper bound for the given percentile (as a fraction, eg. 0.99), or None if empty.
+		This is the upper bound of the bucket it falls in, so is accurate to within a factor of 2."""
+		if not self.count:
+			return None
+		target = fraction * self.count
+		total = 0
+		for bound, count in zip(BUCKET_BOUNDS, self.buckets):
+			total += count
+			if total >= target:
+				return bound
+		return float('inf')
+
+
+class Timer(object):
+	"""Calls, errors and latency of some operation"""
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.latency = Histogram()
+
+	def observe(self, duration, error=False):
+		self.calls += 1
+		if error:
+			self.errors += 1
+		self.latency.observe(duration)
+
+
+class Rate(object):
+	"""Counts events, and keeps an exponentially weighted average of events per second
+	over about the last WINDOW seconds"""
+	WINDOW = 60
+
+	def __init__(self):
+		self.count = 0
+		self._rate = 0.0
+		self._pending = 0
+		self._last = time.time()
+
+	def mark(self, amount=1):
+		self.count += amount
+		self._pending += amount
+
+	@property
+	def rate(self):
+		now = time.time()
+		elapsed = now - self._last
+		if elapsed >= 1:
+			alpha = 1 - math.exp(-elapsed / self.WINDOW)
+			self._rate += alpha * (self._pending / elapsed - self._rate)
+			self._pending = 0
+			self._last = now
+		return self._rate
+
+
+class ClientStats(object):
+	def __init__(self):
+		self.messages_in = Rate()
+		self.messages_out = Rate()
+
+
+class Stats(object):
+	"""Registry of all stats. Timers are keyed by (kind, name), eg. ('command', 'help') or ('handler', 'slave.abdicate').
+	Counters are likewise keyed by (kind, name) and are plain integers."""
+
+	def __init__(self):
+		self.timers = {}
+		self.counters = {}
+		self.clients = {}
+
+	def timer(self, kind, name):
+		key = kind, name
+		if key not in self.timers:
+			self.timers[key] = Timer()
+		return self.timers[key]
+
+	@contextmanager
+	def timed(self, kind, name):
+		"""Context manager that records how long its body took in the given timer,
+		and counts it as an error if it raises"""
+		timer = self.timer(kind, name)
+		start = time.time()
+		error = True
+		try:
+			yield
+			error = False
+		finally:
+			timer.observe(time.time() - start, error)
+
+	def count(self, kind, name, amount=1):
+		key = kind, name
+		self.counters[key] = self.counters.get(key, 0) + amount
+
+	def client(self, name):
+		if name not in self.clients:
+			self.clients[name] = ClientStats()
+		return self.clients[name]
+
+	def reset(self):
+		"""Discard all stats. Metrics are replaced rather than zeroed, so callers should look them up
+		each time they're used rather than holding on to them."""
+		self.timers.clear()
+		self.counters.clear()
+		self.clients.clear()
+
+
+stats = Stats()
+
+
+def format_seconds(value):
+	if value is None:
+		return '-'
+	if value < 1:
+		return '{:.1f}ms'.format(value * 1000)
+	return '{:.2f}s'.format(value)
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(stats=stats, prefix='ekimbot'):
+	"""Returns all stats in the prometheus text exposition format"""
+	lines = []
+	def metric(name, kind, samples):
+		lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+		for suffix, labels, value in samples:
+			labels = ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels)
+			lines.append('{}_{}{}{{{}}} {}'.format(prefix, name, suffix, labels, repr(float(value))))
+
+	timers = sorted(stats.timers.items())
+	metric('calls_total', 'counter', [
+		('', [('kind', kind), ('name', name)], timer.calls) for (kind, name), timer in timers
+	])
+	metric('errors_total', 'counter', [
+		('', [('kind', kind), ('name', name)], timer.errors) for (kind, name), timer in timers
+	])
+	samples = []
+	for (kind, name), timer in timers:
+		labels = [('kind', kind), ('name', name)]
+		total = 0
+		for bound, count in zip(BUCKET_BOUNDS, timer.latency.buckets):
+			total += count
+			samples.append(('_bucket', labels + [('le', repr(bound))], total))
+		samples.append(('_bucket', labels + [('le', '+Inf')], timer.latency.count))
+		samples.append(('_sum', labels, timer.latency.sum))
+		samples.append(('_count', labels, timer.latency.count))
+	metric('latency_seconds', 'histogram', samples)
+	metric('events_total', 'counter', [
+		('', [('kind', kind), ('name', name)], value) for (kind, name), value in sorted(stats.counters.items())
+	])
+	clients = sorted(stats.clients.items())
+	metric('messages_in_total', 'counter', [('', [('client', name)], client.messages_in.count) for name, client in clients])
+	metric('messages_out_total', 'counter', [('', [('client', name)], client.messages_out.count) for name, client in clients])
+	return '\n'.join(lines) + '\n'
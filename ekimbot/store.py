@@ -1,38 +1,557 @@
+"""Persistent storage for plugins.
+Run as __main__ to migrate an existing JSON store to an sqlite store:
+	python -m ekimbot.store JSON_PATH SQLITE_PATH
+"""
 
+import fcntl
 import os
 import json
+import sqlite3
 import weakref
+from collections import MutableMapping
+from contextlib import contextmanager
+
+import gevent
+import gevent.lock
 
 
 class _StoreMeta(type):
-	# provides singleton mechanics for Store based on filepath
+	# provides singleton mechanics for Store based on filepath.
+	# Any options are only used when the store is first created.
 	_stores = weakref.WeakValueDictionary()
-	def __call__(self, filepath):
+	def __call__(self, filepath, **options):
 		if filepath not in self._stores:
-			new_store = super(_StoreMeta, self).__call__(filepath)
+			new_store = super(_StoreMeta, self).__call__(filepath, **options)
 			self._stores[filepath] = new_store
 		return self._stores[filepath]
 
 
 class Store(object):
-	"""Provides means for an easy to use JSON store as a file."""
+	"""Provides means for an easy to use JSON store as a file.
+
+	Data is organised into namespaces, identified by a path of (plugin,), (plugin, client) or (plugin, client, channel),
+	see namespace(). By default, save() synchronously rewrites the whole file.
+	If write_delay is given, the store is instead write-behind: save() only marks the given
+	namespace as dirty, and dirty namespaces are appended to a journal file (filepath + ".journal")
+	at most once every write_delay seconds. Once the journal grows beyond compact_size bytes, or on flush(),
+	it is compacted back into the main file. All file I/O in this mode happens in gevent's threadpool.
+
+	If shared is True, the file may be shared with other processes. Saves always go via the journal
+	(immediately, unless write_delay is also given), and all writes are done holding an advisory lock
+	on filepath + ".lock". Compaction merges what is on disk rather than overwriting it with our data,
+	so each process only ever replaces the namespaces it saved, eg. two processes may each save the same plugin's
+	namespace for different clients without losing the other's changes. The files are polled every poll_interval seconds
+	for changes by other processes, and any changed namespaces are reloaded (unless we have changes to them pending a write).
+	"""
 	__metaclass__ = _StoreMeta
 
-	def __init__(self, filepath):
+	DEFAULT_COMPACT_SIZE = 1024 * 1024
+
+	# sentinel snapshot id, which forces the next _read_changes() to read the whole file
+	_UNREAD = object()
+
+	# {filepath: data} passed from a previous process by a handoff, see set_handoff_state()
+	_handoff_data = {}
+
+	def __init__(self, filepath, write_delay=None, compact_size=None, shared=False, poll_interval=1):
 		self.filepath = filepath
-		self.load()
+		self.journal_path = "{}.journal".format(filepath)
+		self.write_delay = write_delay
+		self.compact_size = self.DEFAULT_COMPACT_SIZE if compact_size is None else compact_size
+		self.shared = shared
+		self._dirty = set()
+		self._dirty_all = False
+		self._flusher = None
+		self._lock = gevent.lock.RLock()
+		self._snapshot_id = self._UNREAD
+		self._journal_offset = 0 # how much of the journal we have read or written
+		if shared:
+			self._lockfile = open("{}.lock".format(filepath), 'a')
+			with self._file_lock():
+				self.load()
+			gevent.spawn(self._watch, weakref.ref(self), poll_interval)
+		else:
+			self.load()
+
+	@classmethod
+	def flush_all(cls):
+		"""Flush all open stores, of any backend. Should be called before exiting."""
+		for store in _StoreMeta._stores.values():
+			store.flush()
+
+	@classmethod
+	def get_handoff_state(cls):
+		"""Returns the data of all open JSON stores, so that a new process taking over from this one
+		doesn't need to re-read them from disk. Stores should be flushed first.
+		Shared stores are not included, as other processes may change them before the new process starts."""
+		return {
+			store.filepath: store.data for store in _StoreMeta._stores.values()
+			if isinstance(store, Store) and not store.shared
+		}
+
+	@classmethod
+	def set_handoff_state(cls, state):
+		"""Use data from get_handoff_state() in a previous process for stores opened later"""
+		cls._handoff_data.update(state)
+
+	def namespace(self, plugin, client=None, channel=None):
+		"""Returns the dict for the given plugin, and optionally client and channel within that plugin"""
+		d = self.data.setdefault(plugin, {})
+		if client is not None:
+			d = d.setdefault(client, {})
+		if channel is not None:
+			d = d.setdefault(channel, {})
+		return d
 
 	def load(self):
+		data = self._handoff_data.pop(self.filepath, None)
+		if data is not None and not self.shared:
+			# the old process flushed before handing off, so this matches what is on disk
+			self.data = data
+			self._snapshot_id = self._file_id(self.filepath)
+			self._journal_offset = self._file_size(self.journal_path)
+			return
+		self._snapshot_id = self._UNREAD
+		self._journal_offset = 0
+		self.data, _ = self._read_changes()
 		if not os.path.exists(self.filepath):
-			self.data = {}
-			self.save()
+			self._write_snapshot(json.dumps(self.data, indent=4))
+
+	def _read_changes(self):
+		"""Returns (snapshot, entries). If the main file has been replaced since we last looked, snapshot
+		is the full data from disk (including the journal) and entries is empty. Otherwise, snapshot is None
+		and entries is a list of journal entries (see _parse_entry) written since we last looked.
+		In shared mode, must be called with the lock file held."""
+		snapshot_id = self._file_id(self.filepath)
+		if snapshot_id != self._snapshot_id:
+			self._snapshot_id = snapshot_id
+			self._journal_offset = 0
+			data = {}
+			if snapshot_id is not None:
+				with open(self.filepath) as f:
+					data = json.load(f)
+			for entry in self._read_journal():
+				self._apply_entry(data, entry)
+			return data, []
+		return None, self._read_journal()
+
+	def _read_journal(self):
+		if not os.path.exists(self.journal_path):
+			return []
+		with open(self.journal_path) as f:
+			f.seek(self._journal_offset)
+			lines = f.read()
+		self._journal_offset += len(lines)
+		entries = []
+		for line in lines.split('\n'):
+			entry = self._parse_entry(line) if line else None
+			if isinstance(entry, dict):
+				if entry.get('snapshot') != json.loads(json.dumps(self._snapshot_id)):
+					# The journal is for an older snapshot. This happens if we crashed while compacting,
+					# after replacing the snapshot but before removing the journal, so its changes are already
+					# in the snapshot and replaying them could undo newer ones.
+					os.remove(self.journal_path)
+					self._journal_offset = 0
+					return []
+			elif entry is not None:
+				entries.append(entry)
+		return entries
+
+	def _parse_entry(self, line):
+		"""Journal entries are (path, value) or (path,) for a deleted namespace, where path is a tuple
+		as per namespace(). Older journals may have a plugin name in place of the path.
+		The first line of a journal is a header {"snapshot": snapshot id} naming the snapshot it applies to,
+		which is returned as a dict."""
+		try:
+			entry = json.loads(line)
+		except ValueError:
+			return None # partially written line, eg. due to a crash mid-write
+		if isinstance(entry, dict):
+			return entry
+		path = entry[0]
+		path = tuple(path) if isinstance(path, list) else (path,)
+		return (path,) + tuple(entry[1:])
+
+	def _apply_entry(self, data, entry):
+		path = entry[0]
+		for key in path[:-1]:
+			data = data.setdefault(key, {})
+		if len(entry) == 2:
+			data[path[-1]] = entry[1]
+		else:
+			data.pop(path[-1], None)
+
+	def _lookup(self, data, path):
+		"""Returns (value,) for the namespace at path in data, or () if it doesn't exist"""
+		for key in path:
+			if not isinstance(data, dict) or key not in data:
+				return ()
+			data = data[key]
+		return data,
+
+	def _merge(self, snapshot, entries, exclude=()):
+		"""Apply changes read from disk to our data, except for namespaces we have unsaved changes to
+		and those in exclude. Namespaces which haven't changed are left alone."""
+		skip = self._dirty | set(exclude)
+		if snapshot is not None:
+			self._merge_snapshot(self.data, snapshot, skip, ())
+		for entry in entries:
+			path = entry[0]
+			if any(path[:len(skipped)] == skipped for skipped in skip):
+				continue # we have newer changes to this namespace, or one containing it
+			# the entry may replace a namespace that contains ones we have newer changes to, so keep ours
+			kept = [(skipped, self._lookup(self.data, skipped)) for skipped in skip if skipped[:len(path)] == path]
+			self._apply_entry(self.data, entry)
+			for skipped, value in kept:
+				self._apply_entry(self.data, (skipped,) + value)
+
+	def _merge_snapshot(self, data, snapshot, skip, path):
+		# data and snapshot are our and the on-disk dicts at path
+		for key in set(snapshot) | set(data):
+			subpath = path + (key,)
+			if subpath in skip:
+				continue
+			if any(skipped[:len(subpath)] == subpath for skipped in skip):
+				# some namespace within this one must be kept, so merge within it
+				theirs = snapshot.get(key)
+				if not isinstance(data.get(key), dict):
+					data[key] = {}
+				self._merge_snapshot(data[key], theirs if isinstance(theirs, dict) else {}, skip, subpath)
+			elif key not in snapshot:
+				del data[key]
+			elif data.get(key) != snapshot[key]:
+				data[key] = snapshot[key]
+
+	@staticmethod
+	def _watch(store_ref, interval):
+		# We only hold a weak reference between polls so we don't keep the store alive
+		while True:
+			gevent.sleep(interval)
+			store = store_ref()
+			if store is None:
+				return
+			try:
+				store.refresh()
+			finally:
+				del store
+
+	def refresh(self):
+		"""In shared mode, reload any namespaces that have been changed by other processes"""
+		if self._file_id(self.filepath) == self._snapshot_id and self._file_size(self.journal_path) <= self._journal_offset:
+			return # fast path: nothing has changed
+		with self._lock:
+			self._merge(*self._in_threadpool(self._locked, fcntl.LOCK_SH, self._read_changes))
+
+	def save(self, plugin=None, client=None, channel=None):
+		"""Persist the store to disk.
+		In write-behind or shared mode, this only marks the given namespace (as per namespace()),
+		or every namespace if none is given, as dirty and schedules it to be written."""
+		if self.write_delay is None and not self.shared:
+			self._write_snapshot(json.dumps(self.data, indent=4))
 			return
-		with open(self.filepath) as f:
-			self.data = json.load(f)
+		if plugin is None:
+			self._dirty_all = True
+		else:
+			self._dirty.add(tuple(key for key in (plugin, client, channel) if key is not None))
+		if self.write_delay is None:
+			self._write()
+		elif self._flusher is None:
+			self._flusher = gevent.spawn_later(self.write_delay, self._scheduled_flush)
 
-	def save(self):
-		# write-then-rename for atomic overwrite
+	def flush(self):
+		"""Immediately write any pending changes and compact the journal into the main file.
+		Blocks the calling greenlet (but not other greenlets) until done."""
+		if self.write_delay is None and not self.shared:
+			return
+		self._write(compact=True)
+
+	def _scheduled_flush(self):
+		self._flusher = None
+		self._write()
+
+	def _write(self, compact=False):
+		with self._lock:
+			dirty_all = self._dirty_all
+			if self._dirty_all:
+				if self.shared:
+					# we can't just write out all our data, as it would clobber other processes' namespaces
+					self._dirty |= set((plugin,) for plugin in self.data)
+				else:
+					compact = True
+				self._dirty_all = False
+			lines = []
+			written, self._dirty = self._dirty, set()
+			for path in written:
+				entry = [path] + list(self._lookup(self.data, path))
+				lines.append(json.dumps(entry, separators=(',', ':')) + '\n')
+			lines = ''.join(lines)
+			try:
+				if self.shared:
+					snapshot, entries = self._in_threadpool(self._locked, fcntl.LOCK_EX, self._shared_write, lines, compact)
+					# changes by other processes were read before we appended ours, so are older for the namespaces we wrote
+					self._merge(snapshot, entries, exclude=written)
+					return
+				if lines:
+					self._in_threadpool(self._append_journal, lines)
+				if compact or self._journal_offset > self.compact_size:
+					# data must be serialized here, not in the threadpool, as other greenlets may be modifying it
+					self._in_threadpool(self._write_snapshot, json.dumps(self.data, separators=(',', ':')))
+			except Exception:
+				# eg. disk full. Keep our changes pending so they're written next time.
+				self._dirty |= written
+				self._dirty_all = self._dirty_all or dirty_all
+				if self.write_delay is not None and self._flusher is None:
+					self._flusher = gevent.spawn_later(self.write_delay, self._scheduled_flush)
+				raise
+
+	def _shared_write(self, lines, compact):
+		"""Append lines to the journal, and compact if needed. Must be called with the lock file held.
+		Returns changes by other processes, as per _read_changes."""
+		changes = self._read_changes()
+		if lines:
+			self._append_journal(lines)
+		if compact or self._journal_offset > self.compact_size:
+			# compact what is on disk, which may include namespaces we haven't seen yet
+			self._snapshot_id = self._UNREAD
+			data, _ = self._read_changes()
+			self._write_snapshot(json.dumps(data, separators=(',', ':')))
+		return changes
+
+	def _in_threadpool(self, fn, *args):
+		return gevent.get_hub().threadpool.apply(fn, args)
+
+	def _locked(self, operation, fn, *args):
+		with self._file_lock(operation):
+			return fn(*args)
+
+	@contextmanager
+	def _file_lock(self, operation=fcntl.LOCK_EX):
+		fcntl.flock(self._lockfile.fileno(), operation)
+		try:
+			yield
+		finally:
+			fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_UN)
+
+	def _file_id(self, path):
+		"""Returns a value that changes if the file is replaced, or None if it doesn't exist"""
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		return stat.st_ino, stat.st_mtime, stat.st_size
+
+	def _file_size(self, path):
+		try:
+			return os.stat(path).st_size
+		except OSError:
+			return 0
+
+	def _append_journal(self, lines):
+		if not self._file_size(self.journal_path):
+			lines = json.dumps({'snapshot': self._snapshot_id}) + '\n' + lines
+		fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+		try:
+			start = os.lseek(fd, 0, os.SEEK_END)
+			try:
+				written = 0
+				while written < len(lines):
+					written += os.write(fd, lines[written:])
+			except Exception:
+				# don't leave a partial line for the next append to be joined onto
+				os.ftruncate(fd, start)
+				raise
+		finally:
+			os.close(fd)
+		self._journal_offset += len(lines)
+
+	def _write_snapshot(self, serialized):
+		# write-then-rename for atomic overwrite. The journal only contains changes that
+		# are already in the snapshot, so we can drop it. If we crash before we do, the journal's header
+		# won't match the new snapshot (rename keeps the file id) so it will be ignored, see _read_journal().
 		tmpfile = "{}.tmp".format(self.filepath)
 		with open(tmpfile, 'w') as f:
-			f.write(json.dumps(self.data, indent=4))
+			f.write(serialized)
 		os.rename(tmpfile, self.filepath)
+		if os.path.exists(self.journal_path):
+			os.remove(self.journal_path)
+		self._snapshot_id = self._file_id(self.filepath)
+		self._journal_offset = 0
+
+
+class SqliteStore(object):
+	"""A store backed by an sqlite database, for data too large to comfortably keep in memory.
+	Each value is a row keyed by (plugin, client, channel, key) and encoded as JSON.
+	Namespaces are mappings which load values lazily on first access, and save() only writes keys
+	that were changed or deleted since they were loaded or last saved.
+	Accepts and ignores the same options as Store, so they can be used interchangeably.
+	In particular, sqlite does its own locking so there's no need for a shared option,
+	but values that have already been loaded are not reloaded if another process changes them.
+	"""
+	__metaclass__ = _StoreMeta
+
+	def __init__(self, filepath, **options):
+		self.filepath = filepath
+		self.db = sqlite3.connect(filepath)
+		self.db.execute("""
+			CREATE TABLE IF NOT EXISTS store (
+				plugin TEXT NOT NULL,
+				client TEXT NOT NULL,
+				channel TEXT NOT NULL,
+				key TEXT NOT NULL,
+				value TEXT NOT NULL,
+				PRIMARY KEY (plugin, client, channel, key)
+			)
+		""")
+		self.db.commit()
+		self._namespaces = {}
+
+	def namespace(self, plugin, client=None, channel=None):
+		"""Returns a mapping for the given plugin, and optionally client and channel within that plugin"""
+		scope = plugin, client or '', channel or ''
+		if scope not in self._namespaces:
+			self._namespaces[scope] = SqliteNamespace(self.db, scope)
+		return self._namespaces[scope]
+
+	def save(self, plugin=None, client=None, channel=None):
+		"""Write changed keys for the given namespace and any within it, or all namespaces if not given"""
+		prefix = tuple(key or '' for key in (plugin, client, channel) if key is not None)
+		for scope, namespace in self._namespaces.items():
+			if scope[:len(prefix)] == prefix:
+				namespace.save()
+		self.db.commit()
+
+	def flush(self):
+		pass # all writes are synchronous
+
+
+class SqliteNamespace(MutableMapping):
+	"""The values for one (plugin, client, channel) scope of an SqliteStore.
+	Loaded values are kept in memory along with their encoded form, so that changes to them
+	(including in-place changes to mutable values) can be detected on save."""
+
+	def __init__(self, db, scope):
+		self.db = db
+		self.scope = scope
+		self._values = {}
+		self._encoded = {} # encoded value as of last load or save, for loaded keys
+		self._deleted = set()
+
+	def __getitem__(self, key):
+		if key in self._values:
+			return self._values[key]
+		if key in self._deleted:
+			raise KeyError(key)
+		row = self.db.execute(
+			"SELECT value FROM store WHERE plugin = ? AND client = ? AND channel = ? AND key = ?",
+			self.scope + (key,),
+		).fetchone()
+		if row is None:
+			raise KeyError(key)
+		encoded, = row
+		self._values[key] = json.loads(encoded)
+		self._encoded[key] = encoded
+		return self._values[key]
+
+	def __setitem__(self, key, value):
+		self._values[key] = value
+		self._deleted.discard(key)
+
+	def __delitem__(self, key):
+		self[key] # raise KeyError if it doesn't exist
+		del self._values[key]
+		self._deleted.add(key)
+
+	def __contains__(self, key):
+		try:
+			self[key]
+		except KeyError:
+			return False
+		return True
+
+	def __iter__(self):
+		keys = set(key for key, in self.db.execute(
+			"SELECT key FROM store WHERE plugin = ? AND client = ? AND channel = ?",
+			self.scope,
+		))
+		keys |= set(self._values)
+		keys -= self._deleted
+		return iter(keys)
+
+	def __len__(self):
+		return sum(1 for key in self)
+
+	def save(self):
+		changed = []
+		for key, value in self._values.items():
+			encoded = json.dumps(value, sort_keys=True)
+			if encoded != self._encoded.get(key):
+				changed.append(self.scope + (key, encoded))
+				self._encoded[key] = encoded
+		if changed:
+			self.db.executemany(
+				"INSERT OR REPLACE INTO store (plugin, client, channel, key, value) VALUES (?, ?, ?, ?, ?)",
+				changed,
+			)
+		if self._deleted:
+			self.db.executemany(
+				"DELETE FROM store WHERE plugin = ? AND client = ? AND channel = ? AND key = ?",
+				[self.scope + (key,) for key in self._deleted],
+			)
+			for key in self._deleted:
+				self._encoded.pop(key, None)
+			self._deleted = set()
+
+
+BACKENDS = {
+	'json': Store,
+	'sqlite': SqliteStore,
+}
+
+
+def migrate(json_path, sqlite_path, depths):
+	"""Copy all data from the JSON store at json_path into the sqlite store at sqlite_path.
+	depths maps plugin name to how many levels of namespace that plugin's data is nested under:
+	0 for BotPlugins, 1 for ClientPlugins (by client) and 2 for ChannelPlugins (by client, then channel).
+	Plugins not in depths are assumed to be BotPlugins.
+	"""
+	with open(json_path) as f:
+		data = json.load(f)
+	target = SqliteStore(sqlite_path)
+	for plugin, plugin_data in data.items():
+		namespaces = [((plugin,), plugin_data)]
+		for level in range(depths.get(plugin, 0)):
+			namespaces = [
+				(scope + (name,), sub_data)
+				for scope, scope_data in namespaces
+				for name, sub_data in scope_data.items()
+			]
+		for scope, scope_data in namespaces:
+			namespace = target.namespace(*scope)
+			namespace.update(scope_data)
+	target.save()
+
+
+if __name__ == '__main__':
+	import sys
+
+	from ekimbot.botplugin import BotPlugin, ClientPlugin, ChannelPlugin
+	from ekimbot.config import config
+	from ekimbot.utils import list_modules
+
+	json_path, sqlite_path = sys.argv[1:]
+	config.load(user_config=True, env=True)
+
+	# we need to load every plugin to find out how deeply its store is nested
+	for path in config.plugin_paths:
+		for plugin_name in list_modules(path):
+			BotPlugin.load(plugin_name)
+	depths = {}
+	plugin_classes = [BotPlugin]
+	while plugin_classes:
+		cls = plugin_classes.pop()
+		plugin_classes += cls.__subclasses__()
+		name = getattr(cls, 'name', None)
+		if name:
+			depths[name] = 2 if issubclass(cls, ChannelPlugin) else 1 if issubclass(cls, ClientPlugin) else 0
+
+	migrate(json_path, sqlite_path, depths)
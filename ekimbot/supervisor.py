@@ -0,0 +1,190 @@
+"""Running clients across multiple worker processes, see the "workers" option.
+
+The supervisor process runs no clients itself. It starts each worker by re-exec()ing ekimbot
+with worker_index, worker_count and control_fd set in the environment, and restarts any worker
+that exits. Each worker runs its share of config.clients (see worker_for()), and worker 0 also runs
+the global plugins.
+
+Workers and the supervisor talk over a unix socketpair (see ControlLink). Operations that affect the
+whole bot, like stopping or a "process restart", are sent to the supervisor, which passes them on
+to every worker. Operations on a single client (eg. the "restart" command) need no routing, as they always
+come from the worker running that client. Sending the supervisor SIGHUP
+makes every worker restart with handoff.
+"""
+
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import gevent
+from backoff import Backoff
+
+from ekimbot import handoff
+from ekimbot.config import config
+
+
+logger = logging.getLogger('ekimbot.supervisor')
+
+
+def worker_count():
+	"""Returns the number of workers configured, or None if we aren't using workers"""
+	workers = config.workers
+	if not workers:
+		return None
+	if workers == 'auto':
+		import multiprocessing
+		workers = multiprocessing.cpu_count()
+	return max(1, min(int(workers), len(config.clients)))
+
+
+def worker_for(name, count):
+	"""Returns the index of the worker which runs the named client"""
+	return sorted(config.clients).index(name) % count
+
+
+class ControlLink(object):
+	"""A connection between the supervisor and a worker over which we send operations,
+	encoded as JSON lines like {"op": "handoff"}.
+	Received operations are passed to handler(op, **args). When the connection closes, handler(None) is called.
+	"""
+
+	def __init__(self, sock, handler):
+		self.sock = sock
+		self.handler = handler
+		self._reader = gevent.spawn(self._read)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def send(self, op, **args):
+		args['op'] = op
+		try:
+			self.sock.sendall(json.dumps(args) + '\n')
+		except socket.error as e:
+			# the other end has gone away, the reader will notice soon enough
+			logger.warning("Failed to send {} to control link: {}".format(op, e))
+
+	def close(self):
+		self._reader.kill()
+		self.sock.close()
+
+	def _read(self):
+		buf = ''
+		while True:
+			try:
+				data = self.sock.recv(4096)
+			except socket.error as e:
+				if e.errno != errno.ECONNRESET:
+					raise
+				data = ''
+			if not data:
+				self.handler(None)
+				return
+			buf += data
+			lines = buf.split('\n')
+			buf = lines.pop()
+			for line in lines:
+				args = json.loads(line)
+				self.handler(args.pop('op'), **args)
+
+
+class Worker(object):
+	"""A worker process, which is restarted whenever it exits unless we are stopping"""
+
+	def __init__(self, supervisor, index):
+		self.supervisor = supervisor
+		self.index = index
+		self.logger = logger.getChild(str(index))
+		self.pid = None
+		self.link = None
+		# lazy import to break cyclic dependency
+		from ekimbot.main import RETRY_START, RETRY_LIMIT, RETRY_FACTOR
+		self.retry_limit = RETRY_LIMIT
+		self.retry_timer = Backoff(RETRY_START, RETRY_LIMIT, RETRY_FACTOR)
+		self.greenlet = gevent.spawn(self._run)
+
+	def _spawn(self):
+		parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+		env = os.environ.copy()
+		env['worker_index'] = str(self.index)
+		env['worker_count'] = str(self.supervisor.count)
+		env['control_fd'] = str(child_sock.fileno())
+		pid = os.fork()
+		if pid == 0:
+			try:
+				handoff.close_fds(keep=[child_sock.fileno()])
+				os.execve(sys.executable, [sys.executable, '-m', 'ekimbot'] + sys.argv[1:], env)
+			finally:
+				os._exit(1) # never return into the supervisor's code in the child
+		child_sock.close()
+		self.pid = pid
+		self.link = ControlLink(parent_sock, self.supervisor.on_message)
+
+	def _run(self):
+		while not self.supervisor.stopping:
+			started = time.time()
+			self._spawn()
+			self.logger.info("Started worker with pid {}".format(self.pid))
+			_, status = os.waitpid(self.pid, 0)
+			self.link.close()
+			self.link = None
+			self.pid = None
+			if self.supervisor.stopping:
+				self.logger.info("Worker exited with status {}".format(status))
+				return
+			if time.time() - started > self.retry_limit:
+				self.retry_timer.reset()
+			self.logger.warning("Worker exited with status {}, restarting in {}s".format(status, self.retry_timer.peek()))
+			gevent.sleep(self.retry_timer.get())
+
+	def send(self, op, **args):
+		if self.link is not None:
+			self.link.send(op, **args)
+
+
+class Supervisor(object):
+	def __init__(self, count):
+		self.count = count
+		self.stopping = False
+		self.workers = []
+
+	def run(self):
+		# gevent.signal was renamed to signal_handler in gevent 1.5.
+		# This is done before starting workers, so if it fails we don't leave them orphaned.
+		signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+		signal_handler(signal.SIGHUP, self.on_message, 'handoff')
+		logger.info("Starting {} workers".format(self.count))
+		self.workers = [Worker(self, index) for index in range(self.count)]
+		try:
+			gevent.joinall([worker.greenlet for worker in self.workers])
+		except (KeyboardInterrupt, SystemExit):
+			self.stop()
+
+	def stop(self):
+		logger.info("Stopping all workers")
+		self.stopping = True
+		for worker in self.workers:
+			worker.send('stop')
+		gevent.joinall([worker.greenlet for worker in self.workers])
+
+	def on_message(self, op, **args):
+		if op == 'handoff':
+			logger.info("Restarting all workers with handoff")
+			for worker in self.workers:
+				worker.send('handoff')
+		elif op == 'stop':
+			gevent.spawn(self.stop)
+		# None means a worker closed its end, we find out why when it exits
+
+
+def supervise(count):
+	"""Run the supervisor with count workers, until stopped"""
+	def term(sig, frame):
+		raise KeyboardInterrupt
+	signal.signal(signal.SIGTERM, term)
+	Supervisor(count).run()
@@ -3,10 +3,16 @@ import os
 
 from girc import Privmsg
 
+from ekimbot.outbound import PRIORITY_NORMAL
 
-def reply(client, msg, text):
-	"""Reply a PRIVMSG to a given msg's sender, or to the whole channel if msg was a PRIVMSG to a channel."""
-	client.msg(reply_target(client, msg), text)
+
+def reply(client, msg, text, priority=None):
+	"""Reply a PRIVMSG to a given msg's sender, or to the whole channel if msg was a PRIVMSG to a channel.
+	The reply is queued in the client's outbound scheduler with the given priority, or by default
+	the priority set by the command that matched msg (see CommandHandler)."""
+	if priority is None:
+		priority = msg.extra.get('reply_priority', PRIORITY_NORMAL)
+	client.outbound.msg(reply_target(client, msg), text, priority)
 
 
 def reply_target(client, msg):
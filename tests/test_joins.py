@@ -0,0 +1,58 @@
+from ekimbot.joins import MAX_LENGTH, join_batches
+
+
+def line_length(names, keys):
+	return len('JOIN {} {}'.format(names, keys) if keys else 'JOIN {}'.format(names))
+
+
+def test_keyed_channels_first():
+	channels = [('#a', None), ('#b', 'key1'), ('#c', None), ('#d', 'key2')]
+	assert join_batches(channels, {}) == ([('#b,#d,#a,#c', 'key1,key2')], [])
+
+
+def test_targmax():
+	channels = [('#' + name, None) for name in 'abcde']
+	batches, skipped = join_batches(channels, {'TARGMAX': 'PRIVMSG:4,JOIN:2'})
+	assert batches == [('#a,#b', ''), ('#c,#d', ''), ('#e', '')]
+	assert skipped == []
+
+
+def test_targmax_without_join_limit():
+	channels = [('#' + name, None) for name in 'abcde']
+	assert join_batches(channels, {'TARGMAX': 'PRIVMSG:4,JOIN:'}) == ([('#a,#b,#c,#d,#e', '')], [])
+
+
+def test_max_length():
+	channels = [('#{}{}'.format('x' * 50, i), 'key{}'.format(i) if i % 3 else None) for i in range(40)]
+	batches, skipped = join_batches(channels, {})
+	assert skipped == []
+	assert len(batches) > 1
+	assert all(line_length(names, keys) <= MAX_LENGTH for names, keys in batches)
+	# every channel is joined exactly once, with its own key
+	joined = {}
+	for names, keys in batches:
+		names = names.split(',')
+		keys = keys.split(',') if keys else []
+		for i, name in enumerate(names):
+			assert name not in joined
+			joined[name] = keys[i] if i < len(keys) else None
+	assert joined == dict(channels)
+
+
+def test_chanlimit_counts_joined():
+	channels = [('#a', None), ('#b', None), ('&c', None)]
+	batches, skipped = join_batches(channels, {'CHANLIMIT': '#:3'}, joined=['#x', '#y'])
+	assert batches == [('#a,&c', '')]
+	assert skipped == ['#b']
+
+
+def test_chanlimit_shared_prefixes():
+	channels = [('#a', None), ('&b', None), ('#c', None)]
+	batches, skipped = join_batches(channels, {'CHANLIMIT': '#&:2'}, joined=['&x'])
+	assert batches == [('#a', '')]
+	assert skipped == ['&b', '#c']
+
+
+def test_maxchannels():
+	channels = [('#a', None), ('#b', None)]
+	assert join_batches(channels, {'MAXCHANNELS': '2'}, joined=['#x']) == ([('#a', '')], ['#b'])
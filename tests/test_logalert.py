@@ -0,0 +1,142 @@
+import asyncore
+import logging
+import smtpd
+import socket
+import threading
+
+import pytest
+
+from ekimbot.config import config
+from ekimbot.core_plugins.logalert import EmailHandler, Mailer
+
+
+class RecordingServer(smtpd.SMTPServer):
+	"""An SMTP server which keeps the mail it receives instead of sending it"""
+
+	def __init__(self):
+		smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+		self.port = self.socket.getsockname()[1]
+		self.received = []
+
+	def process_message(self, peer, mailfrom, rcpttos, data):
+		self.received.append((mailfrom, rcpttos, data))
+
+
+@pytest.fixture
+def server():
+	server = RecordingServer()
+	running = [True]
+	def serve():
+		while running[0]:
+			asyncore.loop(timeout=0.05, count=1)
+	thread = threading.Thread(target=serve)
+	thread.start()
+	yield server
+	running[0] = False
+	thread.join()
+	server.close()
+
+
+def logalert_config(port):
+	return {
+		'smtp_server': ['localhost', port],
+		'smtp_user': 'bot@example.com',
+		'starttls': False,
+		'target': 'admin@example.com',
+	}
+
+
+@pytest.fixture
+def handler(server, monkeypatch):
+	monkeypatch.setattr(config, 'logalert', logalert_config(server.port), raising=False)
+	handler = EmailHandler()
+	handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+	yield handler
+	handler.close()
+
+
+def log(handler, msg, *args, **kwargs):
+	handler.handle(logging.LogRecord(kwargs.get('name', 'ekimbot.test'), logging.WARNING, __file__, 1, msg, args, None))
+
+
+def test_mailer(server):
+	mailer = Mailer(logalert_config(server.port))
+	mailer.send('admin@example.com', 'subject', 'some text')
+	# the connection is kept open and reused
+	mailer.send('admin@example.com', 'again', 'more text')
+	mailer.close()
+	assert len(server.received) == 2
+	mailfrom, rcpttos, data = server.received[0]
+	assert mailfrom == 'bot@example.com'
+	assert rcpttos == ['admin@example.com']
+	assert 'Subject: subject' in data
+	assert 'some text' in data
+
+
+def test_batching_and_dedup(handler, server):
+	for i in range(3):
+		log(handler, "failed %d times", i)
+	log(handler, "something else")
+	log(handler, "failed %d times", 5, name='ekimbot.other')
+	handler._send_pending()
+	assert len(server.received) == 1
+	data = server.received[0][2]
+	assert '(5 records)' in data
+	# same logger and template are sent once, as first seen, with a count
+	assert 'WARNING failed 0 times' in data
+	assert 'failed 1 times' not in data
+	assert 'Repeated 3 times' in data
+	assert 'something else' in data
+	# a different logger isn't a duplicate
+	assert 'WARNING failed 5 times' in data
+	assert handler.pending == {}
+
+
+def test_rate_limit(handler, server):
+	handler.limit = 2
+	log(handler, "first")
+	handler._send_pending()
+	log(handler, "second")
+	handler._send_pending()
+	assert len(server.received) == 2
+	assert 'Rate limit reached' not in server.received[0][2]
+	assert 'Rate limit reached' in server.received[1][2]
+	log(handler, "held")
+	handler._send_pending()
+	assert len(server.received) == 2
+	assert list(handler.pending) == [('ekimbot.test', 'held')]
+	handler.limit = 1
+	handler._send_pending()
+	assert len(server.received) == 3
+	assert 'held' in server.received[2][2]
+
+
+def test_max_pending(handler, server):
+	for i in range(EmailHandler.MAX_PENDING + 5):
+		log(handler, "message {}".format(i))
+	handler._send_pending()
+	data = server.received[0][2]
+	assert 'message {}'.format(EmailHandler.MAX_PENDING - 1) in data
+	assert 'message {}'.format(EmailHandler.MAX_PENDING) not in data
+	assert '5 further records were not included' in data
+
+
+def test_failed_send_kept(handler, server):
+	# nothing is listening on a port we just closed
+	sock = socket.socket()
+	sock.bind(('localhost', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	handler.mailer.args = logalert_config(port)
+	log(handler, "first")
+	handler._send_pending()
+	assert handler.limit == EmailHandler.LIMIT
+	log(handler, "first")
+	log(handler, "second")
+	assert list(handler.pending) == [('ekimbot.test', 'first'), ('ekimbot.test', 'second')]
+	assert handler.pending[('ekimbot.test', 'first')][0] == 2
+	handler.mailer.args = logalert_config(server.port)
+	handler._send_pending()
+	assert len(server.received) == 1
+	assert 'Repeated 2 times' in server.received[0][2]
+	assert handler.limit == EmailHandler.LIMIT - 1
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from ekimbot.paging import pack_lines, split_line
+
+
+def test_split_on_space():
+	assert split_line('aaa bbb ccc', 7) == ['aaa bbb', 'ccc']
+
+
+def test_split_long_word():
+	assert split_line('a' * 10, 4) == ['aaaa', 'aaaa', 'aa']
+
+
+def test_split_multibyte():
+	# each character is 3 bytes in utf-8
+	for line in (u'日本語日本語', u'日本語日本語'.encode('utf-8')):
+		parts = split_line(line, 7)
+		for part in parts:
+			encoded = part.encode('utf-8') if isinstance(part, unicode) else part
+			assert len(encoded) <= 7
+			encoded.decode('utf-8') # not cut inside a character
+		assert ''.join(parts) == line
+		assert type(parts[0]) is type(line)
+
+
+def test_split_multibyte_on_space():
+	line = u'héllo wörld'
+	assert split_line(line, 10) == [u'héllo', u'wörld']
+	assert split_line(line.encode('utf-8'), 10) == ['h\xc3\xa9llo', 'w\xc3\xb6rld']
+
+
+def test_pack_lines():
+	assert pack_lines(['a', 'b', 'c' * 10], 8) == ['a | b', 'cccccccc', 'cc']
@@ -0,0 +1,156 @@
+import json
+import os
+
+import pytest
+
+from ekimbot.store import Store
+
+
+@pytest.fixture
+def path(tmpdir):
+	return str(tmpdir.join('store.json'))
+
+
+def other_process(path):
+	"""Store is a singleton per path, so to get a second store on the same file as another process would,
+	we give it an equivalent path."""
+	return os.path.join(os.path.dirname(path), '.', os.path.basename(path))
+
+
+def read(path):
+	store = Store(other_process(other_process(path)))
+	return store.data
+
+
+def test_shared_different_clients(path):
+	a = Store(path, shared=True, poll_interval=60)
+	b = Store(other_process(path), shared=True, poll_interval=60)
+	b.namespace('seen', 'clientB')['n'] = 1
+	b.save('seen', 'clientB')
+	a.namespace('seen', 'clientA')['n'] = 3
+	a.save('seen', 'clientA')
+	a.flush()
+	expected = {'seen': {'clientA': {'n': 3}, 'clientB': {'n': 1}}}
+	assert read(path) == expected
+	b.refresh()
+	assert b.data == expected
+
+
+def test_shared_keeps_unsaved_namespace(path):
+	a = Store(path, shared=True, poll_interval=60)
+	b = Store(other_process(path), shared=True, poll_interval=60)
+	a.namespace('seen', 'clientA', '#chan')['n'] = 1
+	a.save('seen', 'clientA', '#chan')
+	b.namespace('seen', 'clientA', '#other')['n'] = 2
+	b.save('seen', 'clientA', '#other')
+	# a has unsaved changes to its own channel, which must survive refreshing
+	a.namespace('seen', 'clientA', '#chan')['n'] = 5
+	a._dirty.add(('seen', 'clientA', '#chan'))
+	a.refresh()
+	assert a.data == {'seen': {'clientA': {'#chan': {'n': 5}, '#other': {'n': 2}}}}
+
+
+def test_shared_whole_plugin(path):
+	a = Store(path, shared=True, poll_interval=60)
+	b = Store(other_process(path), shared=True, poll_interval=60)
+	a.namespace('stats')['count'] = 1
+	a.save('stats')
+	b.refresh()
+	assert b.namespace('stats') == {'count': 1}
+	b.namespace('stats')['count'] = 2
+	b.save('stats')
+	a.refresh()
+	assert a.namespace('stats') == {'count': 2}
+
+
+def test_legacy_journal_entries(path):
+	with open(path, 'w') as f:
+		json.dump({}, f)
+	store = Store(path, write_delay=60)
+	with open(store.journal_path, 'w') as f:
+		f.write(json.dumps({'snapshot': store._snapshot_id}) + '\n')
+		f.write(json.dumps(['old', {'a': 1}]) + '\n')
+		f.write(json.dumps([['new', 'client'], {'b': 2}]) + '\n')
+	assert read(path) == {'old': {'a': 1}, 'new': {'client': {'b': 2}}}
+
+
+def test_journal_replay(path):
+	store = Store(path, write_delay=60)
+	store.namespace('seen', 'client')['n'] = 1
+	store.save('seen', 'client')
+	store._write()
+	with open(path) as f:
+		assert json.load(f) == {}
+	assert os.path.exists(store.journal_path)
+	assert read(path) == {'seen': {'client': {'n': 1}}}
+
+
+def test_compaction(path):
+	store = Store(path, write_delay=60, compact_size=100)
+	for i in range(10):
+		store.namespace('seen', 'client{}'.format(i))['n'] = i
+		store.save('seen', 'client{}'.format(i))
+		store._write()
+	# the journal outgrew compact_size, so was compacted into the main file
+	with open(path) as f:
+		snapshot = json.load(f)
+	assert 'client0' in snapshot['seen']
+	assert store._file_size(store.journal_path) <= 100
+	store.flush()
+	assert not os.path.exists(store.journal_path)
+	expected = {'seen': {'client{}'.format(i): {'n': i} for i in range(10)}}
+	with open(path) as f:
+		assert json.load(f) == expected
+	assert read(path) == expected
+
+
+def test_stale_journal_ignored(path):
+	store = Store(path, write_delay=60)
+	store.namespace('seen')['n'] = 1
+	store.save('seen')
+	store._write()
+	with open(store.journal_path) as f:
+		journal = f.read()
+	store.namespace('seen')['n'] = 2
+	store.flush()
+	# as if we crashed during compaction, after replacing the snapshot but before removing the journal
+	with open(store.journal_path, 'w') as f:
+		f.write(journal)
+	assert read(path) == {'seen': {'n': 2}}
+	assert not os.path.exists(store.journal_path)
+
+
+def test_failed_write_retried(path, monkeypatch):
+	store = Store(path, write_delay=60)
+	store.namespace('seen')['n'] = 1
+	store.save('seen')
+	def fail(lines):
+		raise IOError("disk full")
+	monkeypatch.setattr(store, '_append_journal', fail)
+	with pytest.raises(IOError):
+		store._write()
+	assert store._dirty == {('seen',)}
+	monkeypatch.undo()
+	store.flush()
+	assert read(path) == {'seen': {'n': 1}}
+
+
+def test_shared_workers(path):
+	# as with multiple workers: each saves its own clients' namespaces of the same plugin, write-behind,
+	# and each compacts the journal in turn
+	workers = [
+		Store(worker_path, shared=True, write_delay=60, poll_interval=60)
+		for worker_path in (path, other_process(path))
+	]
+	for i in range(3):
+		for index, store in enumerate(workers):
+			client = 'client{}'.format(index)
+			store.namespace('seen', client, '#chan')['n'] = i
+			store.save('seen', client, '#chan')
+			store._write(compact=(i == 1))
+	for store in workers:
+		store.flush()
+	expected = {'seen': {'client0': {'#chan': {'n': 2}}, 'client1': {'#chan': {'n': 2}}}}
+	assert read(path) == expected
+	workers[0].refresh()
+	assert workers[0].data == expected